@@ -0,0 +1,599 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+import aiohttp
+from web3 import Web3
+from web3.providers.async_rpc import AsyncHTTPProvider
+
+from block_index import BlockTimestampIndex
+from chain_store import ChainStore, sync_plan
+from client import get_client
+from ethereum_transactions import (EXCHANGES, HOLDER_INDEXES, PRICE_CACHE, TOKEN_ADDRESSES, get_default_store,
+                                   parse_spot_price, spot_price_request, transaction_record)
+from holder_index import HolderIndex
+from http_client import get_timeout
+from metrics import inc, observe, record_http_request, traced
+from log_scanner import TRANSFER_TOPIC, ChunkPlanner
+from rate_limiter import RetryPolicy
+from rpc_pool import NON_HEDGED_METHODS, HedgedCall, RPCEndpoint, rpc_endpoints, upstream_name
+from transfer_table import TransferTable
+from transfers import BlockTimestampCache, decode_transfer_log
+from wallet_history import merge_logs, split_by_wallet, wallet_topic_filters
+
+
+def format_log(log: Dict) -> Dict:
+    """
+    Convert the hex quantities of a raw JSON-RPC log to integers, as web3 does
+
+    :param log: raw log entry
+    :return: log entry with integer block number, log index and transaction index
+    """
+    return dict(log,
+                blockNumber=int(log['blockNumber'], 16),
+                logIndex=int(log['logIndex'], 16),
+                transactionIndex=int(log['transactionIndex'], 16))
+
+
+def _client_timeout(name: str) -> aiohttp.ClientTimeout:
+    connect, read = get_timeout(name)
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+async def send_request(upstream: str, session: aiohttp.ClientSession, method: str, url: str,
+                       max_retries: int = 5, tokens: int = 1, **kwargs: Any) -> bytes:
+    """
+    Send a request through the shared rate limiter of an upstream, retrying with backoff
+
+    The async counterpart of http_client.request: throttled (429/503),
+    failed (5xx) and dropped requests are retried as RetryPolicy decides,
+    and every attempt is recorded in the metrics of the upstream.
+
+    :param upstream: upstream name whose rate limiter to use
+    :param session: aiohttp session to send the request with
+    :param method: HTTP method
+    :param url: request URL
+    :param max_retries: number of retries before giving up
+    :param tokens: number of requests the upstream meters this request as
+    :param kwargs: options passed to aiohttp
+    :return: body of the successful response
+    """
+    retry = RetryPolicy(upstream, max_retries, tokens)
+    while True:
+        delay = retry.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        started_at = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            record_http_request(upstream, type(e).__name__, time.perf_counter() - started_at, 0, 0)
+            delay = retry.on_error(e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        sent = kwargs.get('data')
+        record_http_request(upstream, response.status, time.perf_counter() - started_at,
+                            len(sent) if isinstance(sent, (bytes, str)) else 0, len(body))
+        delay = retry.on_response(response.status, response.headers)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    response.raise_for_status()
+    retry.on_success()
+    return body
+
+
+class PooledAsyncHTTPProvider(AsyncHTTPProvider):
+    """
+    Async HTTP provider that posts every request over one pooled session
+
+    web3's AsyncHTTPProvider opens a new aiohttp session, and so a new
+    connection, per request. This provider keeps one session per instance
+    and bounds the number of requests in flight to ``max_concurrency``.
+    Requests go through the shared rate limiter of ``upstream``.
+    """
+
+    def __init__(self, endpoint_uri: Optional[str] = None,
+                 request_kwargs: Optional[Any] = None,
+                 max_concurrency: int = 32,
+                 upstream: str = 'infura',
+                 max_retries: int = 5) -> None:
+        super().__init__(endpoint_uri, request_kwargs)
+        self.max_concurrency = max_concurrency
+        self.upstream = upstream
+        self.max_retries = max_retries
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def __str__(self) -> str:
+        return 'Pooled async RPC connection {0}'.format(self.endpoint_uri)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created on first use so they bind to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        session = self._get_session()
+        started_at = time.perf_counter()
+        inc('rpc_calls_total', upstream=self.upstream, method=method)
+        try:
+            async with self._semaphore:
+                raw_response = await send_request(self.upstream, session, 'POST', self.endpoint_uri,
+                                                  max_retries=self.max_retries,
+                                                  data=self.encode_rpc_request(method, params),
+                                                  **self.get_request_kwargs())
+            response = self.decode_rpc_response(raw_response)
+        except Exception:
+            inc('rpc_errors_total', upstream=self.upstream, method=method)
+            raise
+        finally:
+            observe('rpc_request_seconds', time.perf_counter() - started_at, upstream=self.upstream, method=method)
+        if 'error' in response:
+            inc('rpc_errors_total', upstream=self.upstream, method=method)
+        return response
+
+    async def close(self) -> None:
+        """
+        Close the pooled session and its connections
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncEthereumClient:
+    """
+    Asyncio counterpart of the ethereum_transactions functions
+
+    JSON-RPC calls share one pooled connection per endpoint and at most
+    ``max_rpc_concurrency`` of them are in flight per endpoint, and each
+    exchange has its own semaphore of ``max_exchange_concurrency``
+    requests, so a single event loop can drive hundreds of wallet and price
+    queries without overrunning any upstream. With several endpoints, calls
+    are balanced, hedged and failed over like RPCPoolProvider does. Use it
+    as an async context manager, or call ``close`` when done.
+    """
+
+    def __init__(self,
+                 endpoints: Union[str, Sequence[Union[str, Dict[str, Any]]], None] = None,
+                 hedge_quantile: float = 0.95,
+                 min_hedge_delay: float = 0.05,
+                 max_rpc_concurrency: int = 32,
+                 max_exchange_concurrency: int = 8,
+                 block_cache: Optional[BlockTimestampCache] = None,
+                 block_index: Optional[BlockTimestampIndex] = None,
+                 chunk_size: int = 2000,
+                 max_chunk_size: int = 100000,
+                 target_results: int = 5000) -> None:
+        if endpoints is None:
+            endpoints = rpc_endpoints(get_client().config)
+        elif isinstance(endpoints, str):
+            endpoints = [endpoints]
+        self.endpoints = []
+        for endpoint in endpoints:
+            if isinstance(endpoint, str):
+                endpoint = {'url': endpoint}
+            upstream = endpoint.get('upstream') or upstream_name(endpoint['url'])
+            # With several endpoints a failing request is failed over instead of retried
+            provider = PooledAsyncHTTPProvider(endpoint['url'], max_concurrency=max_rpc_concurrency,
+                                               upstream=upstream, max_retries=0 if len(endpoints) > 1 else 5)
+            self.endpoints.append(RPCEndpoint(provider, upstream))
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_exchange_concurrency = max_exchange_concurrency
+        self.block_cache = block_cache or BlockTimestampCache()
+        self.block_index = block_index or BlockTimestampIndex()
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_results = target_results
+        self._exchange_sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._exchange_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def __aenter__(self) -> 'AsyncEthereumClient':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Close the RPC and exchange sessions
+        """
+        for endpoint in self.endpoints:
+            await endpoint.provider.close()
+        for session in self._exchange_sessions.values():
+            await session.close()
+        self._exchange_sessions.clear()
+        self._exchange_semaphores.clear()
+
+    async def _timed(self, endpoint: RPCEndpoint, method: str, params: List[Any]) -> Dict[str, Any]:
+        started_at = endpoint.start()
+        try:
+            response = await endpoint.provider.make_request(method, params)
+        except asyncio.CancelledError:
+            endpoint.finish(started_at, ok=None)
+            raise
+        except Exception:
+            endpoint.finish(started_at, ok=False)
+            raise
+        endpoint.finish(started_at, ok=True)
+        return response
+
+    async def _execute(self, method: str, params: List[Any]) -> Dict[str, Any]:
+        plan = HedgedCall(self.endpoints, method not in NON_HEDGED_METHODS,
+                          self.hedge_quantile, self.min_hedge_delay)
+        tasks = {}
+
+        def launch(endpoint: Optional[RPCEndpoint]) -> None:
+            if endpoint is not None:
+                tasks[asyncio.ensure_future(self._timed(endpoint, method, params))] = endpoint
+
+        launch(plan.next_endpoint())
+        try:
+            while tasks:
+                timeout = plan.hedge_delay(list(tasks.values()))
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(plan.on_timeout())
+                    continue
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        launch(plan.on_error(endpoint, e))
+            raise plan.failure()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def rpc(self, method: str, params: Sequence[Any]) -> Any:
+        """
+        Make a JSON-RPC call
+
+        :param method: JSON-RPC method
+        :param params: method parameters
+        :return: raw result of the call
+        """
+        response = await self._execute(method, list(params))
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    async def block_number(self) -> int:
+        """
+        Get the number of the latest block
+
+        :return: block number
+        """
+        return int(await self.rpc('eth_blockNumber', []), 16)
+
+    async def get_block(self, block_identifier: Union[int, str]) -> Dict[str, int]:
+        """
+        Get the number and timestamp of a block
+
+        :param block_identifier: block number or tag such as 'latest'
+        :return: dictionary with 'number' and 'timestamp'
+        """
+        if isinstance(block_identifier, int):
+            block_identifier = hex(block_identifier)
+        block = await self.rpc('eth_getBlockByNumber', [block_identifier, False])
+        return {'number': int(block['number'], 16), 'timestamp': int(block['timestamp'], 16)}
+
+    async def get_header(self, block_identifier: Union[int, str]) -> Dict[str, Any]:
+        """
+        Get the number, hash, parent hash and timestamp of a block
+
+        :param block_identifier: block number, block hash or tag such as 'latest'
+        :return: dictionary with 'number', 'hash', 'parentHash' and 'timestamp'
+        """
+        if isinstance(block_identifier, int):
+            block_identifier = hex(block_identifier)
+        if isinstance(block_identifier, str) and len(block_identifier) == 66:
+            block = await self.rpc('eth_getBlockByHash', [block_identifier, False])
+        else:
+            block = await self.rpc('eth_getBlockByNumber', [block_identifier, False])
+        return {
+            'number': int(block['number'], 16),
+            'hash': block['hash'],
+            'parentHash': block['parentHash'],
+            'timestamp': int(block['timestamp'], 16),
+        }
+
+    async def get_block_timestamps(self, block_numbers: Sequence[int]) -> Dict[int, int]:
+        """
+        Get the timestamps of several blocks through the shared block cache
+
+        :param block_numbers: numbers of the blocks, duplicates allowed
+        :return: dictionary mapping block numbers to timestamps
+        """
+        timestamps, missing = self.block_cache.lookup(block_numbers)
+        blocks = await asyncio.gather(*(self.get_block(number) for number in missing))
+        fetched = {block['number']: block['timestamp'] for block in blocks}
+        self.block_cache.update(fetched)
+        timestamps.update(fetched)
+        return timestamps
+
+    async def get_logs(self, address: Union[str, List[str]], topics: Sequence[Any],
+                       from_block: int = 0, to_block: Union[int, str] = 'latest',
+                       max_chunks: int = 8) -> AsyncIterator[List[Dict]]:
+        """
+        Scan a block range for logs in adaptive chunks fetched concurrently
+
+        Chunks are planned by the ChunkPlanner of log_scanner.scan_logs, so
+        they are split and shrink when the node rejects a range for
+        returning too many results and grow again on sparse chunks, and at
+        most ``2 * max_chunks`` chunks are held in memory at any time.
+
+        :param address: contract address or list of contract addresses
+        :param topics: eth_getLogs topic filter
+        :param from_block: first block of the range
+        :param to_block: last block of the range, or 'latest'
+        :param max_chunks: number of chunks fetched concurrently
+        :return: async generator of log chunks in block order, each in (block number, log index) order
+        """
+        if to_block == 'latest':
+            to_block = await self.block_number()
+        planner = ChunkPlanner(from_block, to_block, max_chunks, self.chunk_size,
+                               max_chunk_size=self.max_chunk_size, target_results=self.target_results)
+        pending: Dict[asyncio.Task, Tuple[int, int]] = {}
+
+        def submit(start: int, end: int) -> None:
+            task = asyncio.ensure_future(self.rpc('eth_getLogs', [{
+                'address': address,
+                'topics': list(topics),
+                'fromBlock': hex(start),
+                'toBlock': hex(end),
+            }]))
+            pending[task] = (start, end)
+
+        try:
+            while not planner.done:
+                for start, end in planner.next_chunks(len(pending)):
+                    submit(start, end)
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    start, end = pending.pop(task)
+                    try:
+                        chunk = task.result()
+                    except ValueError as e:
+                        for start, end in planner.split(start, end, e):
+                            submit(start, end)
+                        continue
+                    planner.add(start, end, [format_log(log) for log in chunk])
+                for logs in planner.pop_ready():
+                    yield logs
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _collect_logs(self, address: Union[str, List[str]], topics: Sequence[Any],
+                            from_block: int, to_block: int) -> List[Dict]:
+        return [log async for logs in self.get_logs(address, topics, from_block, to_block) for log in logs]
+
+    async def decode_transfers(self, logs: List[Dict], include_tx: bool = False) -> List[Dict[str, Any]]:
+        """
+        Decode Transfer logs and attach block timestamps and optionally transaction fields
+
+        :param logs: raw Transfer log entries
+        :param include_tx: also fetch the transaction of each transfer
+        :return: decoded transfers with a 'timestamp' field
+        """
+        transfers = [transfer for transfer in map(decode_transfer_log, logs) if transfer is not None]
+        timestamps = await self.get_block_timestamps([transfer['block_number'] for transfer in transfers])
+        for transfer in transfers:
+            transfer['timestamp'] = timestamps[transfer['block_number']]
+        if include_tx:
+            tx_hashes = list({transfer['tx_hash'] for transfer in transfers})
+            results = await asyncio.gather(*(self.rpc('eth_getTransactionByHash', [tx_hash])
+                                             for tx_hash in tx_hashes))
+            transactions = dict(zip(tx_hashes, results))
+            for transfer in transfers:
+                tx = transactions[transfer['tx_hash']]
+                transfer['tx_sender'] = Web3.toChecksumAddress(tx['from'])
+                transfer['tx_recipient'] = tx['to'] and Web3.toChecksumAddress(tx['to'])
+                transfer['tx_input'] = tx['input']
+        return transfers
+
+    async def get_block_range(self, start_date: datetime, end_date: datetime) -> Tuple[int, int]:
+        """
+        Find the first and last block mined between two UTC dates
+
+        :param start_date: naive UTC datetime the window starts at, inclusive
+        :param end_date: naive UTC datetime the window ends at, inclusive
+        :return: (first block, last block)
+        """
+        start = int((start_date - datetime(1970, 1, 1)).total_seconds())
+        end = int((end_date - datetime(1970, 1, 1)).total_seconds())
+        from_block, next_block = await asyncio.gather(
+            self.block_index.async_block_at(self.get_block, start),
+            self.block_index.async_block_at(self.get_block, end + 1))
+        return from_block, next_block - 1
+
+    def _exchange(self, exchange: str) -> Tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+        session = self._exchange_sessions.get(exchange)
+        if session is None or session.closed:
+            session = self._exchange_sessions[exchange] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_exchange_concurrency),
+                timeout=_client_timeout(exchange),
+            )
+            self._exchange_semaphores[exchange] = asyncio.Semaphore(self.max_exchange_concurrency)
+        return session, self._exchange_semaphores[exchange]
+
+    async def fetch_token_price(self, token_address: str, exchange: str) -> float:
+        """
+        Fetch the spot price of a token from an exchange, bypassing the price cache
+
+        :param token_address: token to quote
+        :param exchange: 'uniswap', 'binance' or 'bybit'
+        :return: token price
+        """
+        method, url, options = spot_price_request(token_address, exchange)
+        session, semaphore = self._exchange(exchange)
+        async with semaphore:
+            body = await send_request(exchange, session, method, url, **options)
+        return parse_spot_price(json.loads(body), exchange)
+
+    @traced()
+    async def get_token_price(self, token_address: str, exchange: str, use_cache: bool = True) -> float:
+        """
+        Get the spot price of a token from an exchange
+
+        Prices are cached in the PRICE_CACHE shared with get_token_price of
+        ethereum_transactions, and concurrent lookups of the same price,
+        from this loop or from other threads, share one request.
+
+        :param token_address: token to quote
+        :param exchange: 'uniswap', 'binance' or 'bybit'
+        :param use_cache: use the price cache
+        :return: token price
+        """
+        if exchange not in EXCHANGES:
+            raise ValueError('Invalid exchange provided')
+        if not use_cache:
+            return await self.fetch_token_price(token_address, exchange)
+        price, future, owner = PRICE_CACHE.lookup(token_address, exchange)
+        if future is None:
+            return price
+        if not owner:
+            # Shielded, so a cancelled waiter does not cancel the fetch shared with the others
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            price = await self.fetch_token_price(token_address, exchange)
+        except BaseException as e:
+            PRICE_CACHE.fail(token_address, exchange, e)
+            raise
+        PRICE_CACHE.put(token_address, exchange, price)
+        return price
+
+    @traced()
+    async def get_wallets_historic_transactions(self, wallet_addresses: List[str], num_days: int = 30,
+                                                include_tx: bool = False, as_table: bool = False
+                                                ) -> Union[Dict[str, Dict[str, List[Dict]]], TransferTable]:
+        """
+        Get the transaction history of many wallets over all tokens
+
+        :param wallet_addresses: wallets to follow
+        :param num_days: number of days of history
+        :param include_tx: also fetch the transaction of each transfer
+        :param as_table: return one TransferTable for all wallets instead of records
+        :return: dictionary mapping each wallet to its 'incoming' and 'outgoing' records, or a TransferTable
+        """
+        end_date = datetime.utcnow()
+        from_block, to_block = await self.get_block_range(end_date - timedelta(days=num_days), end_date)
+        scans = await asyncio.gather(*(self._collect_logs(TOKEN_ADDRESSES, topics, from_block, to_block)
+                                       for topics in wallet_topic_filters(wallet_addresses)))
+        transfers = await self.decode_transfers(list(merge_logs(scans)), include_tx)
+        if as_table:
+            return TransferTable.from_transfers(transfers)
+        history = split_by_wallet(transfers, wallet_addresses)
+        return {
+            wallet_address: {
+                direction: [transaction_record(transfer, direction, include_tx) for transfer in wallet_transfers]
+                for direction, wallet_transfers in wallet_history.items()
+            }
+            for wallet_address, wallet_history in history.items()
+        }
+
+    @traced()
+    async def get_historic_transactions(self, wallet_address: str, num_days: int = 30,
+                                        include_tx: bool = False, as_table: bool = False
+                                        ) -> Union[Dict[str, List[Dict]], TransferTable]:
+        """
+        Get the transaction history of a wallet over all tokens
+
+        :param wallet_address: wallet to follow
+        :param num_days: number of days of history
+        :param include_tx: also fetch the transaction of each transfer
+        :param as_table: return a TransferTable instead of records
+        :return: dictionary of 'incoming' and 'outgoing' records, or a TransferTable
+        """
+        if as_table:
+            return await self.get_wallets_historic_transactions([wallet_address], num_days, as_table=True)
+        history = await self.get_wallets_historic_transactions([wallet_address], num_days, include_tx)
+        return history[wallet_address]
+
+    @traced()
+    async def get_token_transactions(self, token_address: str, from_block: int = 0,
+                                     to_block: Union[int, str] = 'latest', include_tx: bool = False,
+                                     as_table: bool = False) -> Union[List[Dict[str, Any]], TransferTable]:
+        """
+        Get all transfers of a token
+
+        :param token_address: token contract address
+        :param from_block: first block to scan
+        :param to_block: last block to scan, or 'latest'
+        :param include_tx: also fetch the transaction of each transfer
+        :param as_table: return a TransferTable instead of dictionaries
+        :return: decoded transfers in block order, or a TransferTable
+        """
+        transfers = []
+        async for logs in self.get_logs(Web3.toChecksumAddress(token_address), [TRANSFER_TOPIC],
+                                        from_block, to_block):
+            transfers.extend(await self.decode_transfers(logs, include_tx and not as_table))
+        if as_table:
+            return TransferTable.from_transfers(transfers)
+        return transfers
+
+    async def sync_token_transfers(self, store: ChainStore, token_address: str, start_block: int = 0,
+                                   to_block: Optional[int] = None) -> int:
+        """
+        Bring the stored Transfer events of a token up to date
+
+        Follows the same sync plan as chain_store.sync_token_transfers, so
+        stores synced by either client can be extended by the other.
+
+        :param store: store to update
+        :param token_address: token contract address
+        :param start_block: first block the store should cover
+        :param to_block: block to sync up to, defaults to the latest block
+        :return: last block covered by the store
+        """
+        token_address = Web3.toChecksumAddress(token_address)
+        if to_block is None:
+            to_block = await self.block_number()
+        for from_block, end_block in sync_plan(store, token_address, start_block, to_block):
+            async for logs in self.get_logs(token_address, [TRANSFER_TOPIC], from_block, end_block):
+                transfers = await self.decode_transfers(logs)
+                store.add_transfers(transfers)
+                store.add_block_timestamps({transfer['block_number']: transfer['timestamp']
+                                            for transfer in transfers})
+        return max(to_block, store.get_synced_range(token_address)[1])
+
+    @traced()
+    async def get_top_token_holders(self, token_address: str, num_holders: int = 20,
+                                    store: Optional[ChainStore] = None,
+                                    start_block: int = 0) -> List[Tuple[str, float]]:
+        """
+        Get the top holders of a token
+
+        The token's Transfer events are synced into the chain store and
+        folded into the HolderIndex shared with the synchronous client, so
+        later calls only scan and fold the blocks added since the previous one.
+
+        :param token_address: token contract address
+        :param num_holders: number of holders to return
+        :param store: chain store to sync into, defaults to the shared store
+        :param start_block: block the token was deployed at
+        :return: list of (address, balance) tuples, largest first
+        """
+        token_address = Web3.toChecksumAddress(token_address)
+        if store is None:
+            store = get_default_store()
+        await self.sync_token_transfers(store, token_address, start_block)
+        index = HOLDER_INDEXES.get((store.path, token_address))
+        if index is None:
+            index = HOLDER_INDEXES[(store.path, token_address)] = HolderIndex(token_address)
+        index.update_from_store(store, history_start=start_block)
+        return [(address, balance / (10 ** 18)) for address, balance in index.top(num_holders)]
@@ -0,0 +1,207 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from chain_store import StoreFold
+from holder_index import ZERO_ADDRESS
+
+
+class BalanceHistory(StoreFold):
+    """
+    Token balances of every address at any block, folded from Transfer events
+
+    Every address has a slot and a delta log: the blocks its balance changed
+    in and its running balance after each of them, so the balance at a block
+    is a binary search. Checkpoints record the slots holding a positive
+    balance as a compact array, so the balances of every holder at a block
+    are the closest checkpoint's holders plus the few addresses changed
+    since, each looked up in its delta log. A checkpoint is taken once the
+    changes since the previous one reach ``checkpoint_ratio`` times the
+    number of holders, so checkpoints take about as much memory as the
+    delta logs whatever the holder count, and a snapshot never has to look
+    up more than about twice the holders of its block.
+
+    Block timestamps are kept for the blocks with transfers, so dates are
+    turned into blocks without any request: balances only change in those
+    blocks.
+    """
+
+    def __init__(self, token_address: Optional[str] = None, checkpoint_ratio: float = 1.0,
+                 min_checkpoint_changes: int = 1000) -> None:
+        self.checkpoint_ratio = checkpoint_ratio
+        self.min_checkpoint_changes = min_checkpoint_changes
+        super().__init__(token_address)
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._last_block = -1
+        self._slots: Dict[str, int] = {}
+        self._addresses: List[str] = []
+        self._current: List[int] = []
+        self._holders = 0
+        self._change_blocks: List[List[int]] = []
+        self._change_balances: List[List[int]] = []
+        # Every (block, slot) change in block order, to find the addresses changed since a checkpoint
+        self._changed_blocks = array('q')
+        self._changed_slots = array('q')
+        self._block_numbers: List[int] = []
+        self._timestamps: List[int] = []
+        self._checkpoints: List[int] = []
+        self._snapshots: List[array] = []
+        self._checkpoint_changes = 0
+
+    def __len__(self) -> int:
+        """
+        Number of addresses whose balance ever changed
+        """
+        return len(self._addresses)
+
+    def _checkpoint(self) -> None:
+        self._checkpoints.append(self._last_block)
+        self._snapshots.append(array('q', (slot for slot, balance in enumerate(self._current) if balance > 0)))
+        self._checkpoint_changes = len(self._changed_slots)
+
+    def _record(self, address: str, block_number: int, delta: int) -> None:
+        slot = self._slots.get(address)
+        if slot is None:
+            slot = self._slots[address] = len(self._addresses)
+            self._addresses.append(address)
+            self._current.append(0)
+            self._change_blocks.append([])
+            self._change_balances.append([])
+        before = self._current[slot]
+        balance = self._current[slot] = before + delta
+        self._holders += (balance > 0) - (before > 0)
+        blocks = self._change_blocks[slot]
+        if blocks and blocks[-1] == block_number:
+            self._change_balances[slot][-1] = balance
+        else:
+            blocks.append(block_number)
+            self._change_balances[slot].append(balance)
+            self._changed_blocks.append(block_number)
+            self._changed_slots.append(slot)
+
+    def apply(self, transfers: Iterable[Dict[str, Any]]) -> int:
+        """
+        Fold decoded transfers into the balance history
+
+        :param transfers: decoded transfers in block order, past every folded block
+        :return: number of transfers folded
+        """
+        count = 0
+        for transfer in transfers:
+            block_number = transfer['block_number']
+            new_block = block_number != self._last_block
+            if block_number < self._last_block or (new_block and block_number <= self.block_number):
+                raise ValueError(f'Transfer of block {block_number} is older than the folded history')
+            if new_block:
+                # Balances at the end of the last block, once enough changed since the last checkpoint
+                changes = len(self._changed_slots) - self._checkpoint_changes
+                if changes >= max(self.checkpoint_ratio * self._holders, self.min_checkpoint_changes):
+                    self._checkpoint()
+                self._last_block = block_number
+                if transfer.get('timestamp') is not None:
+                    self._block_numbers.append(block_number)
+                    self._timestamps.append(transfer['timestamp'])
+            value = transfer['value']
+            if transfer['from'] != ZERO_ADDRESS:
+                self._record(transfer['from'], block_number, -value)
+            if transfer['to'] != ZERO_ADDRESS:
+                self._record(transfer['to'], block_number, value)
+            count += 1
+        if self._last_block > self.block_number:
+            self.block_number = self._last_block
+        return count
+
+    def _check_block(self, block_number: int) -> None:
+        if block_number > self.block_number:
+            raise ValueError(f'Block {block_number} is past the folded history, which ends at {self.block_number}')
+
+    def _balance_at(self, slot: int, block_number: int) -> int:
+        i = bisect_right(self._change_blocks[slot], block_number) - 1
+        return self._change_balances[slot][i] if i >= 0 else 0
+
+    def balance_at(self, address: str, block_number: int) -> int:
+        """
+        Get the balance of an address at the end of a block
+
+        :param address: checksummed address
+        :param block_number: block number, at most the last folded block
+        :return: raw integer balance
+        """
+        self._check_block(block_number)
+        slot = self._slots.get(address)
+        return 0 if slot is None else self._balance_at(slot, block_number)
+
+    def balances_at(self, addresses: Iterable[str], block_number: int) -> Dict[str, int]:
+        """
+        Get the balances of several addresses at the end of a block
+
+        :param addresses: checksummed addresses
+        :param block_number: block number, at most the last folded block
+        :return: dictionary mapping each address to its raw integer balance
+        """
+        return {address: self.balance_at(address, block_number) for address in addresses}
+
+    def history(self, address: str, from_block: int = 0, to_block: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Get the balance changes of an address over a block range
+
+        :param address: checksummed address
+        :param from_block: first block of the range
+        :param to_block: last block of the range, the last folded block by default
+        :return: (block number, balance) pairs, starting with the balance at from_block
+        """
+        to_block = self.block_number if to_block is None else to_block
+        self._check_block(to_block)
+        slot = self._slots.get(address)
+        blocks = self._change_blocks[slot] if slot is not None else []
+        balances = self._change_balances[slot] if slot is not None else []
+        start = bisect_right(blocks, from_block)
+        end = bisect_right(blocks, to_block)
+        changes = [(from_block, balances[start - 1] if start else 0)]
+        changes.extend(zip(blocks[start:end], balances[start:end]))
+        return changes
+
+    def snapshot(self, block_number: int) -> Dict[str, int]:
+        """
+        Get the positive balances of every address at the end of a block
+
+        :param block_number: block number, at most the last folded block
+        :return: dictionary mapping addresses to raw integer balances
+        """
+        self._check_block(block_number)
+        i = bisect_right(self._checkpoints, block_number) - 1
+        if i >= 0:
+            slots = set(self._snapshots[i])
+            since = self._checkpoints[i] + 1
+        else:
+            slots = set()
+            since = 0
+        start = bisect_left(self._changed_blocks, since)
+        end = bisect_right(self._changed_blocks, block_number)
+        slots.update(self._changed_slots[start:end])
+        balances = {}
+        for slot in slots:
+            balance = self._balance_at(slot, block_number)
+            if balance > 0:
+                balances[self._addresses[slot]] = balance
+        return balances
+
+    def block_at(self, timestamp: int) -> int:
+        """
+        Get the last block with transfers mined at or before a time
+
+        Balances only change in blocks with transfers, so the balances at
+        this block are the balances at that time. Times past the folded
+        history give its last block.
+
+        :param timestamp: unix timestamp
+        :return: block number, -1 when the time is before the first transfer
+        """
+        i = bisect_right(self._timestamps, timestamp) - 1
+        if i < 0:
+            return -1
+        if i == len(self._timestamps) - 1:
+            return self.block_number
+        return self._block_numbers[i]
@@ -0,0 +1,198 @@
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import requests
+from web3 import HTTPProvider
+from web3._utils.encoding import Web3JsonEncoder
+
+from metrics import inc, observe, record_http_request
+from rate_limiter import RetryPolicy
+
+
+class BatchHTTPProvider(HTTPProvider):
+    """
+    HTTP provider that coalesces concurrent requests into JSON-RPC batches
+
+    Requests made from any thread are queued and sent together as one
+    JSON-RPC batch array once ``max_batch_size`` requests are waiting or
+    ``flush_interval`` seconds have passed since the oldest one was queued.
+    Responses are matched back to their callers by request id, so each
+    caller still sees a plain single-request provider. Posts go through the
+    shared rate limiter of ``upstream`` and throttled or failed posts are
+    retried up to ``max_retries`` times with backoff. Calls, errors and
+    latencies are recorded in the metrics per JSON-RPC method.
+    """
+
+    # Seconds the background flusher thread waits for work before exiting
+    idle_timeout = 5.0
+
+    def __init__(self,
+                 endpoint_uri: Optional[str] = None,
+                 request_kwargs: Optional[Dict[str, Any]] = None,
+                 session: Optional[requests.Session] = None,
+                 max_batch_size: int = 100,
+                 flush_interval: float = 0.005,
+                 upstream: str = 'infura',
+                 max_retries: int = 5) -> None:
+        super().__init__(endpoint_uri, request_kwargs, session)
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.upstream = upstream
+        self.max_retries = max_retries
+        self._session = session or requests.Session()
+        self._ids = itertools.count()
+        self._queue: List[Tuple[Dict[str, Any], Future]] = []
+        self._queued_at = 0.0
+        self._condition = threading.Condition()
+        self._flusher: Optional[threading.Thread] = None
+
+    def __str__(self) -> str:
+        return 'Batched RPC connection {0}'.format(self.endpoint_uri)
+
+    def _payload(self, method: str, params: Any) -> Dict[str, Any]:
+        return {'jsonrpc': '2.0', 'method': method, 'params': params or [], 'id': next(self._ids)}
+
+    def _post(self, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', 30)
+        data = json.dumps(payloads, cls=Web3JsonEncoder)
+        # Nodes meter every call in a batch, not every HTTP request
+        retry = RetryPolicy(self.upstream, self.max_retries, tokens=len(payloads))
+        while True:
+            time.sleep(retry.reserve())
+            started_at = time.perf_counter()
+            try:
+                response = self._session.post(self.endpoint_uri, data=data, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                record_http_request(self.upstream, type(e).__name__, time.perf_counter() - started_at, 0, 0)
+                delay = retry.on_error(e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            record_http_request(self.upstream, response.status_code, time.perf_counter() - started_at,
+                                len(data), len(response.content))
+            delay = retry.on_response(response.status_code, response.headers)
+            if delay is None:
+                break
+            time.sleep(delay)
+        response.raise_for_status()
+        retry.on_success()
+        return response.json()
+
+    def _send(self, payloads: List[Dict[str, Any]]) -> List[Union[Dict[str, Any], Exception]]:
+        inc('rpc_batches_total', upstream=self.upstream)
+        try:
+            responses = self._post(payloads)
+        except Exception as e:
+            results = [e] * len(payloads)
+        else:
+            if isinstance(responses, dict):
+                # Some nodes answer a whole batch with a single error object
+                results = [dict(responses, id=payload['id']) for payload in payloads]
+            else:
+                by_id = {response.get('id'): response for response in responses}
+                results = [
+                    by_id.get(payload['id'], {
+                        'jsonrpc': '2.0',
+                        'id': payload['id'],
+                        'error': {'code': -32603, 'message': 'missing response in batch'},
+                    })
+                    for payload in payloads
+                ]
+        for payload, result in zip(payloads, results):
+            inc('rpc_calls_total', upstream=self.upstream, method=payload['method'])
+            if isinstance(result, Exception) or 'error' in result:
+                inc('rpc_errors_total', upstream=self.upstream, method=payload['method'])
+        return results
+
+    def _flush(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        results = self._send([payload for payload, _ in batch])
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _take_batch(self) -> List[Tuple[Dict[str, Any], Future]]:
+        batch = self._queue[:self.max_batch_size]
+        del self._queue[:self.max_batch_size]
+        self._queued_at = time.monotonic()
+        return batch
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue:
+                    if not self._condition.wait(self.idle_timeout):
+                        # Let idle providers be garbage collected with no thread left behind
+                        self._flusher = None
+                        return
+                remaining = self._queued_at + self.flush_interval - time.monotonic()
+                if remaining > 0 and len(self._queue) < self.max_batch_size:
+                    self._condition.wait(remaining)
+                    continue
+                batch = self._take_batch()
+            # Post each batch on its own thread so one slow response does not hold up the next batches
+            threading.Thread(target=self._flush, args=(batch,), daemon=True).start()
+
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        started_at = time.perf_counter()
+        future: Future = Future()
+        batch = None
+        with self._condition:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, daemon=True)
+                self._flusher.start()
+            if not self._queue:
+                self._queued_at = time.monotonic()
+            self._queue.append((self._payload(method, params), future))
+            if len(self._queue) >= self.max_batch_size:
+                batch = self._take_batch()
+            else:
+                self._condition.notify()
+        if batch:
+            self._flush(batch)
+        try:
+            return future.result()
+        finally:
+            observe('rpc_request_seconds', time.perf_counter() - started_at, upstream=self.upstream, method=method)
+
+    def make_batch_request(self, calls: Sequence[Tuple[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send several requests at once, split into batches of max_batch_size
+
+        Unlike make_request this bypasses the web3 middleware stack, so the
+        results are raw JSON-RPC responses.
+
+        :param calls: (method, params) pairs
+        :return: raw JSON-RPC responses in the order of the calls
+        """
+        responses = []
+        for start in range(0, len(calls), self.max_batch_size):
+            payloads = [self._payload(method, params)
+                        for method, params in calls[start:start + self.max_batch_size]]
+            for result in self._send(payloads):
+                if isinstance(result, Exception):
+                    raise result
+                responses.append(result)
+        return responses
+
+
+def batch_results(responses: List[Dict[str, Any]]) -> List[Any]:
+    """
+    Extract the results of raw batch responses, raising on the first error
+
+    :param responses: raw JSON-RPC responses from make_batch_request
+    :return: list of results
+    """
+    results = []
+    for response in responses:
+        if 'error' in response:
+            raise ValueError(response['error'])
+        results.append(response['result'])
+    return results
@@ -0,0 +1,150 @@
+import json
+import os
+import random
+from typing import Any, Dict, List, Optional
+
+from web3 import Web3
+
+from ethereum_transactions import TOKEN_ADDRESSES
+from log_scanner import TRANSFER_TOPIC, address_topic, scan_logs
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+def wallet_address(i: int) -> str:
+    """
+    Get the address of the i-th synthetic wallet
+
+    :param i: wallet number, from 1
+    :return: checksummed address
+    """
+    return Web3.toChecksumAddress('0x' + format(0xbe00000000000000000000000000000000000000 + i, '040x'))
+
+
+def block_hash(block_number: int) -> str:
+    """
+    Get the hash the stand-in node gives a block
+
+    :param block_number: block number
+    :return: hex encoded block hash
+    """
+    return '0x' + format(block_number + 1, '064x')
+
+
+def synthetic_fixture(num_transfers: int = 50000,
+                      num_blocks: int = 300000,
+                      num_wallets: int = 1000,
+                      token_addresses: Optional[List[str]] = None,
+                      block_time: int = 12,
+                      seed: int = 1) -> Dict[str, Any]:
+    """
+    Generate a chain of random Transfer events
+
+    Wallet activity follows a power law, so a few wallets take part in most
+    of the transfers like on mainnet, and the first transfer of each token
+    mints its supply to the first wallet.
+
+    :param num_transfers: number of Transfer logs
+    :param num_blocks: number of blocks, the head is num_blocks - 1
+    :param num_wallets: number of distinct wallets
+    :param token_addresses: tokens the transfers are spread over, TOKEN_ADDRESSES by default
+    :param block_time: seconds between blocks
+    :param seed: random seed
+    :return: fixture with 'head', 'block_time' and raw JSON-RPC 'logs' in block order
+    """
+    rng = random.Random(seed)
+    token_addresses = [Web3.toChecksumAddress(token) for token in token_addresses or TOKEN_ADDRESSES]
+    wallets = [wallet_address(i) for i in range(1, num_wallets + 1)]
+    weights = [1.0 / i for i in range(1, num_wallets + 1)]
+    blocks = sorted(rng.randrange(1, num_blocks) for _ in range(num_transfers))
+    logs = []
+    log_index = 0
+    for n, block_number in enumerate(blocks):
+        log_index = log_index + 1 if n and blocks[n - 1] == block_number else 0
+        token = token_addresses[n % len(token_addresses)]
+        if n < len(token_addresses):
+            sender, recipient, value = ZERO_ADDRESS, wallets[0], 10 ** 27
+        else:
+            sender, recipient = rng.choices(wallets, weights, k=2)
+            value = rng.randrange(1, 10 ** 21)
+        logs.append({
+            'address': token,
+            'topics': [TRANSFER_TOPIC, address_topic(sender), address_topic(recipient)],
+            'data': '0x' + format(value, '064x'),
+            'blockNumber': hex(block_number),
+            'blockHash': block_hash(block_number),
+            'logIndex': hex(log_index),
+            'transactionIndex': hex(log_index),
+            'transactionHash': '0x' + format(rng.getrandbits(256), '064x'),
+            'removed': False,
+        })
+    return {'head': num_blocks - 1, 'block_time': block_time, 'logs': logs}
+
+
+def _json_log(log: Dict[str, Any]) -> Dict[str, Any]:
+    def hex_value(value):
+        if isinstance(value, int):
+            return hex(value)
+        if isinstance(value, (bytes, bytearray)):
+            return '0x' + bytes(value).hex()
+        return value
+    return {
+        'address': log['address'],
+        'topics': [hex_value(topic) for topic in log['topics']],
+        'data': hex_value(log['data']),
+        'blockNumber': hex_value(log['blockNumber']),
+        'blockHash': hex_value(log['blockHash']),
+        'logIndex': hex_value(log['logIndex']),
+        'transactionIndex': hex_value(log['transactionIndex']),
+        'transactionHash': hex_value(log['transactionHash']),
+        'removed': False,
+    }
+
+
+def record_fixture(w3: Web3, token_addresses: List[str], from_block: int, to_block: int,
+                   block_time: int = 12) -> Dict[str, Any]:
+    """
+    Record the Transfer logs of a real block range as a fixture
+
+    Blocks are renumbered from 0 so the fixture replays the same shape of
+    traffic against the stand-in node, whose timestamps end at the time it
+    starts.
+
+    :param w3: Web3 instance of the chain to record
+    :param token_addresses: tokens to record
+    :param from_block: first block of the range
+    :param to_block: last block of the range
+    :param block_time: seconds between blocks on replay
+    :return: fixture with 'head', 'block_time' and raw JSON-RPC 'logs' in block order
+    """
+    token_addresses = [Web3.toChecksumAddress(token) for token in token_addresses]
+    logs = []
+    for log in scan_logs(w3, token_addresses, [TRANSFER_TOPIC], from_block, to_block):
+        log = _json_log(log)
+        block_number = int(log['blockNumber'], 16) - from_block
+        log['blockNumber'] = hex(block_number)
+        log['blockHash'] = block_hash(block_number)
+        logs.append(log)
+    return {'head': to_block - from_block, 'block_time': block_time, 'logs': logs}
+
+
+def save_fixture(fixture: Dict[str, Any], path: str) -> None:
+    """
+    Write a fixture to a JSON file
+
+    :param fixture: fixture from synthetic_fixture or record_fixture
+    :param path: file to write
+    """
+    with open(path, 'w') as f:
+        json.dump(fixture, f)
+
+
+def load_fixture(path: str) -> Dict[str, Any]:
+    """
+    Read a fixture from a JSON file
+
+    :param path: file written by save_fixture
+    :return: fixture
+    """
+    with open(os.path.expanduser(path)) as f:
+        return json.load(f)
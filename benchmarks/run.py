@@ -0,0 +1,338 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+from web3 import Web3
+
+import ethereum_transactions
+import token_transactions
+from benchmarks.fixtures import load_fixture, record_fixture, save_fixture, synthetic_fixture
+from benchmarks.stub_server import StubServer
+from chain_store import ChainStore
+from client import EthereumClient, set_client
+from ethereum_transactions import EXCHANGES, TOKEN_ADDRESSES
+from http_client import close_sessions
+from price_service import get_price_quotes
+from rate_limiter import configure_rate_limits
+from rpc_pool import RPCPoolProvider
+from transfers import BlockTimestampCache
+
+# Rate limiter name of the stand-in node
+STUB_UPSTREAM = 'stub'
+
+
+class Context:
+    """
+    What the scenarios run against: the fixture, the token and wallet to query and a scratch directory
+    """
+
+    def __init__(self, fixture: Dict[str, Any], token_address: str, wallet_address: str,
+                 num_days: int, warm: bool, work_dir: str) -> None:
+        self.fixture = fixture
+        self.token_address = token_address
+        self.wallet_address = wallet_address
+        self.num_days = num_days
+        self.warm = warm
+        self.work_dir = work_dir
+        self.store: Optional[ChainStore] = None
+        self._stores = 0
+
+    def chain_store(self) -> ChainStore:
+        # A fresh store per run unless warm, so cold runs sync the whole range again
+        if self.store is None or not self.warm:
+            if self.store is not None:
+                self.store.close()
+            self._stores += 1
+            self.store = ChainStore(os.path.join(self.work_dir, f'chain_data_{self._stores}.sqlite3'))
+        return self.store
+
+
+def _token_transactions(context: Context) -> int:
+    return len(token_transactions.get_token_transactions(context.token_address, 0, context.fixture['head']))
+
+
+def _historic_transactions(context: Context) -> int:
+    history = ethereum_transactions.get_historic_transactions(context.wallet_address, context.num_days)
+    return sum(len(transactions) for transactions in history.values())
+
+
+def _top_token_holders(context: Context) -> int:
+    return len(ethereum_transactions.get_top_token_holders(context.token_address, 20, context.chain_store()))
+
+
+def _spot_prices(context: Context) -> int:
+    quotes = get_price_quotes()
+    errors = quotes['error'].dropna()
+    if len(errors):
+        raise RuntimeError(errors.iloc[0])
+    return len(quotes)
+
+
+def _historical_prices(context: Context) -> int:
+    points = 0
+    for exchange in EXCHANGES:
+        resolution = '1d' if exchange == 'uniswap' else '1h'
+        points += len(ethereum_transactions.get_historical_token_prices(
+            context.token_address, context.num_days, exchange, resolution))
+    return points
+
+
+# Scenarios by name, each returning the number of items it produced
+SCENARIOS: Dict[str, Callable[[Context], int]] = {
+    'token_transactions': _token_transactions,
+    'historic_transactions': _historic_transactions,
+    'top_token_holders': _top_token_holders,
+    'spot_prices': _spot_prices,
+    'historical_prices': _historical_prices,
+}
+
+
+def reset_caches() -> None:
+    """
+    Empty the module level caches, so the next call pays for every request again
+    """
+    ethereum_transactions.BLOCK_TIMESTAMPS = BlockTimestampCache()
+    ethereum_transactions.PRICE_CACHE.invalidate()
+    ethereum_transactions.BLOCK_INDEXES.clear()
+    ethereum_transactions.HOLDER_INDEXES.clear()
+    ethereum_transactions.BALANCE_HISTORIES.clear()
+    token_transactions.block_timestamps = BlockTimestampCache()
+
+
+def busiest_wallet(fixture: Dict[str, Any]) -> str:
+    """
+    Get the wallet taking part in the most transfers of a fixture
+
+    :param fixture: fixture from synthetic_fixture or record_fixture
+    :return: checksummed address
+    """
+    counts: Counter = Counter()
+    for log in fixture['logs']:
+        for topic in log['topics'][1:3]:
+            counts[topic] += 1
+    for topic, _ in counts.most_common():
+        address = Web3.toChecksumAddress('0x' + topic[-40:])
+        if int(address, 16):
+            return address
+    raise ValueError('The fixture has no transfers')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Get a percentile by the nearest rank method
+
+    :param values: samples
+    :param q: percentile between 0 and 100
+    :return: sample at the percentile
+    """
+    values = sorted(values)
+    rank = max(1, -(-len(values) * q // 100))
+    return values[int(rank) - 1]
+
+
+def run_scenario(name: str, context: Context, server: StubServer, iterations: int,
+                 measure_memory: bool = True) -> Dict[str, Any]:
+    """
+    Time a scenario against the stand-in server
+
+    Each of the ``iterations`` runs starts from empty caches unless the
+    context is warm. Peak memory is measured in one extra run under
+    tracemalloc, which would otherwise slow the timed runs down.
+
+    :param name: scenario from SCENARIOS
+    :param context: fixture and query parameters
+    :param server: running stand-in server
+    :param iterations: number of timed runs
+    :param measure_memory: also measure the peak memory of a run
+    :return: dictionary of results
+    """
+    scenario = SCENARIOS[name]
+    durations = []
+    items = 0
+    counts: Counter = Counter()
+    bytes_sent = 0
+    if context.warm:
+        scenario(context)
+    for _ in range(iterations):
+        if not context.warm:
+            reset_caches()
+        server.reset_counts()
+        started_at = time.perf_counter()
+        items = scenario(context)
+        durations.append(time.perf_counter() - started_at)
+        counts.update(server.counts)
+        bytes_sent += server.bytes_sent
+    peak_memory = None
+    if measure_memory:
+        if not context.warm:
+            reset_caches()
+        tracemalloc.start()
+        try:
+            scenario(context)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    http_requests = sum(count for key, count in counts.items() if key.startswith('http:'))
+    errors = sum(count for key, count in counts.items() if key.startswith('errors:'))
+    rpc_calls = sum(count for key, count in counts.items() if ':' not in key)
+    p50 = statistics.median(durations)
+    return {
+        'scenario': name,
+        'iterations': iterations,
+        'items': items,
+        'throughput': items / p50 if p50 else None,
+        'rpc_calls': rpc_calls / iterations,
+        'http_requests': http_requests / iterations,
+        'errors': errors / iterations,
+        'bytes': bytes_sent / iterations,
+        'p50': p50,
+        'p99': percentile(durations, 99),
+        'peak_memory': peak_memory,
+        'rpc_methods': {key: count / iterations for key, count in sorted(counts.items()) if ':' not in key},
+    }
+
+
+def print_results(results: List[Dict[str, Any]], file=sys.stdout) -> None:
+    header = f'{"scenario":<24}{"items":>8}{"items/s":>11}{"rpc":>9}{"http":>8}{"p50 ms":>10}{"p99 ms":>10}{"peak MiB":>10}'
+    print(header, file=file)
+    print('-' * len(header), file=file)
+    for result in results:
+        peak_memory = '' if result['peak_memory'] is None else f'{result["peak_memory"] / 2 ** 20:.1f}'
+        print(f'{result["scenario"]:<24}{result["items"]:>8}{result["throughput"] or 0:>11.0f}'
+              f'{result["rpc_calls"]:>9.0f}{result["http_requests"]:>8.0f}'
+              f'{result["p50"] * 1000:>10.1f}{result["p99"] * 1000:>10.1f}{peak_memory:>10}', file=file)
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """
+    Find the scenarios that got slower or chattier than a baseline
+
+    :param results: results of this run
+    :param baseline: results of a previous run, as written with --output
+    :param tolerance: allowed relative increase, e.g. 0.2 for 20%
+    :return: description of every regression
+    """
+    previous = {result['scenario']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before is None:
+            continue
+        for key in ('p50', 'rpc_calls', 'http_requests', 'peak_memory'):
+            if result.get(key) is None or not before.get(key):
+                continue
+            if result[key] > before[key] * (1 + tolerance):
+                regressions.append(f'{result["scenario"]}: {key} went from {before[key]:.4g} to {result[key]:.4g}')
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Benchmark the package against a local stand-in node and exchange APIs')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run, all by default: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=5, help='timed runs per scenario')
+    parser.add_argument('--warm', action='store_true', help='keep the caches between runs')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+    fixture = parser.add_argument_group('fixture')
+    fixture.add_argument('--fixture', help='replay a fixture file instead of a synthetic chain')
+    fixture.add_argument('--transfers', type=int, default=50000, help='Transfer events of the synthetic chain')
+    fixture.add_argument('--blocks', type=int, default=300000, help='blocks of the synthetic chain')
+    fixture.add_argument('--wallets', type=int, default=1000, help='wallets of the synthetic chain')
+    fixture.add_argument('--seed', type=int, default=1, help='seed of the synthetic chain')
+    fixture.add_argument('--record', metavar='RPC_URL',
+                         help='record the Transfer logs of TOKEN_ADDRESSES from a real node into --save')
+    fixture.add_argument('--from-block', type=int, help='first block to record')
+    fixture.add_argument('--to-block', type=int, help='last block to record')
+    fixture.add_argument('--save', help='write the fixture to this file')
+    server = parser.add_argument_group('stand-in server')
+    server.add_argument('--rpc-latency-ms', type=float, default=20.0, help='latency of each RPC request')
+    server.add_argument('--exchange-latency-ms', type=float, default=50.0, help='latency of each exchange request')
+    server.add_argument('--jitter-ms', type=float, default=5.0, help='uniform jitter added to every latency')
+    server.add_argument('--error-rate', type=float, default=0.0, help='share of requests failing with a 503')
+    server.add_argument('--max-results', type=int, default=10000, help='largest eth_getLogs result')
+    server.add_argument('--rate', type=float, default=1e6,
+                        help='requests per second allowed per upstream by the rate limiters')
+    queries = parser.add_argument_group('queries')
+    queries.add_argument('--token', default=TOKEN_ADDRESSES[0], help='token of the token scenarios')
+    queries.add_argument('--wallet', help='wallet of historic_transactions, the busiest one by default')
+    queries.add_argument('--days', type=int, default=30, help='num_days of the date based scenarios')
+    report = parser.add_argument_group('report')
+    report.add_argument('--output', help='write the results as JSON to this file')
+    report.add_argument('--baseline', help='compare with the JSON results of a previous run')
+    report.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase over the baseline counted as a regression')
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name!r}, choose from ' + ', '.join(SCENARIOS))
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.record:
+        if args.from_block is None or args.to_block is None or not args.save:
+            raise SystemExit('--record needs --from-block, --to-block and --save')
+        fixture = record_fixture(Web3(Web3.HTTPProvider(args.record)), TOKEN_ADDRESSES,
+                                 args.from_block, args.to_block)
+        save_fixture(fixture, args.save)
+        print(f'Recorded {len(fixture["logs"])} Transfer logs to {args.save}')
+        return 0
+    if args.fixture:
+        fixture = load_fixture(args.fixture)
+    else:
+        fixture = synthetic_fixture(args.transfers, args.blocks, args.wallets, seed=args.seed)
+        if args.save:
+            save_fixture(fixture, args.save)
+
+    configure_rate_limits({name: {'rate': args.rate} for name in [STUB_UPSTREAM] + EXCHANGES})
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir, StubServer(
+            fixture,
+            rpc_latency_ms=args.rpc_latency_ms,
+            exchange_latency_ms=args.exchange_latency_ms,
+            jitter_ms=args.jitter_ms,
+            error_rate=args.error_rate,
+            max_results=args.max_results) as server:
+        # The config path does not exist, so no API keys or rate limits are read
+        set_client(EthereumClient(
+            config_path=os.path.join(work_dir, 'api_keys.json'),
+            web3=Web3(RPCPoolProvider([{'url': server.rpc_url, 'upstream': STUB_UPSTREAM}]))))
+        server.mount_exchanges()
+        context = Context(fixture, Web3.toChecksumAddress(args.token),
+                          args.wallet or busiest_wallet(fixture), args.days, args.warm, work_dir)
+        print(f'{len(fixture["logs"])} Transfer logs over {fixture["head"] + 1} blocks, '
+              f'{"warm" if args.warm else "cold"} caches, {args.iterations} runs per scenario\n')
+        try:
+            for name in args.scenarios or SCENARIOS:
+                results.append(run_scenario(name, context, server, args.iterations, not args.no_memory))
+        finally:
+            if context.store is not None:
+                context.store.close()
+            close_sessions()
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\nRegressions over the baseline:')
+            for regression in regressions:
+                print(f'  {regression}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,376 @@
+import json
+import random
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from requests.adapters import HTTPAdapter
+
+from benchmarks.fixtures import block_hash
+from http_client import get_session
+
+# Hosts of the exchange APIs the stand-in answers for
+EXCHANGE_HOSTS = {
+    'uniswap': 'https://api.thegraph.com',
+    'binance': 'https://api.binance.com',
+    'bybit': 'https://api.bybit.com',
+}
+
+# Largest number of logs an eth_getLogs call returns, like Infura
+MAX_RESULTS = 10000
+
+KLINE_INTERVALS = {'1m': 60, '1h': 3600, '1d': 86400, '1': 60, '60': 3600, 'D': 86400}
+
+
+def _topic_matches(log_topics: List[str], topics: List[Any]) -> bool:
+    for position, topic in enumerate(topics):
+        if topic is None:
+            continue
+        if position >= len(log_topics):
+            return False
+        if isinstance(topic, list):
+            if log_topics[position] not in topic:
+                return False
+        elif log_topics[position] != topic:
+            return False
+    return True
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class StubChain:
+    """
+    The chain of a fixture, answering the JSON-RPC methods the package uses
+
+    Logs are indexed per token address in block order, so eth_getLogs is a
+    binary search over a block range. Block timestamps are spaced by the
+    fixture's block time and end at the time the chain was loaded, so date
+    based queries see the fixture as the last blocks before now.
+    """
+
+    def __init__(self, fixture: Dict[str, Any], max_results: int = MAX_RESULTS) -> None:
+        self.head = fixture['head']
+        self.block_time = fixture.get('block_time', 12)
+        self.max_results = max_results
+        self.head_timestamp = int(time.time())
+        self._logs: Dict[str, List[Dict[str, Any]]] = {}
+        self._blocks: Dict[str, List[int]] = {}
+        self._by_hash: Dict[str, Dict[str, Any]] = {}
+        self._by_block_hash: Dict[str, List[Dict[str, Any]]] = {}
+        for log in fixture['logs']:
+            address = log['address'].lower()
+            self._logs.setdefault(address, []).append(log)
+            self._blocks.setdefault(address, []).append(int(log['blockNumber'], 16))
+            self._by_hash.setdefault(log['transactionHash'], log)
+            self._by_block_hash.setdefault(log['blockHash'], []).append(log)
+
+    def timestamp(self, block_number: int) -> int:
+        return self.head_timestamp - (self.head - block_number) * self.block_time
+
+    def _block_number(self, tag: Any) -> int:
+        if tag in (None, 'latest', 'pending', 'safe', 'finalized'):
+            return self.head
+        if tag == 'earliest':
+            return 0
+        return int(tag, 16) if isinstance(tag, str) else int(tag)
+
+    def block(self, block_number: int) -> Optional[Dict[str, Any]]:
+        if block_number < 0 or block_number > self.head:
+            return None
+        return {
+            'number': hex(block_number),
+            'hash': block_hash(block_number),
+            'parentHash': block_hash(block_number - 1),
+            'timestamp': hex(self.timestamp(block_number)),
+            'transactions': [],
+        }
+
+    def get_logs(self, log_filter: Dict[str, Any]) -> List[Dict[str, Any]]:
+        addresses = log_filter.get('address') or list(self._logs)
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        topics = log_filter.get('topics') or []
+        if 'blockHash' in log_filter:
+            addresses = {address.lower() for address in addresses}
+            candidates = [log for log in self._by_block_hash.get(log_filter['blockHash'], [])
+                          if log['address'].lower() in addresses]
+        else:
+            from_block = self._block_number(log_filter.get('fromBlock', 'latest'))
+            to_block = self._block_number(log_filter.get('toBlock', 'latest'))
+            candidates = []
+            for address in addresses:
+                blocks = self._blocks.get(address.lower(), [])
+                logs = self._logs.get(address.lower(), [])
+                candidates.extend(logs[bisect_left(blocks, from_block):bisect_right(blocks, to_block)])
+        logs = [log for log in candidates if _topic_matches(log['topics'], topics)]
+        if len(logs) > self.max_results:
+            raise RPCError(-32005, f'query returned more than {self.max_results} results')
+        logs.sort(key=lambda log: (int(log['blockNumber'], 16), int(log['logIndex'], 16)))
+        return logs
+
+    def transaction(self, tx_hash: str) -> Optional[Dict[str, Any]]:
+        log = self._by_hash.get(tx_hash)
+        if log is None:
+            return None
+        return {
+            'hash': tx_hash,
+            'blockHash': log['blockHash'],
+            'blockNumber': log['blockNumber'],
+            'transactionIndex': log['transactionIndex'],
+            'from': '0x' + log['topics'][1][-40:],
+            'to': log['address'],
+            'value': '0x0',
+            'input': '0xa9059cbb' + log['topics'][2][-64:] + log['data'][2:],
+            'gas': hex(60000),
+            'gasPrice': hex(30 * 10 ** 9),
+            'nonce': '0x0',
+            'v': '0x1b', 'r': '0x1', 's': '0x1',
+        }
+
+    def call(self, method: str, params: List[Any]) -> Any:
+        if method == 'eth_blockNumber':
+            return hex(self.head)
+        if method == 'eth_chainId':
+            return '0x1'
+        if method == 'net_version':
+            return '1'
+        if method == 'eth_getBlockByNumber':
+            return self.block(self._block_number(params[0]))
+        if method == 'eth_getBlockByHash':
+            return self.block(int(params[0], 16) - 1)
+        if method == 'eth_getLogs':
+            return self.get_logs(params[0])
+        if method == 'eth_getTransactionByHash':
+            return self.transaction(params[0])
+        raise RPCError(-32601, f'the method {method} does not exist/is not available')
+
+
+class StubExchanges:
+    """
+    Deterministic answers to the spot and historical price endpoints of EXCHANGES
+    """
+
+    def __init__(self, base_price: float = 1.0) -> None:
+        self.base_price = base_price
+
+    def price(self, timestamp: int) -> float:
+        return self.base_price * (1 + 0.1 * ((timestamp // 3600) % 24) / 24)
+
+    def uniswap(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        query = body.get('query', '')
+        if 'tokenDayDatas' in query:
+            first = int(re.search(r'first:\s*(\d+)', query).group(1))
+            date_gt = int(re.search(r'date_gt:\s*(\d+)', query).group(1))
+            date_lte = int(re.search(r'date_lte:\s*(\d+)', query).group(1))
+            date = (date_gt // 86400 + 1) * 86400
+            days = []
+            while date <= date_lte and len(days) < first:
+                days.append({'date': date, 'priceUSD': str(self.price(date))})
+                date += 86400
+            return {'data': {'tokenDayDatas': days}}
+        return {'data': {'pair': {'token0Price': str(self.price(int(time.time())))}}}
+
+    def binance(self, path: str, params: Dict[str, str]) -> Any:
+        if path == '/api/v3/ticker/price':
+            return {'symbol': params.get('symbol', '').upper(), 'price': str(self.price(int(time.time())))}
+        interval = KLINE_INTERVALS[params['interval']] * 1000
+        start = -(-int(params['startTime']) // interval) * interval
+        end = int(params['endTime'])
+        limit = int(params.get('limit', 500))
+        klines = []
+        for open_time in range(start, end + 1, interval):
+            if len(klines) == limit:
+                break
+            price = str(self.price(open_time // 1000))
+            klines.append([open_time, price, price, price, price, '0', open_time + interval - 1])
+        return klines
+
+    def bybit(self, path: str, params: Dict[str, str]) -> Any:
+        if path == '/v2/public/tickers':
+            return {'ret_code': 0, 'result': [{'symbol': params.get('symbol'),
+                                               'last_price': str(self.price(int(time.time())))}]}
+        interval = KLINE_INTERVALS[params['interval']] * 1000
+        start = int(params['start'])
+        end = int(params['end']) // interval * interval
+        limit = int(params.get('limit', 200))
+        klines = []
+        for open_time in range(end, start - 1, -interval):
+            if len(klines) == limit:
+                break
+            price = str(self.price(open_time // 1000))
+            klines.append([str(open_time), price, price, price, price, '0', '0'])
+        return {'retCode': 0, 'result': {'category': 'spot', 'list': klines}}
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local HTTP server standing in for an Ethereum node and the exchange APIs
+
+    JSON-RPC requests, single or batched, are answered from a StubChain at
+    ``/rpc``, and exchange requests redirected by ``mount_exchanges`` from a
+    StubExchanges. Every response is delayed by ``latency_ms`` plus up to
+    ``jitter_ms`` of uniform jitter, and a share ``error_rate`` of the
+    requests fails with a 503, so retries and hedging are exercised too.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self,
+                 fixture: Dict[str, Any],
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 rpc_latency_ms: float = 20.0,
+                 exchange_latency_ms: float = 50.0,
+                 jitter_ms: float = 5.0,
+                 error_rate: float = 0.0,
+                 max_results: int = MAX_RESULTS,
+                 seed: int = 1) -> None:
+        super().__init__((host, port), _Handler)
+        self.chain = StubChain(fixture, max_results)
+        self.exchanges = StubExchanges()
+        self.rpc_latency = rpc_latency_ms / 1000
+        self.exchange_latency = exchange_latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.counts: Counter = Counter()
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def rpc_url(self) -> str:
+        return self.url + '/rpc'
+
+    def start(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> 'StubServer':
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.counts.clear()
+            self.bytes_sent = 0
+
+    def _count(self, key: str, value: int = 1) -> None:
+        with self._lock:
+            self.counts[key] += value
+
+    def _delay(self, latency: float) -> Tuple[float, bool]:
+        with self._lock:
+            delay = latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+        return delay, failed
+
+    def mount_exchanges(self) -> None:
+        """
+        Send the requests of the shared exchange sessions to this server
+        """
+        for name, host in EXCHANGE_HOSTS.items():
+            get_session(name).mount(host, _RedirectAdapter(host, self.url + '/' + name))
+
+
+class _RedirectAdapter(HTTPAdapter):
+    def __init__(self, host: str, target: str) -> None:
+        super().__init__(pool_maxsize=32)
+        self.host = host
+        self.target = target
+
+    def send(self, request, **kwargs):
+        request.url = self.target + request.url[len(self.host):]
+        return super().send(request, **kwargs)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: StubServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _reply(self, status: int, body: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server._lock:
+            self.server.bytes_sent += len(data)
+
+    def _body(self) -> Any:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _handle(self, method: str) -> None:
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/', 1)
+        route = parts[0]
+        path = '/' + parts[1] if len(parts) > 1 else '/'
+        body = self._body() if method == 'POST' else None
+        latency = self.server.rpc_latency if route == 'rpc' else self.server.exchange_latency
+        delay, failed = self.server._delay(latency)
+        time.sleep(delay)
+        self.server._count(f'http:{route}')
+        if failed:
+            self.server._count(f'errors:{route}')
+            self._reply(503, {'error': 'service unavailable'}, {'Retry-After': '0'})
+            return
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if route == 'rpc':
+            self._reply(200, self._rpc(body))
+        elif route == 'uniswap':
+            self._reply(200, self.server.exchanges.uniswap(body or {}))
+        elif route == 'binance':
+            self._reply(200, self.server.exchanges.binance(path, params))
+        elif route == 'bybit':
+            self._reply(200, self.server.exchanges.bybit(path, params))
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def _rpc(self, body: Any) -> Any:
+        if isinstance(body, list):
+            return [self._rpc_call(request) for request in body]
+        return self._rpc_call(body)
+
+    def _rpc_call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        self.server._count(request['method'])
+        try:
+            result = self.server.chain.call(request['method'], request.get('params') or [])
+        except RPCError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': e.code, 'message': e.message}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def do_GET(self) -> None:
+        self._handle('GET')
+
+    def do_POST(self) -> None:
+        self._handle('POST')
@@ -0,0 +1,143 @@
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import Any, Awaitable, Callable, Dict, Generator, Optional, Tuple
+
+from web3 import Web3
+
+
+class BlockTimestampIndex:
+    """
+    Sparse table of block timestamps for translating dates to block numbers
+
+    Lookups bisect the known (block, timestamp) samples first and only fetch
+    block headers to narrow the remaining gap, alternating interpolation and
+    bisection steps so a lookup takes O(log n) requests in the worst case.
+    Every header fetched along the way becomes a new sample, and with a
+    ``store`` (e.g. a ChainStore) the samples are persisted, so repeated
+    lookups of the same date take no requests at all.
+    """
+
+    def __init__(self, store: Any = None, head_ttl: float = 12.0) -> None:
+        self.store = store
+        self.head_ttl = head_ttl
+        self.requests = 0
+        self._numbers = []
+        self._timestamps = []
+        self._head_checked_at = 0.0
+        self._lock = threading.RLock()
+        if store is not None:
+            for number, timestamp in store.get_block_samples():
+                self._insert(number, timestamp)
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def _insert(self, number: int, timestamp: int) -> None:
+        i = bisect_left(self._numbers, number)
+        if i < len(self._numbers) and self._numbers[i] == number:
+            return
+        self._numbers.insert(i, number)
+        self._timestamps.insert(i, timestamp)
+
+    def add_sample(self, number: int, timestamp: int) -> None:
+        """
+        Record the timestamp of a block
+
+        :param number: block number
+        :param timestamp: block timestamp
+        """
+        with self._lock:
+            self._insert(number, timestamp)
+        if self.store is not None:
+            self.store.add_block_timestamps({number: timestamp})
+
+    def _search(self, timestamp: int) -> Generator[Any, Tuple[int, int], int]:
+        # Yields the block identifiers to fetch, is sent back (number, timestamp)
+        # pairs and returns the block number, so sync and async callers share it
+        if not self._numbers or self._numbers[0] != 0:
+            self.add_sample(*(yield 0))
+        if (timestamp > self._timestamps[-1]
+                and time.monotonic() - self._head_checked_at > self.head_ttl):
+            self.add_sample(*(yield 'latest'))
+            self._head_checked_at = time.monotonic()
+        if timestamp > self._timestamps[-1]:
+            return self._numbers[-1] + 1
+        if timestamp <= self._timestamps[0]:
+            return self._numbers[0]
+
+        interpolate = True
+        while True:
+            with self._lock:
+                hi = bisect_left(self._timestamps, timestamp)
+                lo_number, lo_timestamp = self._numbers[hi - 1], self._timestamps[hi - 1]
+                hi_number, hi_timestamp = self._numbers[hi], self._timestamps[hi]
+            if hi_number - lo_number <= 1:
+                return hi_number
+            if interpolate:
+                fraction = (timestamp - lo_timestamp) / (hi_timestamp - lo_timestamp)
+                guess = lo_number + int(fraction * (hi_number - lo_number))
+            else:
+                guess = (lo_number + hi_number) // 2
+            interpolate = not interpolate
+            self.add_sample(*(yield min(max(guess, lo_number + 1), hi_number - 1)))
+
+    def block_at(self, w3: Web3, timestamp: int) -> int:
+        """
+        Find the first block mined at or after a timestamp
+
+        :param w3: Web3 instance used when the samples do not pin the block down
+        :param timestamp: unix timestamp in seconds
+        :return: block number, or the next block to be mined if none is that recent yet
+        """
+        search = self._search(timestamp)
+        try:
+            block_identifier = next(search)
+            while True:
+                block = w3.eth.get_block(block_identifier)
+                self.requests += 1
+                block_identifier = search.send((block['number'], block['timestamp']))
+        except StopIteration as e:
+            return e.value
+
+    async def async_block_at(self, get_block: Callable[[Any], Awaitable[Dict]], timestamp: int) -> int:
+        """
+        Find the first block mined at or after a timestamp, fetching headers asynchronously
+
+        :param get_block: coroutine function returning the header of a block identifier
+        :param timestamp: unix timestamp in seconds
+        :return: block number, or the next block to be mined if none is that recent yet
+        """
+        search = self._search(timestamp)
+        try:
+            block_identifier = next(search)
+            while True:
+                block = await get_block(block_identifier)
+                self.requests += 1
+                block_identifier = search.send((block['number'], block['timestamp']))
+        except StopIteration as e:
+            return e.value
+
+    def block_range(self, w3: Web3, start_timestamp: int, end_timestamp: int) -> Tuple[int, int]:
+        """
+        Find the blocks mined within a time window
+
+        :param w3: Web3 instance used when the samples do not pin the blocks down
+        :param start_timestamp: unix timestamp the window starts at, inclusive
+        :param end_timestamp: unix timestamp the window ends at, inclusive
+        :return: (first block, last block), empty when the first is greater than the last
+        """
+        return self.block_at(w3, start_timestamp), self.block_at(w3, end_timestamp + 1) - 1
+
+    def timestamp_of(self, block_number: int) -> Optional[int]:
+        """
+        Get the timestamp of a sampled block
+
+        :param block_number: number of a block in the table
+        :return: block timestamp, or None if the block is not sampled
+        """
+        with self._lock:
+            i = bisect_right(self._numbers, block_number) - 1
+            if i >= 0 and self._numbers[i] == block_number:
+                return self._timestamps[i]
+            return None
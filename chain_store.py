@@ -0,0 +1,352 @@
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from web3 import Web3
+
+from log_scanner import scan_transfer_logs
+from transfers import BlockTimestampCache, iter_decoded_transfers
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS transfers (
+    token TEXT NOT NULL,
+    block_number INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    transaction_index INTEGER NOT NULL,
+    tx_hash TEXT NOT NULL,
+    from_address TEXT NOT NULL,
+    to_address TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (token, block_number, log_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transfers_from ON transfers (from_address, block_number);
+CREATE INDEX IF NOT EXISTS transfers_to ON transfers (to_address, block_number);
+CREATE TABLE IF NOT EXISTS blocks (
+    number INTEGER PRIMARY KEY,
+    timestamp INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    token TEXT PRIMARY KEY,
+    start_block INTEGER NOT NULL,
+    block_number INTEGER NOT NULL
+);
+'''
+
+# Number of most recent blocks re-scanned on every sync to drop reorged transfers
+REORG_DEPTH = 12
+
+
+class ChainStore:
+    """
+    SQLite store of decoded Transfer events and block timestamps
+
+    Each token has a synced block range, so later syncs only fetch blocks
+    past the high-water mark. Values are stored as decimal strings because
+    uint256 amounts do not fit SQLite integers.
+    """
+
+    def __init__(self, path: str = 'chain_data.sqlite3') -> None:
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def add_transfers(self, transfers: Iterable[Dict[str, Any]]) -> None:
+        """
+        Insert decoded transfers, replacing any already stored at the same position
+
+        :param transfers: decoded transfers as returned by iter_decoded_transfers
+        """
+        rows = [(transfer['token'], transfer['block_number'], transfer['log_index'],
+                 transfer['transaction_index'], transfer['tx_hash'], transfer['from'],
+                 transfer['to'], str(transfer['value']))
+                for transfer in transfers]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def add_block_timestamps(self, timestamps: Dict[int, int]) -> None:
+        """
+        Store block timestamps
+
+        :param timestamps: dictionary mapping block numbers to timestamps
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO blocks VALUES (?, ?)', timestamps.items())
+
+    def get_block_timestamps(self, block_numbers: Iterable[int]) -> Dict[int, int]:
+        """
+        Get stored block timestamps
+
+        :param block_numbers: numbers of the blocks
+        :return: dictionary mapping the stored block numbers to timestamps
+        """
+        block_numbers = list(block_numbers)
+        timestamps = {}
+        with self._lock:
+            for start in range(0, len(block_numbers), 500):
+                chunk = block_numbers[start:start + 500]
+                rows = self._connection.execute(
+                    'SELECT number, timestamp FROM blocks WHERE number IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk)
+                timestamps.update(rows)
+        return timestamps
+
+    def get_block_samples(self) -> List[Tuple[int, int]]:
+        """
+        Get every stored block timestamp
+
+        :return: (block number, timestamp) pairs ordered by block number
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT number, timestamp FROM blocks ORDER BY number').fetchall()
+
+    def get_synced_range(self, token_address: str) -> Optional[Tuple[int, int]]:
+        """
+        Get the block range of a token that is fully stored
+
+        :param token_address: token contract address
+        :return: (start block, high-water mark) or None if never synced
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT start_block, block_number FROM sync_state WHERE token = ?',
+                (Web3.toChecksumAddress(token_address),)).fetchone()
+        return tuple(row) if row else None
+
+    def set_synced_range(self, token_address: str, start_block: int, block_number: int) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                (Web3.toChecksumAddress(token_address), start_block, block_number))
+
+    def rewind(self, token_address: str, block_number: int) -> None:
+        """
+        Drop the transfers of a token from a block onwards, e.g. after a reorg
+
+        :param token_address: token contract address
+        :param block_number: first block to drop
+        """
+        token_address = Web3.toChecksumAddress(token_address)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM transfers WHERE token = ? AND block_number >= ?',
+                (token_address, block_number))
+            self._connection.execute(
+                'UPDATE sync_state SET block_number = MIN(block_number, ?) WHERE token = ?',
+                (block_number - 1, token_address))
+
+    def iter_transfers(self,
+                       token_address: Optional[str] = None,
+                       from_block: int = 0,
+                       to_block: Optional[int] = None,
+                       wallet_address: Optional[str] = None,
+                       batch_size: int = 10000,
+                       wallet_addresses: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over stored transfers in block order
+
+        :param token_address: only return transfers of this token
+        :param from_block: first block to return
+        :param to_block: last block to return, defaults to the last stored block
+        :param wallet_address: only return transfers from or to this address
+        :param batch_size: number of rows read from the database at a time
+        :param wallet_addresses: only return transfers from or to any of these addresses
+        :return: generator of decoded transfers with their block 'timestamp'
+        """
+        conditions = ['t.block_number >= ?']
+        params = [from_block]
+        if to_block is not None:
+            conditions.append('t.block_number <= ?')
+            params.append(to_block)
+        if token_address is not None:
+            conditions.append('t.token = ?')
+            params.append(Web3.toChecksumAddress(token_address))
+        if wallet_address is not None:
+            wallet_address = Web3.toChecksumAddress(wallet_address)
+            conditions.append('(t.from_address = ? OR t.to_address = ?)')
+            params.extend([wallet_address, wallet_address])
+        if wallet_addresses is not None:
+            wallet_addresses = [Web3.toChecksumAddress(address) for address in wallet_addresses]
+            placeholders = ', '.join('?' * len(wallet_addresses))
+            conditions.append(f'(t.from_address IN ({placeholders}) OR t.to_address IN ({placeholders}))')
+            params.extend(wallet_addresses + wallet_addresses)
+        query = '''
+            SELECT t.token, t.from_address, t.to_address, t.value, t.block_number,
+                   t.log_index, t.transaction_index, t.tx_hash, b.timestamp
+            FROM transfers t LEFT JOIN blocks b ON b.number = t.block_number
+            WHERE %s
+            ORDER BY t.block_number, t.log_index
+        ''' % ' AND '.join(conditions)
+        with self._lock:
+            cursor = self._connection.execute(query, params)
+            rows = cursor.fetchmany(batch_size)
+        while rows:
+            for row in rows:
+                yield {
+                    'token': row[0],
+                    'from': row[1],
+                    'to': row[2],
+                    'value': int(row[3]),
+                    'block_number': row[4],
+                    'log_index': row[5],
+                    'transaction_index': row[6],
+                    'tx_hash': row[7],
+                    'timestamp': row[8],
+                }
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+
+
+class StoreFold:
+    """
+    Base of the in-memory views folded from the transfers a store holds for a token
+
+    Subclasses hold their state in ``_reset`` and fold transfers in
+    ``apply``. ``update_from_store`` folds whatever the store synced past
+    the last folded block, and folds it again from scratch when the store
+    was backfilled further back.
+    """
+
+    def __init__(self, token_address: Optional[str] = None) -> None:
+        self.token_address = token_address
+        self.start_block: Optional[int] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.block_number = -1
+
+    def apply(self, transfers: Iterable[Dict[str, Any]]) -> int:
+        raise NotImplementedError
+
+    def update_from_store(self, store: ChainStore, confirmations: int = REORG_DEPTH, history_start: int = 0) -> int:
+        """
+        Fold the transfers a store holds past the last folded block
+
+        Only blocks with at least ``confirmations`` confirmations below the
+        store's high-water mark are folded, so reorgs that the store rewinds
+        never have to be undone here. Balances are only right when the store
+        holds every transfer since the token was deployed, so a store synced
+        from a later block, e.g. for a wallet history window, is rejected.
+
+        :param store: store synced for this view's token
+        :param confirmations: number of most recent synced blocks left out
+        :param history_start: block the token was deployed at, the store must be synced from it
+        :return: what apply returns for the folded transfers
+        :raises ValueError: if the store was never synced for the token, or only from after history_start
+        """
+        synced = store.get_synced_range(self.token_address)
+        if synced is None:
+            raise ValueError(f'{store.path} was never synced for token {self.token_address}')
+        start_block, synced_end = synced
+        if start_block > history_start:
+            raise ValueError(f'{store.path} only holds the transfers of token {self.token_address} from block '
+                             f'{start_block}, balances need them from block {history_start}')
+        if self.start_block != start_block:
+            # The store was backfilled further back, so fold it again from scratch
+            self._reset()
+            self.start_block = start_block
+        to_block = synced_end - confirmations
+        if to_block <= self.block_number:
+            return 0
+        result = self.apply(store.iter_transfers(self.token_address, self.block_number + 1, to_block))
+        self.block_number = to_block
+        return result
+
+
+def _store_range(w3: Web3, store: ChainStore, token_address: str, from_block: int, to_block: int,
+                 block_cache: BlockTimestampCache, batch_size: int, **scan_kwargs: Any) -> None:
+    transfer_logs = scan_transfer_logs(w3, token_address, from_block, to_block, **scan_kwargs)
+    batch = []
+    for transfer in iter_decoded_transfers(w3, transfer_logs, block_cache):
+        batch.append(transfer)
+        if len(batch) >= batch_size:
+            store.add_transfers(batch)
+            batch = []
+    store.add_transfers(batch)
+
+
+def sync_plan(store: ChainStore,
+              token_address: str,
+              start_block: int,
+              to_block: int,
+              reorg_depth: int = REORG_DEPTH) -> Iterator[Tuple[int, int]]:
+    """
+    Plan the scans that bring the stored transfers of a token up to date
+
+    The caller stores the transfers of each yielded range before asking
+    for the next one, and the synced range of the store is moved forward
+    as they are, so sync_token_transfers and the async client share the
+    backfill, reorg rewind and high-water mark bookkeeping.
+
+    :param store: store to update
+    :param token_address: token contract address
+    :param start_block: first block the store should cover
+    :param to_block: block to sync up to
+    :param reorg_depth: number of recent blocks re-scanned on every sync
+    :return: generator of (first block, last block) ranges to scan and store
+    """
+    synced = store.get_synced_range(token_address)
+
+    if synced is None:
+        sync_from = start_block
+    else:
+        synced_start, synced_end = synced
+        if start_block < synced_start:
+            yield start_block, synced_start - 1
+            store.set_synced_range(token_address, start_block, synced_end)
+            synced_start = start_block
+        start_block = synced_start
+        if to_block <= synced_end:
+            return
+        sync_from = max(synced_start, synced_end - reorg_depth + 1)
+        store.rewind(token_address, sync_from)
+
+    if sync_from <= to_block:
+        yield sync_from, to_block
+    store.set_synced_range(token_address, start_block, max(to_block, sync_from - 1))
+
+
+def sync_token_transfers(w3: Web3,
+                         store: ChainStore,
+                         token_address: str,
+                         start_block: int = 0,
+                         to_block: Optional[int] = None,
+                         reorg_depth: int = REORG_DEPTH,
+                         block_cache: Optional[BlockTimestampCache] = None,
+                         batch_size: int = 5000,
+                         **scan_kwargs: Any) -> int:
+    """
+    Bring the stored transfers of a token up to date
+
+    Only blocks past the high-water mark are fetched, plus the last
+    ``reorg_depth`` blocks below it, which are dropped and re-scanned so
+    transfers from reorged blocks do not survive. Blocks before the synced
+    range are backfilled when ``start_block`` is lower than on earlier syncs.
+
+    :param w3: Web3 instance to query
+    :param store: store to update
+    :param token_address: token contract address
+    :param start_block: first block the store should cover
+    :param to_block: block to sync up to, defaults to the latest block
+    :param reorg_depth: number of recent blocks re-scanned on every sync
+    :param block_cache: block timestamp cache, defaults to one backed by the store
+    :param batch_size: number of transfers written per transaction
+    :param scan_kwargs: chunking options passed to scan_logs
+    :return: the high-water mark after the sync
+    """
+    if to_block is None:
+        to_block = w3.eth.block_number
+    if block_cache is None:
+        block_cache = BlockTimestampCache(store=store)
+    for from_block, end_block in sync_plan(store, token_address, start_block, to_block, reorg_depth):
+        _store_range(w3, store, token_address, from_block, end_block, block_cache,
+                     batch_size, **scan_kwargs)
+    return max(to_block, store.get_synced_range(token_address)[1])
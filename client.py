@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import requests
+from web3 import Web3
+
+from http_client import request
+from metrics import configure_metrics
+from rate_limiter import configure_rate_limits
+from rpc_pool import RPCPoolProvider, rpc_endpoints
+
+# Config and ABI files are looked up next to this module, not in the working directory
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CONFIG_PATH = os.path.join(PACKAGE_DIR, 'api_keys.json')
+DEFAULT_ABI_PATH = os.path.join(PACKAGE_DIR, 'erc20_abi.json')
+
+# Environment variable overriding the config path
+CONFIG_PATH_ENV = 'ETHEREUM_TRANSACTIONS_CONFIG'
+
+
+class EthereumClient:
+    """
+    Lazily initialized config and Web3 instance
+
+    Nothing is read or connected until first used: the config and ABI files
+    are loaded on first access and the Web3 instance over an RPCPoolProvider
+    of the configured endpoints is created once.
+    """
+
+    def __init__(self, config_path: Optional[str] = None, abi_path: Optional[str] = None,
+                 web3: Optional[Web3] = None) -> None:
+        self.config_path = config_path or os.environ.get(CONFIG_PATH_ENV) or DEFAULT_CONFIG_PATH
+        self.abi_path = abi_path or DEFAULT_ABI_PATH
+        self._config: Optional[Dict[str, Any]] = None
+        self._erc20_abi: Optional[List[Dict[str, Any]]] = None
+        self._web3 = web3
+        self._lock = threading.RLock()
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        """
+        The parsed config file, empty if there is none
+        """
+        with self._lock:
+            if self._config is None:
+                config = {}
+                if os.path.exists(self.config_path):
+                    with open(self.config_path) as f:
+                        config = json.load(f)
+                configure_rate_limits(config.get('rate_limits', {}))
+                configure_metrics(config.get('metrics', {}))
+                self._config = config
+            return self._config
+
+    def api_key(self, name: str) -> Optional[str]:
+        """
+        Get an API key from the config
+
+        :param name: key name, e.g. 'etherscan', 'binance' or 'bybit'
+        :return: API key, or None if it is not configured
+        """
+        return self.config.get(name)
+
+    def request(self, name: str, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """
+        Send a request to an upstream with the rate limits of the config, see http_client.request
+
+        :param name: upstream name, e.g. an exchange from EXCHANGES
+        :param method: HTTP method
+        :param url: request URL
+        :param kwargs: options passed to http_client.request
+        :return: successful response
+        """
+        self.config  # the configured rate limits apply from the first request on
+        return request(name, method, url, **kwargs)
+
+    @property
+    def erc20_abi(self) -> List[Dict[str, Any]]:
+        """
+        The ERC20 ABI
+        """
+        with self._lock:
+            if self._erc20_abi is None:
+                with open(self.abi_path) as f:
+                    self._erc20_abi = json.load(f)
+            return self._erc20_abi
+
+    @property
+    def web3(self) -> Web3:
+        """
+        The Web3 instance shared by every call
+        """
+        with self._lock:
+            if self._web3 is None:
+                self._web3 = Web3(RPCPoolProvider(rpc_endpoints(self.config)))
+            return self._web3
+
+
+_client: Optional[EthereumClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> EthereumClient:
+    """
+    Get the client shared by every function of the package
+
+    :return: shared client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = EthereumClient()
+        return _client
+
+
+def set_client(client: EthereumClient) -> None:
+    """
+    Replace the shared client, e.g. to use another config file
+
+    :param client: client to share
+    """
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def get_web3() -> Web3:
+    """
+    Get the Web3 instance shared by every function of the package
+
+    :return: shared Web3 instance
+    """
+    return get_client().web3
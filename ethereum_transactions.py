@@ -1,21 +1,35 @@
-import json
-import time
+import calendar
+import threading
 from datetime import datetime, timedelta
-from typing import List, Tuple
-import requests
+from typing import Any, Dict, List, Optional, Tuple, Union
+import pandas as pd
 from web3 import Web3
-from requests.exceptions import HTTPError
 
-with open('api_keys.json') as f:
-    API_KEYS = json.load(f)
-
-with open('erc20_abi.json') as f:
-    ERC20_ABI = json.load(f)
-
-
-ETHERSCAN_API_KEY = API_KEYS['etherscan']
-BINANCE_API_KEY = API_KEYS['binance']
-BYBIT_API_KEY = API_KEYS['bybit']
+from balance_history import BalanceHistory
+from block_index import BlockTimestampIndex
+from chain_store import ChainStore, sync_token_transfers
+from client import get_client, get_web3
+from holder_index import HolderIndex
+from metrics import traced
+from price_cache import PriceCache
+from transfer_table import TransferTable
+from transfers import BlockTimestampCache, iter_decoded_transfers, iter_with_transactions
+from wallet_history import iter_stored_wallet_transfers, scan_wallet_transfer_logs, split_by_wallet
+
+# Config values that used to be loaded at import time, now read from the shared client on access
+_LAZY_CONFIG = {
+    'ETHERSCAN_API_KEY': lambda: get_client().api_key('etherscan'),
+    'BINANCE_API_KEY': lambda: get_client().api_key('binance'),
+    'BYBIT_API_KEY': lambda: get_client().api_key('bybit'),
+    'API_KEYS': lambda: get_client().config,
+    'ERC20_ABI': lambda: get_client().erc20_abi,
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_CONFIG:
+        return _LAZY_CONFIG[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 TOKEN_ADDRESSES = [
@@ -24,50 +38,92 @@ TOKEN_ADDRESSES = [
     '0xb23d80f5FefcDDaa212212F028021B41DEd428CF',  # PRIME
 ]
 
+TOKEN_SYMBOLS = {
+    '0x3845badade8e6dff049820680d1f14bd3903a5d0': 'SAND',
+    '0x0f5d2fb29fb7d3cfee444a200298f468908cc942': 'MANA',
+    '0xb23d80f5fefcddaa212212f028021b41ded428cf': 'PRIME',
+}
+
 EXCHANGES = ['uniswap', 'binance', 'bybit']
 
+# Candle resolutions supported by get_historical_token_prices, in seconds
+PRICE_RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+# Block timestamps shared by every call, fetched once per block
+BLOCK_TIMESTAMPS = BlockTimestampCache()
+
+# Seconds a price stays fresh per exchange before it is fetched again
+PRICE_TTLS = {'uniswap': 30, 'binance': 5, 'bybit': 5}
+PRICE_CACHE = PriceCache(PRICE_TTLS)
+
+# Date to block number indexes, one in memory and one per chain store file
+BLOCK_INDEXES: Dict[str, BlockTimestampIndex] = {}
+
+# Holder balance indexes per chain store file and token, kept up to date from the store
+HOLDER_INDEXES: Dict[Tuple[str, str], HolderIndex] = {}
+
+# Balance histories per chain store file and token, kept up to date from the store
+BALANCE_HISTORIES: Dict[Tuple[str, str], BalanceHistory] = {}
+
+# Function to build the spot price request of an exchange as (method, url, request options)
+def spot_price_request(token_address: str, exchange: str) -> Tuple[str, str, Dict]:
+    if exchange == 'uniswap':
+        uniswap_url = f'https://api.thegraph.com/subgraphs/name/uniswap/uniswap-v2'
+        query = f'''{{
+            pair(id: "{token_address.lower()}_weth") {{
+                token0Price
+            }}
+        }}'''
+        return 'POST', uniswap_url, {'json': {'query': query}}
+    elif exchange == 'binance':
+        binance_url = f'https://api.binance.com/api/v3/ticker/price?symbol={get_token_symbol(token_address)}USDT'
+        return 'GET', binance_url, {'headers': {'X-MBX-APIKEY': get_client().api_key('binance')}}
+    elif exchange == 'bybit':
+        bybit_url = f'https://api.bybit.com/v2/public/tickers?symbol={get_token_symbol(token_address)}USDT'
+        return 'GET', bybit_url, {'headers': {'Referer': 'https://www.bybit.com/'}}
+    else:
+        raise ValueError('Invalid exchange provided')
+
+# Function to read the spot price out of the decoded response of an exchange
+def parse_spot_price(result: Dict, exchange: str) -> float:
+    if exchange == 'uniswap':
+        return float(result['data']['pair']['token0Price'])
+    elif exchange == 'binance':
+        return float(result['price'])
+    elif exchange == 'bybit':
+        return float(result['result'][0]['last_price'])
+    else:
+        raise ValueError('Invalid exchange provided')
+
+# Function to get the spot price of a token from an exchange over its shared session
+def _get_spot_price(token_address: str, exchange: str) -> float:
+    method, url, options = spot_price_request(token_address, exchange)
+    response = get_client().request(exchange, method, url, **options)
+    return parse_spot_price(response.json(), exchange)
+
 # Function to get token price from Uniswap
 def get_uniswap_token_price(token_address: str) -> float:
-    uniswap_url = f'https://api.thegraph.com/subgraphs/name/uniswap/uniswap-v2'
-    query = f'''{{
-        pair(id: "{token_address.lower()}_weth") {{
-            token0Price
-        }}
-    }}'''
-    response = requests.post(uniswap_url, json={'query': query})
-    if response.ok:
-        result = response.json()
-        price = float(result['data']['pair']['token0Price'])
-        return price
-    else:
-        response.raise_for_status()
+    return _get_spot_price(token_address, 'uniswap')
 
 # Function to get token price from Binance
 def get_binance_token_price(token_address: str) -> float:
-    binance_url = f'https://api.binance.com/api/v3/ticker/price?symbol={token_address.lower()}usdt'
-    headers = {'X-MBX-APIKEY': BINANCE_API_KEY}
-    response = requests.get(binance_url, headers=headers)
-    if response.ok:
-        result = response.json()
-        price = float(result['price'])
-        return price
-    else:
-        response.raise_for_status()
+    return _get_spot_price(token_address, 'binance')
 
 # Function to get token price from Bybit
 def get_bybit_token_price(token_address: str) -> float:
-    bybit_url = f'https://api.bybit.com/v2/public/tickers?symbol={token_address.upper()}USDT'
-    headers = {'Referer': 'https://www.bybit.com/'}
-    response = requests.get(bybit_url, headers=headers)
-    if response.ok:
-        result = response.json()
-        price = float(result['result'][0]['last_price'])
-        return price
-    else:
-        response.raise_for_status()
+    return _get_spot_price(token_address, 'bybit')
 
 # Function to get token price from an exchange
-def get_token_price(token_address: str, exchange: str) -> float:
+@traced()
+def get_token_price(token_address: str, exchange: str, use_cache: bool = True) -> float:
+    if exchange not in EXCHANGES:
+        raise ValueError('Invalid exchange provided')
+    if not use_cache:
+        return fetch_token_price(token_address, exchange)
+    return PRICE_CACHE.get(token_address, exchange, lambda: fetch_token_price(token_address, exchange))
+
+# Function to fetch token price from an exchange, bypassing the price cache
+def fetch_token_price(token_address: str, exchange: str) -> float:
     if exchange == 'uniswap':
         return get_uniswap_token_price(token_address)
     elif exchange == 'binance':
@@ -77,76 +133,241 @@ def get_token_price(token_address: str, exchange: str) -> float:
     else:
         raise ValueError('Invalid exchange provided')
 
+# Chain store used when a function is given none, opened on first use and shared by every call
+_default_store: Optional[ChainStore] = None
+_default_store_lock = threading.Lock()
+
+# Function to get the chain store shared by every call that is given none
+def get_default_store() -> ChainStore:
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ChainStore()
+        return _default_store
 
 # Function to get the top token holders for a given token
-def get_top_token_holders(token_address: str, num_holders: int = 20) -> List[Tuple[str, float]]:
-    w3 = Web3(Web3.HTTPProvider('https://mainnet.infura.io/v3/your-infura-api-key'))
-    contract = w3.eth.contract(address=token_address, abi=ERC20_ABI)
-    holders = {}
-    total_supply = contract.functions.totalSupply().call()
-    if total_supply == 0:
-        return []
-    for i in range(0, total_supply, 100):
-        chunk = contract.functions.topHolders(i, 100).call()
-        for holder in chunk:
-            address = Web3.toChecksumAddress(holder[0])
-            balance = holder[1] / (10 ** 18)
-            if balance > 0 and address != '0x0000000000000000000000000000000000000000':
-                holders[address] = holders.get(address, 0) + balance
-    sorted_holders = sorted(holders.items(), key=lambda x: x[1], reverse=True)
-    return sorted_holders[:num_holders]
+@traced()
+def get_top_token_holders(token_address: str, num_holders: int = 20, store: ChainStore = None, start_block: int = 0) -> List[Tuple[str, float]]:
+    w3 = get_web3()
+    token_address = Web3.toChecksumAddress(token_address)
+    if store is None:
+        store = get_default_store()
+    sync_token_transfers(w3, store, token_address, start_block)
+    index = HOLDER_INDEXES.get((store.path, token_address))
+    if index is None:
+        index = HOLDER_INDEXES[(store.path, token_address)] = HolderIndex(token_address)
+    index.update_from_store(store, history_start=start_block)
+    return [(address, balance / (10 ** 18)) for address, balance in index.top(num_holders)]
+
+# Function to get the balance history of a token, synced first unless sync is False
+def get_balance_history(token_address: str, store: ChainStore = None, start_block: int = 0, sync: bool = True) -> BalanceHistory:
+    token_address = Web3.toChecksumAddress(token_address)
+    if store is None:
+        store = get_default_store()
+    if sync:
+        sync_token_transfers(get_web3(), store, token_address, start_block)
+    history = BALANCE_HISTORIES.get((store.path, token_address))
+    if history is None:
+        history = BALANCE_HISTORIES[(store.path, token_address)] = BalanceHistory(token_address)
+    history.update_from_store(store, history_start=start_block)
+    return history
+
+# Function to get the raw token balances of many wallets at a UTC date, without any request when sync is False
+@traced()
+def get_historical_token_balances(wallet_addresses: List[str], date: datetime, token_addresses: List[str] = None, store: ChainStore = None, sync: bool = True) -> pd.DataFrame:
+    wallet_addresses = [Web3.toChecksumAddress(wallet_address) for wallet_address in wallet_addresses]
+    token_addresses = [Web3.toChecksumAddress(token_address) for token_address in token_addresses or TOKEN_ADDRESSES]
+    timestamp = _utc_timestamp(date)
+    balances = {}
+    for token_address in token_addresses:
+        history = get_balance_history(token_address, store, sync=sync)
+        block_number = history.block_at(timestamp)
+        balances[token_address] = [history.balance_at(wallet_address, block_number) for wallet_address in wallet_addresses]
+    return pd.DataFrame(balances, index=pd.Index(wallet_addresses, name='wallet'),
+                        columns=pd.Index(token_addresses, name='token'), dtype=object)
+
+# Function to get the balance of a wallet in a token at every step of the last num_days
+@traced()
+def get_historical_balance(wallet_address: str, token_address: str, num_days: int = 30, resolution: str = '1d', store: ChainStore = None, sync: bool = True) -> pd.Series:
+    if resolution not in PRICE_RESOLUTIONS:
+        raise ValueError('Invalid resolution provided')
+    wallet_address = Web3.toChecksumAddress(wallet_address)
+    history = get_balance_history(token_address, store, sync=sync)
+    step = PRICE_RESOLUTIONS[resolution]
+    end_time = _utc_timestamp(datetime.utcnow())
+    start_time = (end_time - num_days * 86400) // step * step + step
+    timestamps = list(range(start_time, end_time + 1, step))
+    balances = [history.balance_at(wallet_address, history.block_at(timestamp)) / (10 ** 18) for timestamp in timestamps]
+    index = pd.to_datetime(timestamps, unit='s', utc=True).rename('date')
+    return pd.Series(balances, index=index, name='balance', dtype=float)
+
+# Function to convert a naive UTC datetime to a unix timestamp
+def _utc_timestamp(date: datetime) -> int:
+    return calendar.timegm(date.utctimetuple())
+
+# Function to get the trading symbol of a token, falling back to the given value
+def get_token_symbol(token_address: str) -> str:
+    return TOKEN_SYMBOLS.get(token_address.lower(), token_address).upper()
+
+# Function to get historical token prices from Binance klines, 1000 candles per request
+def get_binance_historical_prices(token_address: str, start: datetime, end: datetime, resolution: str = '1d') -> List[Tuple[int, float]]:
+    binance_url = 'https://api.binance.com/api/v3/klines'
+    headers = {'X-MBX-APIKEY': get_client().api_key('binance')}
+    interval_ms = PRICE_RESOLUTIONS[resolution] * 1000
+    start_time = _utc_timestamp(start) * 1000
+    end_time = _utc_timestamp(end) * 1000
+    prices = []
+    while start_time <= end_time:
+        response = get_client().request('binance', 'GET', binance_url, headers=headers, params={
+            'symbol': f'{get_token_symbol(token_address)}USDT',
+            'interval': resolution,
+            'startTime': start_time,
+            'endTime': end_time,
+            'limit': 1000,
+        })
+        klines = response.json()
+        prices.extend((kline[0] // 1000, float(kline[4])) for kline in klines)
+        if len(klines) < 1000:
+            break
+        start_time = klines[-1][0] + interval_ms
+    return prices
 
-# Function to get historical token prices for a given token
-def get_historical_token_prices(token_address: str, num_days: int = 30, exchange: str = 'uniswap') -> List[Tuple[str, float]]:
+# Function to get historical token prices from Bybit klines, 1000 candles per request
+def get_bybit_historical_prices(token_address: str, start: datetime, end: datetime, resolution: str = '1d') -> List[Tuple[int, float]]:
+    bybit_url = 'https://api.bybit.com/v5/market/kline'
+    headers = {'Referer': 'https://www.bybit.com/'}
+    interval = {'1m': '1', '1h': '60', '1d': 'D'}[resolution]
+    start_time = _utc_timestamp(start) * 1000
+    end_time = _utc_timestamp(end) * 1000
     prices = []
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=num_days)
-    current_date = start_date
-    while current_date <= end_date:
-        timestamp = int(current_date.timestamp())
-        try:
-            price = get_token_price(token_address, exchange)
-            prices.append((datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d'), price))
-        except HTTPError as e:
-            print(f'Error fetching price for date {current_date}: {e}')
-        current_date += timedelta(days=1)
-        time.sleep(1)
+    while start_time <= end_time:
+        response = get_client().request('bybit', 'GET', bybit_url, headers=headers, params={
+            'category': 'spot',
+            'symbol': f'{get_token_symbol(token_address)}USDT',
+            'interval': interval,
+            'start': start_time,
+            'end': end_time,
+            'limit': 1000,
+        })
+        # Candles come newest first, so page backwards from the end of the range
+        klines = response.json()['result']['list']
+        prices.extend((int(kline[0]) // 1000, float(kline[4])) for kline in klines)
+        if len(klines) < 1000:
+            break
+        end_time = int(klines[-1][0]) - 1
+    prices.sort()
     return prices
 
-# Function to get the transaction history of a wallet
+# Function to get historical token prices from the Uniswap subgraph, daily only
+def get_uniswap_historical_prices(token_address: str, start: datetime, end: datetime, resolution: str = '1d') -> List[Tuple[int, float]]:
+    if resolution != '1d':
+        raise ValueError('Uniswap only provides daily historical prices')
+    uniswap_url = 'https://api.thegraph.com/subgraphs/name/uniswap/uniswap-v2'
+    last_date = _utc_timestamp(start) - 1
+    end_date = _utc_timestamp(end)
+    prices = []
+    while last_date < end_date:
+        query = f'''{{
+            tokenDayDatas(first: 1000, orderBy: date, orderDirection: asc,
+                          where: {{token: "{token_address.lower()}", date_gt: {last_date}, date_lte: {end_date}}}) {{
+                date
+                priceUSD
+            }}
+        }}'''
+        response = get_client().request('uniswap', 'POST', uniswap_url, json={'query': query})
+        day_datas = response.json()['data']['tokenDayDatas']
+        prices.extend((int(day['date']), float(day['priceUSD'])) for day in day_datas)
+        if len(day_datas) < 1000:
+            break
+        last_date = int(day_datas[-1]['date'])
+    return prices
 
-def get_historic_transactions(wallet_address: str, num_days: int = 30) -> Dict[str, List[Dict]]:
-    w3 = Web3(Web3.HTTPProvider('https://mainnet.infura.io/v3/your-infura-api-key'))
-    transactions = {'incoming': [], 'outgoing': []}
+# Function to get historical token prices for a given token
+@traced()
+def get_historical_token_prices(token_address: str, num_days: int = 30, exchange: str = 'uniswap', resolution: str = '1d') -> pd.Series:
+    if resolution not in PRICE_RESOLUTIONS:
+        raise ValueError('Invalid resolution provided')
+    end_date = datetime.utcnow()
+    start_date = end_date - timedelta(days=num_days)
+    if exchange == 'uniswap':
+        prices = get_uniswap_historical_prices(token_address, start_date, end_date, resolution)
+    elif exchange == 'binance':
+        prices = get_binance_historical_prices(token_address, start_date, end_date, resolution)
+    elif exchange == 'bybit':
+        prices = get_bybit_historical_prices(token_address, start_date, end_date, resolution)
+    else:
+        raise ValueError('Invalid exchange provided')
+    timestamps = [timestamp for timestamp, _ in prices]
+    index = pd.to_datetime(timestamps, unit='s', utc=True).rename('date')
+    series = pd.Series([price for _, price in prices], index=index, name='price', dtype=float)
+    return series[~series.index.duplicated()].sort_index()
+
+# Function to get the date to block number index, persisted in the chain store if one is given
+def get_block_index(store: ChainStore = None) -> BlockTimestampIndex:
+    key = store.path if store is not None else ''
+    index = BLOCK_INDEXES.get(key)
+    if index is None:
+        index = BLOCK_INDEXES[key] = BlockTimestampIndex(store)
+    return index
+
+# Function to get the first and last block mined between two UTC dates
+def get_block_range(w3: Web3, start_date: datetime, end_date: datetime, store: ChainStore = None) -> Tuple[int, int]:
+    return get_block_index(store).block_range(w3, _utc_timestamp(start_date), _utc_timestamp(end_date))
+
+# Function to turn a decoded transfer into a transaction record of a wallet
+def transaction_record(transfer: Dict, direction: str, include_tx: bool) -> Dict:
+    amount = float(transfer['value']) / (10 ** 18)
+    if direction == 'outgoing':
+        amount *= -1
+    transaction = {
+        'date': datetime.utcfromtimestamp(transfer['timestamp']),
+        'token': transfer['token'],
+        'amount': amount,
+        'tx_hash': transfer['tx_hash'],
+        'from': transfer['from'],
+        'to': transfer['to'],
+        'block_number': transfer['block_number']
+    }
+    if include_tx:
+        transaction['tx_sender'] = transfer['tx_sender']
+        transaction['tx_recipient'] = transfer['tx_recipient']
+    return transaction
+
+# Function to get the transaction history of many wallets in a single pass over all tokens
+@traced()
+def get_wallets_historic_transactions(wallet_addresses: List[str], num_days: int = 30, include_tx: bool = False, store: ChainStore = None, as_table: bool = False) -> Union[Dict[str, Dict[str, List[Dict]]], TransferTable]:
+    w3 = get_web3()
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=num_days)
-    for token_address in TOKEN_ADDRESSES:
-        contract = w3.eth.contract(address=token_address, abi=ERC20_ABI)
-        transfer_events = contract.events.Transfer().process(
-            argument_filters={'to': wallet_address},
-            fromBlock=w3.eth.block_number - 50000,
-            toBlock='latest'
-        )
-        for event in transfer_events:
-            tx = w3.eth.getTransaction(event['transactionHash'].hex())
-            timestamp = w3.eth.getBlock(tx['blockNumber'])['timestamp']
-            tx_date = datetime.utcfromtimestamp(timestamp)
-            if start_date <= tx_date <= end_date:
-                amount = float(event['args']['value']) / (10 ** 18)
-                direction = 'incoming'
-                if tx['from'] == wallet_address:
-                    direction = 'outgoing'
-                    amount *= -1
-                transactions[direction].append({
-                    'date': tx_date,
-                    'token': token_address,
-                    'amount': amount,
-                    'tx_hash': event['transactionHash'].hex(),
-                    'from': tx['from'],
-                    'to': tx['to'],
-                    'block_number': tx['blockNumber']
-                })
-    return transactions
+    from_block, block_number = get_block_range(w3, start_date, end_date, store)
+    if store is not None:
+        # Only fetch the blocks past the store's high-water mark
+        for token_address in TOKEN_ADDRESSES:
+            sync_token_transfers(w3, store, token_address, from_block, block_number)
+        transfers = iter_stored_wallet_transfers(store, wallet_addresses, TOKEN_ADDRESSES, from_block, block_number)
+        if include_tx:
+            transfers = iter_with_transactions(w3, transfers)
+    else:
+        transfer_logs = scan_wallet_transfer_logs(w3, wallet_addresses, TOKEN_ADDRESSES, from_block, block_number)
+        transfers = iter_decoded_transfers(w3, transfer_logs, BLOCK_TIMESTAMPS, include_tx)
+    if as_table:
+        # One compact table for all wallets, select with for_wallet(wallet, direction)
+        return TransferTable.from_transfers(transfers)
+    history = split_by_wallet(transfers, wallet_addresses)
+    return {
+        wallet_address: {
+            direction: [transaction_record(transfer, direction, include_tx) for transfer in wallet_transfers]
+            for direction, wallet_transfers in wallet_history.items()
+        }
+        for wallet_address, wallet_history in history.items()
+    }
+
+# Function to get the transaction history of a wallet
+@traced()
+def get_historic_transactions(wallet_address: str, num_days: int = 30, include_tx: bool = False, store: ChainStore = None, as_table: bool = False) -> Union[Dict[str, List[Dict]], TransferTable]:
+    if as_table:
+        return get_wallets_historic_transactions([wallet_address], num_days, store=store, as_table=True)
+    return get_wallets_historic_transactions([wallet_address], num_days, include_tx, store)[wallet_address]
 
 
 
@@ -0,0 +1,129 @@
+import csv
+import itertools
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from transfers import check_timestamps
+
+# Columns of an exported transfer, in file order
+TRANSFER_COLUMNS = [
+    'block_number', 'log_index', 'transaction_index', 'timestamp',
+    'tx_hash', 'token', 'from', 'to', 'value',
+]
+
+EXPORT_FORMATS = ('parquet', 'csv', 'jsonl')
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('block_number', pa.int64()),
+        ('log_index', pa.int32()),
+        ('transaction_index', pa.int32()),
+        ('timestamp', pa.timestamp('s', tz='UTC')),
+        ('tx_hash', pa.binary(32)),
+        ('token', pa.binary(20)),
+        ('from', pa.binary(20)),
+        ('to', pa.binary(20)),
+        # uint256 does not fit any Arrow integer or decimal type, so store it as big-endian bytes
+        ('value', pa.binary(32)),
+    ])
+
+
+def _hex_bytes(value: str) -> bytes:
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+
+def _parquet_batch(transfers: List[Dict[str, Any]], schema):
+    import pyarrow as pa
+    check_timestamps(transfers)
+    columns = [
+        [transfer['block_number'] for transfer in transfers],
+        [transfer['log_index'] for transfer in transfers],
+        [transfer['transaction_index'] for transfer in transfers],
+        [transfer['timestamp'] for transfer in transfers],
+        [_hex_bytes(transfer['tx_hash']) for transfer in transfers],
+        [_hex_bytes(transfer['token']) for transfer in transfers],
+        [_hex_bytes(transfer['from']) for transfer in transfers],
+        [_hex_bytes(transfer['to']) for transfer in transfers],
+        [transfer['value'].to_bytes(32, 'big') for transfer in transfers],
+    ]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema)
+
+
+def _text_row(transfer: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'block_number': transfer['block_number'],
+        'log_index': transfer['log_index'],
+        'transaction_index': transfer['transaction_index'],
+        'timestamp': transfer['timestamp'],
+        'tx_hash': transfer['tx_hash'],
+        'token': transfer['token'],
+        'from': transfer['from'],
+        'to': transfer['to'],
+        # Decimal string keeps uint256 values exact in every reader
+        'value': str(transfer['value']),
+    }
+
+
+def export_transfers(transfers: Iterable[Dict[str, Any]],
+                     path: str,
+                     format: Optional[str] = None,
+                     batch_size: int = 65536) -> int:
+    """
+    Stream decoded transfers to a Parquet, CSV or JSON Lines file
+
+    Transfers are consumed and written in batches of ``batch_size`` rows
+    (one Parquet row group per batch), so memory use does not grow with
+    the number of transfers. Parquet columns are typed: hashes and
+    addresses are fixed-size binary and values are 32-byte big-endian
+    unsigned integers. CSV and JSON Lines use hex strings and decimal
+    value strings. Parquet export needs pyarrow.
+
+    :param transfers: decoded transfers, e.g. from iter_decoded_transfers or ChainStore.iter_transfers
+    :param path: file to write
+    :param format: 'parquet', 'csv' or 'jsonl', inferred from the file extension by default
+    :param batch_size: number of transfers written at a time
+    :return: number of transfers written
+    :raises ValueError: if a transfer written to Parquet has no block timestamp
+    """
+    if format is None:
+        format = os.path.splitext(path)[1].lstrip('.').lower()
+        format = {'pq': 'parquet', 'ndjson': 'jsonl'}.get(format, format)
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'Invalid export format: {format}')
+
+    transfers = iter(transfers)
+    count = 0
+    if format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet export requires pyarrow, install it with `pip install pyarrow`')
+        schema = _parquet_schema()
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while True:
+                batch = list(itertools.islice(transfers, batch_size))
+                if not batch:
+                    break
+                writer.write_batch(_parquet_batch(batch, schema))
+                count += len(batch)
+        return count
+
+    with open(path, 'w', newline='') as f:
+        if format == 'csv':
+            writer = csv.DictWriter(f, fieldnames=TRANSFER_COLUMNS)
+            writer.writeheader()
+        while True:
+            batch = list(itertools.islice(transfers, batch_size))
+            if not batch:
+                break
+            if format == 'csv':
+                writer.writerows(_text_row(transfer) for transfer in batch)
+            else:
+                f.writelines(json.dumps(_text_row(transfer)) + '\n' for transfer in batch)
+            count += len(batch)
+    return count
@@ -0,0 +1,102 @@
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from chain_store import StoreFold
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+class HolderIndex(StoreFold):
+    """
+    Exact token balances of every holder, folded from Transfer events
+
+    Balances are Python integers in a list addressed by a per-holder slot,
+    and positive balances are kept in a ranking sorted by balance so top
+    holder queries are a slice. Small updates are applied to the ranking in
+    place, larger ones trigger a lazy re-sort on the next query.
+    """
+
+    def __init__(self, token_address: Optional[str] = None, rebuild_ratio: float = 0.05) -> None:
+        self.rebuild_ratio = rebuild_ratio
+        super().__init__(token_address)
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._slots: Dict[str, int] = {}
+        self._addresses: List[str] = []
+        self._balances: List[int] = []
+        self._ranking: List[Tuple[int, int]] = []
+        self._ranked = False
+
+    def __len__(self) -> int:
+        """
+        Number of addresses holding a positive balance
+        """
+        if self._ranked:
+            return len(self._ranking)
+        return sum(1 for balance in self._balances if balance > 0)
+
+    def _slot(self, address: str) -> int:
+        slot = self._slots.get(address)
+        if slot is None:
+            slot = self._slots[address] = len(self._addresses)
+            self._addresses.append(address)
+            self._balances.append(0)
+        return slot
+
+    def apply(self, transfers: Iterable[Dict[str, Any]]) -> int:
+        """
+        Fold decoded transfers into the balances
+
+        :param transfers: decoded transfers in block order
+        :return: number of holders whose balance changed
+        """
+        balances = self._balances
+        previous: Dict[int, int] = {}
+        for transfer in transfers:
+            value = transfer['value']
+            if transfer['from'] != ZERO_ADDRESS:
+                slot = self._slot(transfer['from'])
+                previous.setdefault(slot, balances[slot])
+                balances[slot] -= value
+            if transfer['to'] != ZERO_ADDRESS:
+                slot = self._slot(transfer['to'])
+                previous.setdefault(slot, balances[slot])
+                balances[slot] += value
+            if transfer['block_number'] > self.block_number:
+                self.block_number = transfer['block_number']
+
+        if self._ranked:
+            if len(previous) > self.rebuild_ratio * len(self._ranking) + 64:
+                self._ranked = False
+            else:
+                ranking = self._ranking
+                for slot, before in previous.items():
+                    if before > 0:
+                        del ranking[bisect_left(ranking, (-before, slot))]
+                    if balances[slot] > 0:
+                        insort(ranking, (-balances[slot], slot))
+        return len(previous)
+
+    def balance_of(self, address: str) -> int:
+        """
+        Get the balance of an address
+
+        :param address: checksummed holder address
+        :return: raw integer balance
+        """
+        slot = self._slots.get(address)
+        return 0 if slot is None else self._balances[slot]
+
+    def top(self, num_holders: int = 20) -> List[Tuple[str, int]]:
+        """
+        Get the holders with the largest balances
+
+        :param num_holders: number of holders to return
+        :return: (address, raw integer balance) pairs, largest first
+        """
+        if not self._ranked:
+            self._ranking = sorted((-balance, slot) for slot, balance in enumerate(self._balances)
+                                   if balance > 0)
+            self._ranked = True
+        return [(self._addresses[slot], -balance) for balance, slot in self._ranking[:num_holders]]
@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import record_http_request
+from rate_limiter import RetryPolicy
+
+# Per-upstream request timeouts in seconds (connect, read)
+TIMEOUTS = {
+    'uniswap': (3.05, 10),
+    'binance': (3.05, 5),
+    'bybit': (3.05, 5),
+}
+DEFAULT_TIMEOUT = (3.05, 10)
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name: str, pool_maxsize: int = 32) -> requests.Session:
+    """
+    Get the shared keep-alive session for an upstream
+
+    Sessions are created once per upstream name and reuse pooled
+    connections, so only the first request to an upstream pays for the
+    TCP and TLS handshakes.
+
+    :param name: upstream name, e.g. an exchange from EXCHANGES
+    :param pool_maxsize: maximum number of pooled connections per host
+    :return: shared requests session
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[name] = session
+        return session
+
+
+def get_timeout(name: str):
+    """
+    Get the request timeout configured for an upstream
+
+    :param name: upstream name
+    :return: (connect, read) timeout in seconds
+    """
+    return TIMEOUTS.get(name, DEFAULT_TIMEOUT)
+
+
+def request(name: str, method: str, url: str, max_retries: int = 5, **kwargs: Any) -> requests.Response:
+    """
+    Send a request to an upstream through its shared session and rate limiter
+
+    Throttled (429/503), failed (5xx) and dropped requests are retried up
+    to ``max_retries`` times as RetryPolicy decides. Every attempt and
+    retry is recorded in the metrics of the upstream.
+
+    :param name: upstream name, e.g. an exchange from EXCHANGES
+    :param method: HTTP method
+    :param url: request URL
+    :param max_retries: number of retries before giving up
+    :param kwargs: options passed to requests, the upstream timeout is used by default
+    :return: successful response
+    """
+    kwargs.setdefault('timeout', get_timeout(name))
+    session = get_session(name)
+    retry = RetryPolicy(name, max_retries)
+    while True:
+        time.sleep(retry.reserve())
+        started_at = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_http_request(name, type(e).__name__, time.perf_counter() - started_at, 0, 0)
+            delay = retry.on_error(e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        record_http_request(name, response.status_code, time.perf_counter() - started_at,
+                            len(response.request.body or b''), len(response.content))
+        delay = retry.on_response(response.status_code, response.headers)
+        if delay is None:
+            break
+        time.sleep(delay)
+    response.raise_for_status()
+    retry.on_success()
+    return response
+
+
+def close_sessions() -> None:
+    """
+    Close every shared session and its pooled connections
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
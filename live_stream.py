@@ -0,0 +1,282 @@
+import asyncio
+import inspect
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
+
+import websockets
+from web3 import Web3
+
+from async_client import AsyncEthereumClient, format_log
+from chain_store import REORG_DEPTH
+from ethereum_transactions import TOKEN_ADDRESSES
+from log_scanner import TRANSFER_TOPIC
+from transfers import decode_transfer_log
+from wallet_history import _log_key, wallet_topic_filters
+
+logger = logging.getLogger(__name__)
+
+TransferCallback = Callable[[Dict[str, Any]], Union[None, Awaitable[None]]]
+
+
+def _header(block: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'number': int(block['number'], 16),
+        'hash': block['hash'],
+        'parentHash': block['parentHash'],
+        'timestamp': int(block['timestamp'], 16),
+    }
+
+
+class TransferStream:
+    """
+    Live stream of the Transfer events of a token set and wallet set
+
+    New heads come from a WebSocket ``eth_subscribe`` newHeads subscription
+    when ``ws_uri`` is given, and from polling the latest block over HTTP
+    otherwise or while the WebSocket is down. The Transfer logs of every
+    new block are fetched by block hash, decoded and pushed to the
+    registered callbacks and async iterators within about a block time.
+
+    The hashes of the last ``reorg_depth`` blocks are kept. Before the
+    blocks up to a new head are fetched, the parent hash of the canonical
+    block after the last processed one is checked against them. When it
+    does not match, even across several blocks, the stream walks back to
+    the common ancestor and emits a retraction, the original event with
+    ``removed`` set to True, for every transfer of the abandoned blocks,
+    then fetches the new chain from there. Logs of a block range are
+    checked against the canonical hash of each of the last ``reorg_depth``
+    blocks.
+    """
+
+    def __init__(self,
+                 client: AsyncEthereumClient,
+                 ws_uri: Optional[str] = None,
+                 token_addresses: Optional[List[str]] = None,
+                 wallet_addresses: Optional[List[str]] = None,
+                 from_block: Optional[int] = None,
+                 reorg_depth: int = REORG_DEPTH,
+                 poll_interval: float = 4.0,
+                 ws_retry_interval: float = 30.0,
+                 max_queue_size: int = 10000) -> None:
+        self.client = client
+        self.ws_uri = ws_uri
+        self.token_addresses = [Web3.toChecksumAddress(token_address)
+                                for token_address in (token_addresses or TOKEN_ADDRESSES)]
+        self.wallet_addresses = list(wallet_addresses or [])
+        self.block_number = None if from_block is None else from_block - 1
+        self.reorg_depth = reorg_depth
+        self.poll_interval = poll_interval
+        self.ws_retry_interval = ws_retry_interval
+        self.max_queue_size = max_queue_size
+        self.retractions = 0
+        self._hashes: 'OrderedDict[int, str]' = OrderedDict()
+        self._emitted: Dict[int, List[Dict[str, Any]]] = {}
+        self._callbacks: List[TransferCallback] = []
+        self._queues: List[asyncio.Queue] = []
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def add_callback(self, callback: TransferCallback) -> None:
+        """
+        Call a function, or await a coroutine function, with every event
+
+        :param callback: function taking a decoded transfer with a 'removed' field
+        """
+        self._callbacks.append(callback)
+
+    async def __aenter__(self) -> 'TransferStream':
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    def __aiter__(self) -> AsyncIterator[Dict[str, Any]]:
+        return self.events()
+
+    def start(self) -> asyncio.Task:
+        """
+        Run the stream in a background task
+
+        :return: the task running the stream
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """
+        Stop the background task and end the async iterators
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in self._queues:
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+    async def events(self) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Iterate over the events emitted from now on
+
+        :return: async generator of decoded transfers with a 'removed' field
+        """
+        queue: asyncio.Queue = asyncio.Queue(self.max_queue_size)
+        self._queues.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._queues.remove(queue)
+
+    async def run(self) -> None:
+        """
+        Follow the chain until cancelled, over the WebSocket when possible
+        """
+        self._lock = asyncio.Lock()
+        while True:
+            if self.ws_uri is not None:
+                try:
+                    await self._follow_subscription()
+                except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                    logger.warning('newHeads subscription failed, polling over HTTP: %s', e)
+            try:
+                await asyncio.wait_for(self._follow_polling(), self.ws_retry_interval if self.ws_uri else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _follow_subscription(self) -> None:
+        async with websockets.connect(self.ws_uri) as websocket:
+            await websocket.send(json.dumps({
+                'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads'],
+            }))
+            response = json.loads(await websocket.recv())
+            if 'error' in response:
+                raise websockets.exceptions.InvalidMessage(str(response['error']))
+            subscription = response['result']
+            # Catch up on the blocks mined before the subscription started
+            await self.advance(await self.client.get_header('latest'))
+            async for message in websocket:
+                notification = json.loads(message)
+                params = notification.get('params') or {}
+                if params.get('subscription') == subscription:
+                    await self.advance(_header(params['result']))
+
+    async def _follow_polling(self) -> None:
+        while True:
+            head = await self.client.get_header('latest')
+            if head['hash'] != self._hashes.get(head['number']):
+                await self.advance(head)
+            await asyncio.sleep(self.poll_interval)
+
+    async def advance(self, head: Dict[str, Any]) -> None:
+        """
+        Process a new head, emitting retractions and the transfers of every block up to it
+
+        :param head: header with 'number', 'hash', 'parentHash' and 'timestamp'
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.block_number is None:
+                self.block_number = head['number'] - 1
+            if head['number'] <= self.block_number and self._hashes.get(head['number'], head['hash']) == head['hash']:
+                # Already processed, or older than the kept hashes
+                return
+            await self._reconcile(head)
+            logs = await self._fetch(head)
+            transfers = await self.client.decode_transfers(logs)
+            for transfer, log in zip(transfers, logs):
+                transfer['block_hash'] = log['blockHash']
+                transfer['removed'] = False
+                self._emitted.setdefault(transfer['block_number'], []).append(transfer)
+                await self._emit(transfer)
+            self.block_number = head['number']
+            self._prune()
+
+    async def _reconcile(self, head: Dict[str, Any]) -> None:
+        # The canonical block after the last processed one, or the head when it replaces a processed block
+        number = min(head['number'], self.block_number + 1)
+        child = head if number == head['number'] else await self.client.get_header(number)
+        # Walk back until the parent of the canonical block is the recorded one, blocks
+        # older than the kept hashes are final
+        ancestor = number - 1
+        while ancestor in self._hashes and self._hashes[ancestor] != child['parentHash']:
+            child = await self.client.get_header(ancestor)
+            ancestor -= 1
+        if ancestor >= self.block_number:
+            return
+        for number in sorted(self._emitted, reverse=True):
+            if number <= ancestor:
+                break
+            for transfer in reversed(self._emitted.pop(number)):
+                self.retractions += 1
+                await self._emit(dict(transfer, removed=True))
+        for number in [number for number in self._hashes if number > ancestor]:
+            del self._hashes[number]
+        self.block_number = ancestor
+
+    async def _fetch(self, head: Dict[str, Any]) -> List[Dict]:
+        if head['number'] == self.block_number + 1:
+            self._hashes[head['number']] = head['hash']
+            self.client.block_cache.update({head['number']: head['timestamp']})
+            return await self._get_logs({'blockHash': head['hash']})
+        logs = await self._get_logs({'fromBlock': hex(self.block_number + 1), 'toBlock': hex(head['number'])})
+        # Logs of a range may come from another fork than the canonical blocks that can still change
+        first = max(self.block_number + 1, head['number'] - self.reorg_depth)
+        headers = await asyncio.gather(*(self.client.get_header(number) for number in range(first, head['number'])))
+        headers.append(head)
+        hashes = {header['number']: header['hash'] for header in headers}
+        self._hashes.update(hashes)
+        self._hashes = OrderedDict(sorted(self._hashes.items()))
+        self.client.block_cache.update({header['number']: header['timestamp'] for header in headers})
+        stale = sorted({log['blockNumber'] for log in logs
+                        if hashes.get(log['blockNumber'], log['blockHash']) != log['blockHash']})
+        if stale:
+            refetched = await asyncio.gather(*(self._get_logs({'blockHash': hashes[number]}) for number in stale))
+            logs = [log for log in logs if log['blockNumber'] not in stale]
+            logs.extend(log for block_logs in refetched for log in block_logs)
+            logs.sort(key=_log_key)
+        return logs
+
+    async def _get_logs(self, block_filter: Dict[str, Any]) -> List[Dict]:
+        filters = wallet_topic_filters(self.wallet_addresses) if self.wallet_addresses else [[TRANSFER_TOPIC]]
+        results = await asyncio.gather(*(
+            self.client.rpc('eth_getLogs', [dict(block_filter, address=self.token_addresses, topics=topics)])
+            for topics in filters))
+        logs = {}
+        for result in results:
+            for log in result:
+                log = format_log(log)
+                if decode_transfer_log(log) is not None and not log.get('removed'):
+                    logs[_log_key(log)] = log
+        return [logs[key] for key in sorted(logs)]
+
+    def _prune(self) -> None:
+        oldest = self.block_number - self.reorg_depth
+        while self._hashes and next(iter(self._hashes)) < oldest:
+            self._hashes.popitem(last=False)
+        for number in [number for number in self._emitted if number < oldest]:
+            del self._emitted[number]
+
+    async def _emit(self, event: Dict[str, Any]) -> None:
+        for callback in self._callbacks:
+            try:
+                result = callback(event)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                logger.exception('Transfer callback failed')
+        for queue in self._queues:
+            await queue.put(event)
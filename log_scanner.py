@@ -0,0 +1,250 @@
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from web3 import Web3
+
+# keccak256('Transfer(address,address,uint256)')
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+
+# Error fragments nodes return when an eth_getLogs range holds too many events
+TOO_MANY_RESULTS_ERRORS = (
+    'more than 10000 results',
+    'query returned more than',
+    'log response size exceeded',
+    'response size exceeded',
+    'too many results',
+    'limit exceeded',
+    'block range is too wide',
+    'query timeout exceeded',
+)
+
+
+def is_too_many_results_error(error: Exception) -> bool:
+    """
+    Check whether an eth_getLogs error means the block range should be split
+
+    :param error: Exception raised by web3 for the request
+    :return: True if retrying with a smaller range can succeed
+    """
+    details = error.args[0] if error.args else error
+    if isinstance(details, dict):
+        if details.get('code') == -32005:
+            return True
+        details = details.get('message', '')
+    message = str(details).lower()
+    return any(fragment in message for fragment in TOO_MANY_RESULTS_ERRORS)
+
+
+def _get_logs(w3: Web3, address: Union[str, List[str]], topics: Sequence[Any],
+              from_block: int, to_block: int) -> List[Dict]:
+    return w3.eth.get_logs({
+        'address': address,
+        'topics': list(topics),
+        'fromBlock': from_block,
+        'toBlock': to_block,
+    })
+
+
+class ChunkPlanner:
+    """
+    Plan the chunks of an adaptive eth_getLogs scan, independently of how they are fetched
+
+    The range is cut into chunks of ``chunk_size`` blocks. A chunk that the
+    node rejects for returning too many results is split in two and the
+    chunk size shrinks with it, chunks that come back with fewer than
+    ``target_results`` logs grow it. Fetched chunks are handed back in
+    block order, and at most ``2 * max_pending`` chunks are in flight or
+    waiting for an earlier one at any time.
+    """
+
+    def __init__(self,
+                 from_block: int,
+                 to_block: int,
+                 max_pending: int = 8,
+                 chunk_size: int = 2000,
+                 min_chunk_size: int = 1,
+                 max_chunk_size: int = 100000,
+                 target_results: int = 5000) -> None:
+        self.to_block = to_block
+        self.max_pending = max_pending
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_results = target_results
+        self.chunk_size = max(min_chunk_size, min(chunk_size, max_chunk_size))
+        self._next_start = from_block
+        self._next_yield = from_block
+        self._ready: Dict[int, Tuple[int, List[Dict]]] = {}
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether every chunk of the range was handed back
+        """
+        return self._next_yield > self.to_block
+
+    def next_chunks(self, pending: int) -> Iterator[Tuple[int, int]]:
+        """
+        Get the chunks to fetch next
+
+        :param pending: number of chunks being fetched
+        :return: generator of (first block, last block) ranges, each to be fetched
+        """
+        while (self._next_start <= self.to_block
+               and pending < self.max_pending
+               and pending + len(self._ready) < 2 * self.max_pending):
+            end = min(self._next_start + self.chunk_size - 1, self.to_block)
+            yield self._next_start, end
+            self._next_start = end + 1
+            pending += 1
+
+    def split(self, start: int, end: int, error: Exception) -> List[Tuple[int, int]]:
+        """
+        Split a chunk the node rejected
+
+        :param start: first block of the chunk
+        :param end: last block of the chunk
+        :param error: exception raised for the chunk
+        :return: the two halves to fetch instead
+        :raises: the error when splitting the chunk cannot help
+        """
+        if end <= start or not is_too_many_results_error(error):
+            raise error
+        middle = (start + end) // 2
+        self.chunk_size = max(self.min_chunk_size, min(self.chunk_size, end - start + 1) // 2)
+        return [(start, middle), (middle + 1, end)]
+
+    def add(self, start: int, end: int, logs: List[Dict]) -> None:
+        """
+        Record the logs of a fetched chunk
+
+        :param start: first block of the chunk
+        :param end: last block of the chunk
+        :param logs: log entries with integer block numbers and log indexes
+        """
+        self._ready[start] = (end, logs)
+        if len(logs) < self.target_results // 2:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size * 2)
+
+    def pop_ready(self) -> Iterator[List[Dict]]:
+        """
+        Hand back the fetched chunks that continue the range
+
+        :return: generator of chunks in block order, each sorted by (block number, log index)
+        """
+        while self._next_yield in self._ready:
+            end, logs = self._ready.pop(self._next_yield)
+            logs.sort(key=lambda log: (log['blockNumber'], log['logIndex']))
+            yield logs
+            self._next_yield = end + 1
+
+
+def scan_logs(w3: Web3,
+              address: Union[str, List[str]],
+              topics: Sequence[Any],
+              from_block: int = 0,
+              to_block: Union[int, str] = 'latest',
+              max_workers: int = 8,
+              chunk_size: int = 2000,
+              min_chunk_size: int = 1,
+              max_chunk_size: int = 100000,
+              target_results: int = 5000,
+              executor: Optional[Executor] = None) -> Iterator[Dict]:
+    """
+    Scan a block range for logs in adaptive chunks fetched over a worker pool
+
+    The range is split into chunks, planned by a ChunkPlanner, that are
+    fetched concurrently. Logs are yielded in (block number, log index)
+    order, and at most ``2 * max_workers`` chunks are held in memory at any
+    time. Scans run side by side can share one ``executor`` to bound their
+    threads, otherwise each scan starts a pool of ``max_workers`` threads.
+
+    :param w3: Web3 instance to query
+    :param address: contract address or list of contract addresses
+    :param topics: eth_getLogs topic filter
+    :param from_block: first block of the range
+    :param to_block: last block of the range, or 'latest'
+    :param max_workers: number of chunks fetched concurrently
+    :param chunk_size: initial number of blocks per chunk
+    :param min_chunk_size: smallest chunk size the scan shrinks to
+    :param max_chunk_size: largest chunk size the scan grows to
+    :param target_results: number of logs per chunk the scan aims for
+    :param executor: pool the chunks are fetched on, defaults to a pool of the scan's own
+    :return: generator of raw log entries
+    """
+    if to_block == 'latest':
+        to_block = w3.eth.block_number
+    planner = ChunkPlanner(from_block, to_block, max_workers, chunk_size,
+                           min_chunk_size, max_chunk_size, target_results)
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield from _scan_chunks(w3, address, topics, planner, executor)
+    else:
+        yield from _scan_chunks(w3, address, topics, planner, executor)
+
+
+def _scan_chunks(w3: Web3, address: Union[str, List[str]], topics: Sequence[Any],
+                 planner: ChunkPlanner, executor: Executor) -> Iterator[Dict]:
+    pending = {}
+
+    def submit(start: int, end: int) -> None:
+        future = executor.submit(_get_logs, w3, address, topics, start, end)
+        pending[future] = (start, end)
+
+    try:
+        while not planner.done:
+            for start, end in planner.next_chunks(len(pending)):
+                submit(start, end)
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end = pending.pop(future)
+                try:
+                    logs = future.result()
+                except ValueError as e:
+                    for start, end in planner.split(start, end, e):
+                        submit(start, end)
+                    continue
+                planner.add(start, end, logs)
+
+            for logs in planner.pop_ready():
+                yield from logs
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def scan_transfer_logs(w3: Web3,
+                       token_address: Union[str, List[str]],
+                       from_block: int = 0,
+                       to_block: Union[int, str] = 'latest',
+                       from_address: Optional[str] = None,
+                       to_address: Optional[str] = None,
+                       **kwargs: Any) -> Iterator[Dict]:
+    """
+    Scan a block range for ERC20 Transfer logs
+
+    :param w3: Web3 instance to query
+    :param token_address: token contract address or list of addresses
+    :param from_block: first block of the range
+    :param to_block: last block of the range, or 'latest'
+    :param from_address: only return transfers sent by this address
+    :param to_address: only return transfers received by this address
+    :param kwargs: chunking options passed to scan_logs
+    :return: generator of raw Transfer log entries in block order
+    """
+    topics = [TRANSFER_TOPIC, address_topic(from_address), address_topic(to_address)]
+    while topics[-1] is None:
+        topics.pop()
+    return scan_logs(w3, token_address, topics, from_block, to_block, **kwargs)
+
+
+def address_topic(address: Optional[str]) -> Optional[str]:
+    """
+    Left-pad an address to a 32-byte log topic
+
+    :param address: address to pad, or None for a wildcard topic
+    :return: hex encoded topic
+    """
+    if address is None:
+        return None
+    return '0x' + address.lower().replace('0x', '').rjust(64, '0')
@@ -0,0 +1,465 @@
+import contextvars
+import functools
+import inspect
+import itertools
+import logging
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms, keyed by metric name and labels
+
+    The registry is the default metrics sink. Its values can be read as a
+    plain dictionary with ``snapshot`` or rendered in the Prometheus text
+    exposition format with ``prometheus_text``.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # Per-bucket counts followed by the overflow count, the sum and the total count
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [0.0] * (len(self.buckets) + 3)
+            histogram[bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def reset(self) -> None:
+        """
+        Drop every recorded value
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the current values
+
+        Series are keyed by their Prometheus label string, e.g.
+        ``'{method="eth_getLogs",upstream="infura"}'``, and histograms give
+        their count, sum and cumulative bucket counts.
+
+        :return: dictionary with 'counters' and 'histograms'
+        """
+        with self._lock:
+            counters = {name: {_format_labels(labels): value for labels, value in series.items()}
+                        for name, series in self._counters.items()}
+            histograms = {}
+            for name, series in self._histograms.items():
+                histograms[name] = {}
+                for labels, histogram in series.items():
+                    cumulative = list(itertools.accumulate(histogram[:len(self.buckets) + 1]))
+                    histograms[name][_format_labels(labels)] = {
+                        'count': histogram[-1],
+                        'sum': histogram[-2],
+                        'buckets': dict(zip(self.buckets + (float('inf'),), cumulative)),
+                    }
+        return {'counters': counters, 'histograms': histograms}
+
+    def quantile(self, name: str, q: float, **labels: Any) -> Optional[float]:
+        """
+        Estimate a quantile of a histogram from its buckets
+
+        :param name: histogram name
+        :param q: quantile between 0 and 1
+        :param labels: labels of the series, every series of the name is merged if none are given
+        :return: upper bound of the bucket holding the quantile, or None without observations
+        """
+        key = _labels(labels)
+        with self._lock:
+            series = [histogram for series_labels, histogram in self._histograms.get(name, {}).items()
+                      if not labels or series_labels == key]
+            counts = [sum(values) for values in zip(*series)][:len(self.buckets) + 1] if series else []
+        total = sum(counts)
+        if not total:
+            return None
+        for bound, count in zip(self.buckets + (float('inf'),), itertools.accumulate(counts)):
+            if count >= q * total:
+                return bound
+        return None
+
+    def prometheus_text(self, prefix: str = '') -> str:
+        """
+        Render the values in the Prometheus text exposition format
+
+        :param prefix: prefix added to every metric name
+        :return: exposition text
+        """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f'# TYPE {prefix}{name} counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{prefix}{name}{_format_labels(labels)} {value:g}')
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = itertools.accumulate(histogram[:len(self.buckets) + 1])
+                    for bound, count in zip(self.buckets + (float('inf'),), cumulative):
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(f'{prefix}{name}_bucket{_format_labels(labels, ("le", le))} {count:g}')
+                    lines.append(f'{prefix}{name}_sum{_format_labels(labels)} {histogram[-2]:g}')
+                    lines.append(f'{prefix}{name}_count{_format_labels(labels)} {histogram[-1]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink:
+    """
+    Metrics sink sending every value to a statsd daemon over UDP
+
+    Counters are sent as ``c`` and histograms as ``ms`` timings. Labels are
+    sent as DogStatsD tags when ``tags`` is set, and appended to the metric
+    name otherwise, e.g. ``ethereum_transactions.rpc_calls_total.eth_getLogs.infura``.
+    Sending never blocks or raises, lost packets are lost metrics.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8125, prefix: str = 'ethereum_transactions',
+                 tags: bool = False) -> None:
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags = tags
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name: str, value: str, labels: Dict[str, Any]) -> None:
+        labels = _labels(labels)
+        if self.tags:
+            tags = '|#' + ','.join(f'{key}:{label}' for key, label in labels) if labels else ''
+            packet = f'{self.prefix}.{name}:{value}{tags}'
+        else:
+            path = ''.join('.' + label.replace('.', '_').replace(':', '_') for _, label in labels)
+            packet = f'{self.prefix}.{name}{path}:{value}'
+        try:
+            self._socket.sendto(packet.encode(), self.address)
+        except OSError:
+            pass
+
+    def inc(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        self._send(name, f'{value:g}|c', labels)
+
+    def observe(self, name: str, value: float, labels: Dict[str, Any]) -> None:
+        self._send(name, f'{value * 1000:.3f}|ms', labels)
+
+    def close(self) -> None:
+        self._socket.close()
+
+
+# The in-process registry, always the first sink
+REGISTRY = MetricsRegistry()
+
+_sinks: List[Any] = [REGISTRY]
+_sinks_lock = threading.Lock()
+
+
+def add_sink(sink: Any) -> None:
+    """
+    Send every metric to another sink as well, e.g. a StatsdSink
+
+    :param sink: object with inc(name, value, labels) and observe(name, value, labels) methods
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + [sink]
+
+
+def remove_sink(sink: Any) -> None:
+    """
+    Stop sending metrics to a sink
+
+    :param sink: sink added with add_sink
+    """
+    global _sinks
+    with _sinks_lock:
+        _sinks = [other for other in _sinks if other is not sink]
+
+
+def inc(name: str, value: float = 1.0, **labels: Any) -> None:
+    """
+    Increase a counter
+
+    :param name: counter name, ending in _total
+    :param value: amount to add
+    :param labels: labels of the series
+    """
+    for sink in _sinks:
+        sink.inc(name, value, labels)
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    """
+    Record a value in a histogram
+
+    :param name: histogram name, ending in its unit, e.g. _seconds
+    :param value: observed value
+    :param labels: labels of the series
+    """
+    for sink in _sinks:
+        sink.observe(name, value, labels)
+
+
+@contextmanager
+def timer(name: str, **labels: Any) -> Iterator[None]:
+    """
+    Record the time spent in a block in a histogram
+
+    :param name: histogram name, ending in _seconds
+    :param labels: labels of the series
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started_at, **labels)
+
+
+def record_http_request(upstream: str, status: Any, duration: float, sent: int, received: int) -> None:
+    """
+    Record an HTTP request to an upstream
+
+    :param upstream: upstream name, e.g. 'infura' or an exchange from EXCHANGES
+    :param status: HTTP status, or the name of the error for requests without a response
+    :param duration: seconds until the response body was read
+    :param sent: request body size in bytes
+    :param received: response body size in bytes
+    """
+    inc('http_requests_total', upstream=upstream, status=status)
+    observe('http_request_seconds', duration, upstream=upstream)
+    if sent:
+        inc('http_sent_bytes_total', sent, upstream=upstream)
+    if received:
+        inc('http_received_bytes_total', received, upstream=upstream)
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the current values of the in-process registry, see MetricsRegistry.snapshot
+    """
+    return REGISTRY.snapshot()
+
+
+def prometheus_text(prefix: str = '') -> str:
+    """
+    Render the in-process registry in the Prometheus text exposition format
+
+    :param prefix: prefix added to every metric name
+    :return: exposition text
+    """
+    return REGISTRY.prometheus_text(prefix)
+
+
+def serve_prometheus(port: int = 9100, host: str = '0.0.0.0', prefix: str = '') -> ThreadingHTTPServer:
+    """
+    Serve the in-process registry on /metrics for Prometheus to scrape
+
+    :param port: port to listen on, 0 picks a free one
+    :param host: address to listen on
+    :param prefix: prefix added to every metric name
+    :return: the server, running on a daemon thread until shutdown() is called
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text(prefix).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+_configured: Dict[str, Any] = {}
+
+
+def configure_metrics(config: Dict[str, Any]) -> None:
+    """
+    Set up the sinks of a "metrics" config section, replacing those of a previous config
+
+    ``{"statsd": {"host": ..., "port": ..., "prefix": ..., "tags": ...}}``
+    adds a StatsdSink and ``{"prometheus_port": 9100}`` serves /metrics.
+
+    :param config: the "metrics" section of api_keys.json
+    """
+    with _sinks_lock:
+        statsd = _configured.pop('statsd', None)
+        server = _configured.pop('prometheus', None)
+    if statsd is not None:
+        remove_sink(statsd)
+        statsd.close()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    if config.get('statsd') is not None:
+        statsd = _configured['statsd'] = StatsdSink(**config['statsd'])
+        add_sink(statsd)
+    if config.get('prometheus_port') is not None:
+        _configured['prometheus'] = serve_prometheus(int(config['prometheus_port']))
+
+
+class Span:
+    """
+    A timed high-level call, with the span it was made from as parent
+    """
+
+    def __init__(self, name: str, attributes: Dict[str, Any], parent: Optional['Span']) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else next(_ids)
+        self.span_id = next(_ids)
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f'Span({self.name!r}, duration={self.duration}, error={self.error!r})'
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+_ids = itertools.count(1)
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+_span_listeners: List[Callable[[Span], None]] = []
+
+
+def add_span_listener(listener: Callable[[Span], None]) -> None:
+    """
+    Call a function with every finished span, e.g. to log or export traces
+
+    :param listener: function taking a Span
+    """
+    _span_listeners.append(listener)
+
+
+def remove_span_listener(listener: Callable[[Span], None]) -> None:
+    """
+    Stop calling a span listener
+
+    :param listener: function added with add_span_listener
+    """
+    _span_listeners.remove(listener)
+
+
+def current_span() -> Optional[Span]:
+    """
+    Get the span of the running call, if any
+    """
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """
+    Trace a block as a span
+
+    The duration is recorded in the ``span_seconds`` histogram and the
+    finished span is passed to every span listener. Spans started inside
+    the block, in the same thread or task, get it as parent.
+
+    :param name: span name, e.g. the function name
+    :param attributes: attributes of the span
+    """
+    current = Span(name, attributes, _current_span.get())
+    token = _current_span.set(current)
+    started_at = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.duration = time.perf_counter() - started_at
+        _current_span.reset(token)
+        observe('span_seconds', current.duration, span=name, status='error' if current.error else 'ok')
+        for listener in _span_listeners:
+            try:
+                listener(current)
+            except Exception:
+                logger.exception('Span listener failed')
+
+
+def traced(name: Optional[str] = None) -> Callable[[Callable], Callable]:
+    """
+    Decorator tracing every call of a function or coroutine function as a span
+
+    :param name: span name, the function name by default
+    :return: decorator
+    """
+    def decorator(function: Callable) -> Callable:
+        span_name = name or function.__name__
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(span_name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Tuple, Union
+
+from web3 import Web3
+
+# Multicall3 is deployed at the same address on mainnet and most EVM chains
+MULTICALL3_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+# aggregate3((address target, bool allowFailure, bytes callData)[])
+AGGREGATE3_SELECTOR = bytes.fromhex('82ad56cb')
+
+# balanceOf(address)
+BALANCE_OF_SELECTOR = bytes.fromhex('70a08231')
+
+# ABI encoded size of one Call3 tuple besides its padded call data
+CALL3_OVERHEAD = 32 * 5
+
+
+def _chunk_calls(calls: Sequence[Tuple[str, bytes]], max_calls: int,
+                 max_calldata_size: int) -> List[Sequence[Tuple[str, bytes]]]:
+    chunks = []
+    start = 0
+    size = 0
+    for i, (_, data) in enumerate(calls):
+        call_size = CALL3_OVERHEAD + -(-len(data) // 32) * 32
+        if i > start and (i - start >= max_calls or size + call_size > max_calldata_size):
+            chunks.append(calls[start:i])
+            start = i
+            size = 0
+        size += call_size
+    if start < len(calls):
+        chunks.append(calls[start:])
+    return chunks
+
+
+def _aggregate3_chunk(w3: Web3, calls: Sequence[Tuple[str, bytes]],
+                      block: Union[int, str]) -> List[Tuple[bool, bytes]]:
+    encoded = w3.codec.encode_abi(
+        ['(address,bool,bytes)[]'],
+        [[(Web3.toChecksumAddress(target), True, data) for target, data in calls]]
+    )
+    raw = w3.eth.call({'to': MULTICALL3_ADDRESS, 'data': AGGREGATE3_SELECTOR + encoded},
+                      block_identifier=block)
+    return list(w3.codec.decode_abi(['(bool,bytes)[]'], raw)[0])
+
+
+def aggregate3(w3: Web3,
+               calls: Sequence[Tuple[str, bytes]],
+               block: Union[int, str] = 'latest',
+               max_calls: int = 1000,
+               max_calldata_size: int = 128 * 1024,
+               max_workers: int = 4) -> List[Tuple[bool, bytes]]:
+    """
+    Execute many read-only calls through Multicall3 aggregate3
+
+    Calls are split into chunks of at most ``max_calls`` calls and
+    ``max_calldata_size`` bytes of calldata, which keeps each eth_call under
+    the node's gas and request size limits. Chunks are sent concurrently and
+    individual failing calls do not revert the chunk.
+
+    :param w3: Web3 instance to query
+    :param calls: (target address, call data) pairs
+    :param block: block number or tag the calls are executed at
+    :param max_calls: maximum number of calls per eth_call
+    :param max_calldata_size: maximum calldata bytes per eth_call
+    :param max_workers: number of chunks sent concurrently
+    :return: (success, return data) pairs in the order of the calls
+    """
+    chunks = _chunk_calls(calls, max_calls, max_calldata_size)
+    if len(chunks) <= 1:
+        return [result for chunk in chunks for result in _aggregate3_chunk(w3, chunk, block)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda chunk: _aggregate3_chunk(w3, chunk, block), chunks)
+        return [result for chunk_results in results for result in chunk_results]
+
+
+def balance_of_calldata(wallet_address: str) -> bytes:
+    """
+    Encode an ERC20 balanceOf call
+
+    :param wallet_address: address whose balance is queried
+    :return: call data
+    """
+    return BALANCE_OF_SELECTOR + bytes.fromhex(wallet_address.lower().replace('0x', '').rjust(64, '0'))
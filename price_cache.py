@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+from metrics import inc
+
+
+class PriceCache:
+    """
+    Thread-safe LRU cache of token prices with per-exchange TTLs
+
+    Concurrent lookups of the same (token, exchange) pair that miss the
+    cache share a single in-flight fetch. Failed fetches are not cached.
+    ``get`` fetches in the calling thread, and asyncio callers drive the
+    same cache with ``lookup``, ``put`` and ``fail``, waiting on the
+    returned Future with asyncio.wrap_future.
+    Hit, miss, stale and coalesced lookups are counted, here and in the
+    ``cache_lookups_total`` metric, for tuning TTLs against exchange rate
+    limits.
+    """
+
+    def __init__(self, ttls: Optional[Dict[str, float]] = None, default_ttl: float = 10.0,
+                 maxsize: int = 1024) -> None:
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.maxsize = maxsize
+        self._entries: 'OrderedDict[Tuple[str, str], Tuple[float, float]]' = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, token_address: str, exchange: str, fetch: Callable[[], float]) -> float:
+        """
+        Get a cached price, calling fetch when it is missing or expired
+
+        :param token_address: token the price is for
+        :param exchange: exchange the price comes from
+        :param fetch: function fetching the current price
+        :return: token price
+        """
+        price, future, owner = self.lookup(token_address, exchange)
+        if future is None:
+            return price
+        if not owner:
+            return future.result()
+        try:
+            price = fetch()
+        except Exception as e:
+            self.fail(token_address, exchange, e)
+            raise
+        self.put(token_address, exchange, price)
+        return price
+
+    def lookup(self, token_address: str, exchange: str) -> Tuple[Optional[float], Optional[Future], bool]:
+        """
+        Look a price up, registering a fetch when it is missing or expired
+
+        The caller that gets ``owner`` True must fetch the price and hand it
+        to ``put``, or its error to ``fail``, which resolve the Future every
+        concurrent lookup of the price waits on.
+
+        :param token_address: token the price is for
+        :param exchange: exchange the price comes from
+        :return: (price, None, False) on a hit, else (None, future of the in-flight fetch, owner)
+        """
+        key = (token_address.lower(), exchange)
+        owner = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                result = 'hit'
+            else:
+                future = self._in_flight.get(key)
+                if future is not None:
+                    self.coalesced += 1
+                    result = 'coalesced'
+                else:
+                    if entry is None:
+                        self.misses += 1
+                        result = 'miss'
+                    else:
+                        self.stale += 1
+                        result = 'stale'
+                    future = self._in_flight[key] = Future()
+                    owner = True
+        inc('cache_lookups_total', cache='price', result=result)
+        if result == 'hit':
+            return entry[1], None, False
+        return None, future, owner
+
+    def put(self, token_address: str, exchange: str, price: float) -> None:
+        """
+        Cache the price fetched by the owner of a lookup
+
+        :param token_address: token the price is for
+        :param exchange: exchange the price comes from
+        :param price: fetched price
+        """
+        key = (token_address.lower(), exchange)
+        with self._lock:
+            expires = time.monotonic() + self.ttls.get(exchange, self.default_ttl)
+            self._entries[key] = (expires, price)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            future = self._in_flight.pop(key, None)
+        if future is not None:
+            future.set_result(price)
+
+    def fail(self, token_address: str, exchange: str, error: BaseException) -> None:
+        """
+        Hand the error of the owner's fetch to the concurrent lookups, caching nothing
+
+        :param token_address: token the price is for
+        :param exchange: exchange the price comes from
+        :param error: exception raised by the fetch
+        """
+        with self._lock:
+            future = self._in_flight.pop((token_address.lower(), exchange), None)
+        if future is not None:
+            future.set_exception(error)
+
+    def invalidate(self, token_address: Optional[str] = None, exchange: Optional[str] = None) -> None:
+        """
+        Drop cached prices, optionally only those of a token and/or exchange
+
+        :param token_address: only drop prices of this token
+        :param exchange: only drop prices from this exchange
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if token_address is not None and key[0] != token_address.lower():
+                    continue
+                if exchange is not None and key[1] != exchange:
+                    continue
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the lookup counters of the cache
+
+        :return: dictionary of hits, misses, stale, coalesced and size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'coalesced': self.coalesced,
+                'size': len(self._entries),
+            }
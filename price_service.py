@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from ethereum_transactions import EXCHANGES, TOKEN_ADDRESSES, get_token_price
+from metrics import traced
+
+
+def _fetch_quote(token_address: str, exchange: str) -> Dict[str, Any]:
+    start = time.perf_counter()
+    price = None
+    error = None
+    try:
+        price = get_token_price(token_address, exchange)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    return {
+        'token': token_address,
+        'exchange': exchange,
+        'price': price,
+        'latency': time.perf_counter() - start,
+        'error': error,
+    }
+
+
+@traced()
+def get_price_quotes(token_addresses: Optional[List[str]] = None,
+                     exchanges: Optional[List[str]] = None,
+                     max_workers: Optional[int] = None) -> pd.DataFrame:
+    """
+    Function to get the prices of many tokens from many exchanges concurrently
+
+    Every (token, exchange) quote is requested at the same time over the
+    shared keep-alive session of its exchange, so the total latency is that
+    of the slowest single request. A failing exchange does not fail the
+    others, its error is reported in the table instead.
+
+    :param token_addresses: Tokens to quote, defaults to TOKEN_ADDRESSES
+    :param exchanges: Exchanges to query, defaults to EXCHANGES
+    :param max_workers: Number of concurrent requests, defaults to one per quote
+    :return: DataFrame with token, exchange, price, latency (seconds) and error columns
+    """
+    token_addresses = token_addresses or TOKEN_ADDRESSES
+    exchanges = exchanges or EXCHANGES
+    pairs = [(token_address, exchange) for token_address in token_addresses for exchange in exchanges]
+    with ThreadPoolExecutor(max_workers=max_workers or len(pairs)) as executor:
+        quotes = list(executor.map(lambda pair: _fetch_quote(*pair), pairs))
+    return pd.DataFrame(quotes, columns=['token', 'exchange', 'price', 'latency', 'error'])
+
+
+def price_matrix(quotes: pd.DataFrame) -> pd.DataFrame:
+    """
+    Function to reshape a quote table into a token x exchange price matrix
+
+    :param quotes: Quote table from get_price_quotes
+    :return: DataFrame of prices indexed by token with one column per exchange, NaN where missing
+    """
+    return quotes.pivot(index='token', columns='exchange', values='price').astype(float)
@@ -0,0 +1,250 @@
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from metrics import inc
+
+# Requests per second each upstream starts at, overridden by the "rate_limits"
+# section of api_keys.json, e.g. {"binance": {"rate": 20, "burst": 40}}
+DEFAULT_RATE_LIMITS = {
+    'infura': {'rate': 10.0},
+    'etherscan': {'rate': 5.0},
+    'uniswap': {'rate': 10.0},
+    'binance': {'rate': 20.0},
+    'bybit': {'rate': 10.0},
+}
+DEFAULT_RATE = 10.0
+
+# HTTP statuses that mean the upstream is throttling us
+THROTTLE_STATUSES = (429, 503)
+
+# HTTP statuses worth retrying after a backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter that adapts its rate to the upstream limit
+
+    Each request takes a token from a bucket refilled at ``rate`` tokens per
+    second and holding at most ``burst`` tokens. The rate follows AIMD: it
+    grows by ``increase`` after each ``rate`` successful requests (about
+    ``increase`` per second at full use) and is multiplied by ``decrease``
+    on every throttled response, so it settles just under the real limit
+    of the upstream. A Retry-After delay pauses the bucket until then.
+
+    ``reserve`` never blocks, it returns how long the caller must wait, so
+    threads and coroutines share the same limiter. Limiters with a ``name``
+    count their waits and throttles in the metrics of that upstream.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: Optional[float] = None,
+                 min_rate: Optional[float] = None, max_rate: Optional[float] = None,
+                 increase: float = 1.0, decrease: float = 0.5, name: Optional[str] = None) -> None:
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.min_rate = float(min_rate if min_rate is not None else min(rate, 0.5))
+        self.max_rate = float(max_rate if max_rate is not None else rate * 4)
+        self.increase = increase
+        self.decrease = decrease
+        self.name = name
+        self.throttled = 0
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if now > self._updated_at:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """
+        Take tokens from the bucket, going into debt if it is empty
+
+        A batch larger than the burst size is charged in full, so the bucket
+        goes as far into debt as the batch needs and the caller waits until
+        the rate has paid it back.
+
+        :param tokens: number of requests to reserve
+        :return: seconds to wait before sending the requests
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= tokens
+            delay = max(-self._tokens / self.rate if self._tokens < 0 else 0.0, self._paused_until - now)
+        if delay > 0 and self.name is not None:
+            inc('rate_limit_wait_seconds_total', delay, upstream=self.name)
+        return delay
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """
+        Wait until the requests may be sent
+
+        :param tokens: number of requests to send
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self, tokens: float = 1.0) -> None:
+        """
+        Record requests the upstream accepted
+
+        :param tokens: number of requests accepted
+        """
+        with self._lock:
+            self._successes += tokens
+            if self._successes >= self.rate:
+                self._successes = 0
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        """
+        Record a request the upstream throttled
+
+        :param retry_after: seconds the upstream asked us to wait, if any
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled += 1
+            self._successes = 0
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+        if self.name is not None:
+            inc('rate_limit_throttled_total', upstream=self.name)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """
+    Get a jittered exponential backoff delay
+
+    Full jitter spreads the retries of concurrent callers so they do not hit
+    the upstream again at the same moment.
+
+    :param attempt: number of the retry, starting at 0
+    :param base: delay of the first retry before jitter, in seconds
+    :param cap: largest delay before jitter, in seconds
+    :return: seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(headers: Any) -> Optional[float]:
+    """
+    Read a Retry-After header given in seconds
+
+    :param headers: response headers
+    :return: seconds to wait, or None if the header is missing or a date
+    """
+    value = headers.get('Retry-After') if headers is not None else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Rate limiting and retries of one request to an upstream
+
+    Shared by the blocking and asyncio clients, which do the waiting
+    themselves: every method returns how long to wait. Throttled (429/503),
+    failed (5xx) and dropped requests are retried up to ``max_retries``
+    times after a jittered exponential backoff, or after the Retry-After
+    delay when the upstream sends one, and throttled responses also lower
+    the rate of the upstream's limiter. Retries are counted in the metrics
+    of the upstream.
+    """
+
+    def __init__(self, name: str, max_retries: int = 5, tokens: float = 1.0) -> None:
+        self.name = name
+        self.max_retries = max_retries
+        self.tokens = tokens
+        self.limiter = get_rate_limiter(name)
+        self.attempt = 0
+
+    def reserve(self) -> float:
+        """
+        Reserve the next attempt in the rate limiter of the upstream
+
+        :return: seconds to wait before sending it
+        """
+        return self.limiter.reserve(self.tokens)
+
+    def on_error(self, error: Exception) -> Optional[float]:
+        """
+        Record an attempt that got no response
+
+        :param error: connection error or timeout of the attempt
+        :return: seconds to wait before retrying, None when out of retries
+        """
+        if self.attempt == self.max_retries:
+            return None
+        inc('http_retries_total', upstream=self.name, reason=type(error).__name__)
+        delay = backoff_delay(self.attempt)
+        self.attempt += 1
+        return delay
+
+    def on_response(self, status: int, headers: Any) -> Optional[float]:
+        """
+        Record the response of an attempt
+
+        :param status: HTTP status of the response
+        :param headers: response headers
+        :return: seconds to wait before retrying, None when the response is final
+        """
+        retry_after = None
+        if status in THROTTLE_STATUSES:
+            retry_after = retry_after_seconds(headers)
+            self.limiter.on_throttle(retry_after)
+        if status not in RETRY_STATUSES or self.attempt == self.max_retries:
+            return None
+        inc('http_retries_total', upstream=self.name, reason=status)
+        delay = max(backoff_delay(self.attempt), retry_after or 0.0)
+        self.attempt += 1
+        return delay
+
+    def on_success(self) -> None:
+        """
+        Record that the upstream accepted the request
+        """
+        self.limiter.on_success(self.tokens)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limits: Dict[str, Dict[str, float]] = {name: dict(limits) for name, limits in DEFAULT_RATE_LIMITS.items()}
+_limiters_lock = threading.Lock()
+
+
+def configure_rate_limits(rate_limits: Dict[str, Dict[str, float]]) -> None:
+    """
+    Set the limiter options of upstreams, replacing their current limiters
+
+    :param rate_limits: dictionary mapping upstream names to RateLimiter keyword arguments
+    """
+    with _limiters_lock:
+        for name, limits in rate_limits.items():
+            _limits[name] = dict(limits)
+            _limiters.pop(name, None)
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """
+    Get the shared rate limiter of an upstream
+
+    :param name: upstream name, e.g. 'infura' or an exchange from EXCHANGES
+    :return: shared rate limiter
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter(name=name, **_limits.get(name, {'rate': DEFAULT_RATE}))
+        return limiter
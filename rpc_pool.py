@@ -0,0 +1,344 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from urllib.parse import urlparse
+
+from web3.providers.base import JSONBaseProvider
+
+from batch_provider import BatchHTTPProvider
+from metrics import inc
+
+# Used when no RPC endpoint is configured in api_keys.json
+DEFAULT_RPC_ENDPOINTS = ['https://mainnet.infura.io/v3/your-infura-api-key']
+
+# Methods that must not be sent twice at the same time
+NON_HEDGED_METHODS = ('eth_sendRawTransaction', 'eth_sendTransaction')
+
+
+def upstream_name(endpoint_uri: str) -> str:
+    """
+    Get the rate limiter name of an RPC endpoint from its host, e.g. 'infura'
+
+    :param endpoint_uri: endpoint URL
+    :return: upstream name
+    """
+    host = urlparse(endpoint_uri).hostname or endpoint_uri
+    parts = host.split('.')
+    if len(parts) < 2 or host.replace('.', '').isdigit():
+        return host
+    return parts[-2]
+
+
+class RPCEndpoint:
+    """
+    A provider with running latency and error statistics
+
+    Latency and error rate are exponentially weighted moving averages, and
+    the latencies of the last ``window`` requests give the p95 used to
+    decide when a slow request gets hedged.
+    """
+
+    def __init__(self, provider: Any, upstream: str, alpha: float = 0.2, window: int = 256,
+                 error_penalty: float = 1.0, error_half_life: float = 30.0) -> None:
+        self.provider = provider
+        self.upstream = upstream
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.error_half_life = error_half_life
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self._error_at = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self._latencies: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'RPCEndpoint({self.upstream!r}, latency={self.latency}, error_rate={self.error_rate:.3f})'
+
+    def start(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+        return time.monotonic()
+
+    def finish(self, started_at: float, ok: Optional[bool]) -> None:
+        # ok is None for abandoned requests, which say nothing about the endpoint
+        latency = time.monotonic() - started_at
+        with self._lock:
+            self.in_flight -= 1
+            if ok is None:
+                return
+            self.error_rate = self._decayed_error_rate(started_at + latency)
+            self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+            self._error_at = started_at + latency
+            if ok:
+                self._latencies.append(latency)
+                self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+            else:
+                self.errors += 1
+
+    def _decayed_error_rate(self, now: float) -> float:
+        # Errors fade while an endpoint is not used, so a recovered one gets tried again
+        return self.error_rate * 0.5 ** ((now - self._error_at) / self.error_half_life)
+
+    def score(self) -> float:
+        """
+        Expected cost of sending the next request here, lower is better
+
+        Each recent error costs ``error_penalty`` seconds, and endpoints
+        without a successful request yet are assumed instant so each is tried.
+        """
+        latency = self.latency or 0.0
+        error_rate = self._decayed_error_rate(time.monotonic())
+        return (latency + error_rate * self.error_penalty) * (1 + self.in_flight)
+
+    def quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        """
+        Get a quantile of the recent latencies
+
+        :param q: quantile between 0 and 1
+        :param min_samples: number of samples needed for an estimate
+        :return: latency in seconds, or None with too few samples
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'upstream': self.upstream,
+            'latency': self.latency,
+            'p95': self.quantile(0.95),
+            'error_rate': self._decayed_error_rate(time.monotonic()),
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+
+def rank_endpoints(endpoints: Sequence[RPCEndpoint]) -> List[RPCEndpoint]:
+    """
+    Order endpoints by score, least loaded and fastest first
+
+    :param endpoints: endpoints of a pool
+    :return: endpoints in the order they should be tried
+    """
+    return sorted(endpoints, key=RPCEndpoint.score)
+
+
+class HedgedCall:
+    """
+    Endpoint choice of one request to a pool, independently of how it is sent
+
+    The request goes to the best ranked endpoint first. ``hedge_delay`` is
+    how much longer to wait for it before ``on_timeout`` picks the endpoint
+    of a duplicate, counted from the start of the request so failovers do
+    not push the hedge back, and ``on_error`` picks the endpoint to fail
+    over to.
+    RPCPoolProvider drives it from a thread pool and AsyncEthereumClient
+    from an event loop.
+    """
+
+    def __init__(self, endpoints: Sequence[RPCEndpoint], hedge: bool = True,
+                 hedge_quantile: float = 0.95, min_hedge_delay: float = 0.05) -> None:
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.error: Optional[Exception] = None
+        self.started_at = time.monotonic()
+        self._candidates = iter(rank_endpoints(endpoints))
+
+    def next_endpoint(self) -> Optional[RPCEndpoint]:
+        """
+        Get the next endpoint to send the request to
+
+        :return: endpoint, or None when every endpoint was tried
+        """
+        return next(self._candidates, None)
+
+    def hedge_delay(self, in_flight: Sequence[RPCEndpoint]) -> Optional[float]:
+        """
+        Get how long to wait for the requests in flight before hedging
+
+        :param in_flight: endpoints the request is running on, oldest first
+        :return: seconds left to wait, None to wait for a response
+        """
+        if not self.hedge or not in_flight:
+            return None
+        delay = in_flight[0].quantile(self.hedge_quantile)
+        if delay is None:
+            return None
+        return max(0.0, max(self.min_hedge_delay, delay) - (time.monotonic() - self.started_at))
+
+    def on_timeout(self) -> Optional[RPCEndpoint]:
+        """
+        Pick the endpoint of a duplicate once the hedge delay ran out
+
+        :return: endpoint to send the duplicate to, or None
+        """
+        # Only one duplicate per request, so a slow pool is not flooded
+        self.hedge = False
+        endpoint = self.next_endpoint()
+        if endpoint is not None:
+            inc('rpc_hedged_total')
+        return endpoint
+
+    def on_error(self, endpoint: RPCEndpoint, error: Exception) -> Optional[RPCEndpoint]:
+        """
+        Pick the endpoint to fail over to after a transport error
+
+        :param endpoint: endpoint that failed
+        :param error: exception raised for the request
+        :return: endpoint to send the request to, or None
+        """
+        # A failed hedge is replaced too rather than waiting on a slow primary
+        self.error = error
+        inc('rpc_failovers_total', upstream=endpoint.upstream)
+        return self.next_endpoint()
+
+    def failure(self) -> Exception:
+        """
+        Get the exception to raise once no endpoint is left
+
+        :return: the last transport error
+        """
+        return self.error or ValueError('no RPC endpoints configured')
+
+
+class RPCPoolProvider(JSONBaseProvider):
+    """
+    Provider that spreads requests over several RPC endpoints
+
+    Each request goes to the endpoint with the best score, which weighs its
+    latency EWMA by its error EWMA and its requests in flight, so load
+    shifts away from slow, failing or busy endpoints. A request still
+    running after the p95 latency of its endpoint is hedged: a duplicate is
+    sent to the next endpoint and the first response wins. A request that
+    fails with a transport error fails over to the next endpoint. JSON-RPC
+    error responses are returned as they are, since every node would give
+    the same answer.
+
+    Every endpoint is a BatchHTTPProvider, so concurrent requests to the
+    same endpoint are still coalesced into batches. Each request waits for
+    its batch on a thread of the pool, so ``max_workers`` caps how many
+    requests a batch can gather; it defaults to twice ``max_batch_size``,
+    enough to fill one batch while the previous one is sent. With several
+    endpoints a failing post is not retried on the same endpoint but failed
+    over.
+    """
+
+    def __init__(self,
+                 endpoints: Sequence[Union[str, Dict[str, Any]]],
+                 hedge_quantile: float = 0.95,
+                 min_hedge_delay: float = 0.05,
+                 max_workers: Optional[int] = None,
+                 **provider_kwargs: Any) -> None:
+        super().__init__()
+        if not endpoints:
+            raise ValueError('At least one RPC endpoint is required')
+        if len(endpoints) > 1:
+            provider_kwargs.setdefault('max_retries', 0)
+        self.endpoints = []
+        for endpoint in endpoints:
+            if isinstance(endpoint, str):
+                endpoint = {'url': endpoint}
+            upstream = endpoint.get('upstream') or upstream_name(endpoint['url'])
+            provider = BatchHTTPProvider(endpoint['url'], upstream=upstream, **provider_kwargs)
+            self.endpoints.append(RPCEndpoint(provider, upstream))
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.hedged = 0
+        if max_workers is None:
+            max_workers = 2 * max(endpoint.provider.max_batch_size for endpoint in self.endpoints)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='rpc-pool')
+
+    def __str__(self) -> str:
+        return 'RPC pool of {0} endpoints'.format(len(self.endpoints))
+
+    def _timed(self, endpoint: RPCEndpoint, call: Callable[[Any], Any], settled: threading.Event) -> Any:
+        # Requests still running once another one answered are recorded as abandoned
+        started_at = endpoint.start()
+        try:
+            result = call(endpoint.provider)
+        except Exception:
+            endpoint.finish(started_at, ok=None if settled.is_set() else False)
+            raise
+        endpoint.finish(started_at, ok=None if settled.is_set() else True)
+        return result
+
+    def _execute(self, call: Callable[[Any], Any], hedge: bool = True) -> Any:
+        plan = HedgedCall(self.endpoints, hedge, self.hedge_quantile, self.min_hedge_delay)
+        settled = threading.Event()
+        futures = {}
+
+        def launch(endpoint: Optional[RPCEndpoint]) -> None:
+            if endpoint is not None:
+                futures[self._executor.submit(self._timed, endpoint, call, settled)] = endpoint
+
+        launch(plan.next_endpoint())
+        try:
+            while futures:
+                done, _ = wait(futures, plan.hedge_delay(list(futures.values())), return_when=FIRST_COMPLETED)
+                if not done:
+                    endpoint = plan.on_timeout()
+                    if endpoint is not None:
+                        self.hedged += 1
+                    launch(endpoint)
+                    continue
+                for future in done:
+                    endpoint = futures.pop(future)
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        launch(plan.on_error(endpoint, e))
+            raise plan.failure()
+        finally:
+            settled.set()
+
+    def make_request(self, method: str, params: Any) -> Dict[str, Any]:
+        return self._execute(lambda provider: provider.make_request(method, params),
+                             hedge=method not in NON_HEDGED_METHODS)
+
+    def make_batch_request(self, calls: Sequence[Tuple[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Send several requests at once to one endpoint, see BatchHTTPProvider.make_batch_request
+
+        :param calls: (method, params) pairs
+        :return: raw JSON-RPC responses in the order of the calls
+        """
+        hedge = not any(method in NON_HEDGED_METHODS for method, _ in calls)
+        return self._execute(lambda provider: provider.make_batch_request(calls), hedge)
+
+    def isConnected(self) -> bool:
+        return any(endpoint.provider.isConnected() for endpoint in self.endpoints)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        Get the statistics of every endpoint
+
+        :return: list of per-endpoint dictionaries
+        """
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+
+def rpc_endpoints(config: Dict[str, Any]) -> List[Union[str, Dict[str, Any]]]:
+    """
+    Get the RPC endpoints of a config
+
+    Endpoints are read from "rpc_endpoints", a list of URLs or of
+    {"url": ..., "upstream": ...} objects, falling back to the "infura" URL.
+
+    :param config: parsed api_keys.json
+    :return: list of endpoints
+    """
+    if config.get('rpc_endpoints'):
+        return list(config['rpc_endpoints'])
+    if config.get('infura'):
+        return [config['infura']]
+    return list(DEFAULT_RPC_ENDPOINTS)
@@ -1,45 +1,63 @@
-import requests
-import json
-from web3 import Web3
+from typing import List, Union
 
-# Replace with the token address you want to monitor
-TOKEN_ADDRESS = '0x3845badAde8e6dFF049820680d1F14bD3903a5d0'
-
-# API endpoints for getting token balances
-UNISWAP_API = f'https://api.thegraph.com/subgraphs/name/uniswap/uniswap-v2?query=\
-{{pairs(where: {{token0: "{TOKEN_ADDRESS}"}}) {{token1Price}}}}'
-
-BYBIT_API = f'https://api.bybit.com/v2/public/tickers?symbol={TOKEN_ADDRESS}USDT'
+import pandas as pd
 
-BINANCE_API = f'https://api.binance.com/api/v3/ticker/price?symbol={TOKEN_ADDRESS}USDT'
+from client import get_web3
+from metrics import traced
+from multicall import aggregate3, balance_of_calldata
+from price_service import get_price_quotes, price_matrix
+from valuation import value_portfolio
 
-# Web3 connection
-w3 = Web3(Web3.HTTPProvider(
-    'https://mainnet.infura.io/v3/your_infura_project_id'))
+# Replace with the token address you want to monitor
+TOKEN_ADDRESS = '0x3845badAde8e6dFF049820680d1F14bD3903a5d0'
 
 # Replace with your Ethereum address
 MY_ADDRESS = '0x1234567890123456789012345678901234567890'
 
-# Get the token balance for the specified address
-token_balance = w3.eth.get_balance(TOKEN_ADDRESS)
-token_balance = token_balance / 10 ** 18
-
-# Get the token prices from different exchanges
-uniswap_price = json.loads(requests.get(UNISWAP_API).text)[
-    'data']['pairs'][0]['token1Price']
-bybit_price = json.loads(requests.get(BYBIT_API).text)[
-    'result'][0]['last_price']
-binance_price = json.loads(requests.get(BINANCE_API).text)['price']
-
-# Calculate the value of the token holdings
-uniswap_value = uniswap_price * token_balance
-bybit_value = bybit_price * token_balance
-binance_value = binance_price * token_balance
-total_value = uniswap_value + bybit_value + binance_value
-
-# Print the token balance and values
-print(f'Token Balance: {token_balance}')
-print(f'Uniswap Price: {uniswap_price} | Uniswap Value: {uniswap_value}')
-print(f'Bybit Price: {bybit_price} | Bybit Value: {bybit_value}')
-print(f'Binance Price: {binance_price} | Binance Value: {binance_value}')
-print(f'Total Value: {total_value}')
+
+@traced()
+def get_token_balances(token_addresses: List[str],
+                       wallet_addresses: List[str],
+                       block: Union[int, str] = 'latest',
+                       max_calls: int = 1000) -> pd.DataFrame:
+    """
+    Function to get the token balances of many wallets in bulk
+
+    All (wallet, token) balanceOf calls are aggregated into Multicall3 calls,
+    so thousands of balances take a handful of eth_calls.
+
+    :param token_addresses: Addresses of the token contracts
+    :param wallet_addresses: Addresses of the wallets
+    :param block: Block number or tag the balances are read at
+    :param max_calls: Maximum number of balanceOf calls per eth_call
+    :return: DataFrame of raw integer balances indexed by wallet with one column per token,
+        None where a balanceOf call failed
+    """
+    calls = [(token_address, balance_of_calldata(wallet_address))
+             for wallet_address in wallet_addresses
+             for token_address in token_addresses]
+    results = aggregate3(get_web3(), calls, block=block, max_calls=max_calls)
+    balances = [int.from_bytes(data[:32], 'big') if success and len(data) >= 32 else None
+                for success, data in results]
+    num_tokens = len(token_addresses)
+    rows = [balances[i:i + num_tokens] for i in range(0, len(balances), num_tokens)]
+    return pd.DataFrame(rows, index=pd.Index(wallet_addresses, name='wallet'),
+                        columns=pd.Index(token_addresses, name='token'), dtype=object)
+
+
+if __name__ == '__main__':
+    # Get the token balance for the specified address
+    balances = get_token_balances([TOKEN_ADDRESS], [MY_ADDRESS])
+    token_balance = balances.iloc[0, 0] / 10 ** 18
+
+    # Get the token prices from all exchanges concurrently
+    quotes = get_price_quotes([TOKEN_ADDRESS])
+    prices = price_matrix(quotes)
+
+    # Print the token balance and its value at each exchange's price
+    print(f'Token Balance: {token_balance}')
+    for exchange, price in prices.loc[TOKEN_ADDRESS].items():
+        print(f'{exchange.capitalize()} Price: {price} | {exchange.capitalize()} Value: {price * token_balance}')
+
+    # The holdings are valued once, at the median price across exchanges
+    print(f'Total Value: {value_portfolio(balances, prices, method="median").total}')
@@ -1,69 +1,155 @@
-import requests
-import json
-import time
-from web3 import Web3
+import sys
+
+from chain_store import sync_token_transfers
+from client import get_client, get_web3
+from export import export_transfers
+from log_scanner import scan_transfer_logs
+from metrics import traced
+from transfer_table import TransferTable
+from transfers import BlockTimestampCache, iter_decoded_transfers, iter_with_transactions
 
 # Define endpoint for Etherscan API
 ETHERSCAN_API_ENDPOINT = 'https://api.etherscan.io/api'
 
-# Load API keys from json file
-with open('api_keys.json') as f:
-    api_keys = json.load(f)
+# Block timestamps shared across scans
+block_timestamps = BlockTimestampCache()
+
+# Config values and the web3 instance, read from the shared client on first access
+_LAZY_GLOBALS = {
+    'api_keys': lambda: get_client().config,
+    'etherscan_api_key': lambda: get_client().api_key('etherscan'),
+    'web3': get_web3,
+    'erc20_abi': lambda: get_client().erc20_abi,
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_GLOBALS:
+        return _LAZY_GLOBALS[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def iter_token_transfers(token_address, from_block=0, to_block='latest', max_workers=8,
+                         include_tx=False, store=None):
+    """
+    Iterate over the decoded Transfer events of a given ERC20 token in block order
+
+    Transfers are decoded from the Transfer logs themselves and block
+    timestamps are fetched once per block. With include_tx the transaction of
+    each transfer is fetched as well. With a store, only blocks past its
+    high-water mark are fetched and the transfers are read back from disk.
+
+    :param token_address: str, the address of the ERC20 token
+    :param from_block: int, first block to scan
+    :param to_block: int or 'latest', last block to scan
+    :param max_workers: int, number of block ranges fetched concurrently
+    :param include_tx: bool, also fetch transaction-level fields
+    :param store: ChainStore, local store to sync and read from
+    :return: generator of decoded transfers
+    """
+    web3 = get_web3()
+    if store is not None:
+        if to_block == 'latest':
+            to_block = web3.eth.block_number
+        sync_token_transfers(web3, store, token_address, from_block, to_block,
+                             max_workers=max_workers)
+        transfers = store.iter_transfers(token_address, from_block, to_block)
+        if include_tx:
+            transfers = iter_with_transactions(web3, transfers)
+        return transfers
+
+    # Scan the Transfer logs in adaptive, concurrently fetched block ranges
+    transfer_logs = scan_transfer_logs(web3, token_address, from_block, to_block,
+                                       max_workers=max_workers)
+    return iter_decoded_transfers(web3, transfer_logs, block_timestamps, include_tx)
+
 
-# Get Etherscan API key
-etherscan_api_key = api_keys['etherscan']
+def iter_token_transactions(token_address, from_block=0, to_block='latest', max_workers=8,
+                            include_tx=False, store=None):
+    """
+    Iterate over all transactions for a given ERC20 token in block order
 
-# Create web3 instance using Infura endpoint
-web3 = Web3(Web3.HTTPProvider(api_keys['infura']))
+    'tx_from', 'tx_to' and 'tx_value' are decoded from the Transfer log itself.
+    With include_tx 'tx_sender', 'tx_recipient' and 'tx_input' are filled from
+    the transaction of each transfer.
 
-# Load ERC20 ABI
-with open('erc20_abi.json') as f:
-    erc20_abi = json.load(f)
+    :param token_address: str, the address of the ERC20 token
+    :param from_block: int, first block to scan
+    :param to_block: int or 'latest', last block to scan
+    :param max_workers: int, number of block ranges fetched concurrently
+    :param include_tx: bool, also fetch transaction-level fields
+    :param store: ChainStore, local store to sync and read from
+    :return: generator of dictionaries containing transaction data
+    """
+    transfers = iter_token_transfers(token_address, from_block, to_block, max_workers,
+                                     include_tx, store)
+    for transfer in transfers:
+        transaction = {
+            'tx_hash': transfer['tx_hash'],
+            'tx_data': transfer['tx_hash'],
+            'tx_from': transfer['from'],
+            'tx_to': transfer['to'],
+            'tx_value': transfer['value'],
+            'timestamp': transfer['timestamp'],
+            'block_number': transfer['block_number'],
+            'log_index': transfer['log_index'],
+            'token_address': token_address
+        }
+        if include_tx:
+            transaction['tx_sender'] = transfer['tx_sender']
+            transaction['tx_recipient'] = transfer['tx_recipient']
+            transaction['tx_input'] = transfer['tx_input']
+        yield transaction
 
 
-def get_token_transactions(token_address):
+@traced()
+def get_token_transactions(token_address, from_block=0, to_block='latest', max_workers=8,
+                           include_tx=False, store=None, as_table=False):
     """
     Get all transactions for a given ERC20 token
 
     :param token_address: str, the address of the ERC20 token
-    :return: list of dictionaries containing transaction data
+    :param from_block: int, first block to scan
+    :param to_block: int or 'latest', last block to scan
+    :param max_workers: int, number of block ranges fetched concurrently
+    :param include_tx: bool, also fetch transaction-level fields
+    :param store: ChainStore, local store to sync and read from
+    :param as_table: bool, return a compact TransferTable instead of dictionaries
+    :return: list of dictionaries containing transaction data, or a TransferTable
+    """
+    if as_table:
+        return TransferTable.from_transfers(iter_token_transfers(token_address, from_block, to_block,
+                                                                 max_workers, store=store))
+    return list(iter_token_transactions(token_address, from_block, to_block, max_workers,
+                                        include_tx, store))
+
+
+@traced()
+def export_token_transactions(token_address, path, from_block=0, to_block='latest',
+                              max_workers=8, store=None, format=None):
+    """
+    Stream all transfers of a given ERC20 token to a Parquet, CSV or JSON Lines file
+
+    :param token_address: str, the address of the ERC20 token
+    :param path: str, file to write
+    :param from_block: int, first block to scan
+    :param to_block: int or 'latest', last block to scan
+    :param max_workers: int, number of block ranges fetched concurrently
+    :param store: ChainStore, local store to sync and read from
+    :param format: str, 'parquet', 'csv' or 'jsonl', inferred from the path by default
+    :return: int, number of transfers written
     """
-    # Get token contract instance
-    token_contract = web3.eth.contract(address=token_address, abi=erc20_abi)
-
-    # Get the number of token transfer events
-    transfer_filter = token_contract.events.Transfer.createFilter(fromBlock=0)
-    transfer_events = transfer_filter.get_all_entries()
-
-    # Get transactions for each transfer event
-    transactions = []
-    for event in transfer_events:
-        tx_hash = event['transactionHash'].hex()
-        tx_receipt = web3.eth.getTransactionReceipt(tx_hash)
-        if tx_receipt is not None:
-            tx_data = tx_receipt['transactionHash'].hex()
-            tx_from = tx_receipt['from']
-            tx_to = tx_receipt['to']
-            tx_value = token_contract.events.Transfer().processReceipt(tx_receipt)[
-                0]['args']['value']
-            timestamp = web3.eth.getBlock(
-                tx_receipt['blockNumber'])['timestamp']
-            transactions.append({
-                'tx_hash': tx_hash,
-                'tx_data': tx_data,
-                'tx_from': tx_from,
-                'tx_to': tx_to,
-                'tx_value': tx_value,
-                'timestamp': timestamp,
-                'token_address': token_address
-            })
-        time.sleep(0.1)
-
-    return transactions
+    transfers = iter_token_transfers(token_address, from_block, to_block, max_workers,
+                                     store=store)
+    return export_transfers(transfers, path, format)
 
 
 if __name__ == '__main__':
-    # Example usage
+    # Example usage: python token_transactions.py [output.parquet|output.csv|output.jsonl]
     token_address = '0x3845badAde8e6dFF049820680d1F14bD3903a5d0'
-    transactions = get_token_transactions(token_address)
-    print(transactions)
+    if len(sys.argv) > 1:
+        count = export_token_transactions(token_address, sys.argv[1])
+        print(f'Wrote {count} transfers to {sys.argv[1]}')
+    else:
+        for transaction in iter_token_transactions(token_address):
+            print(transaction)
@@ -0,0 +1,226 @@
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+from web3 import Web3
+
+from transfers import check_timestamps
+
+# Column dtypes of a TransferTable, about 150 bytes per transfer
+TRANSFER_DTYPES = {
+    'block_number': np.int64,
+    'log_index': np.int32,
+    'transaction_index': np.int32,
+    'timestamp': np.int64,
+    'tx_hash': 'S32',
+    'token': 'S20',
+    'sender': 'S20',
+    'recipient': 'S20',
+    # uint256 amounts as 32-byte big-endian unsigned integers
+    'amount': 'S32',
+}
+
+
+def _hex_bytes(value: str) -> bytes:
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+
+def _chunks(data: bytes, size: int) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def _key(address: str) -> np.bytes_:
+    return np.bytes_(_hex_bytes(address))
+
+
+def _timestamp(value: Union[int, datetime]) -> int:
+    if isinstance(value, datetime):
+        return int((value - datetime(1970, 1, 1, tzinfo=value.tzinfo)).total_seconds())
+    return int(value)
+
+
+class TransferTable:
+    """
+    Struct-of-arrays container of decoded transfers backed by NumPy
+
+    Hashes and addresses are fixed-size byte columns, block numbers and
+    timestamps are int64, and amounts are exact 32-byte big-endian integers.
+    Filters are vectorized and return new tables, and iterating a table
+    yields the same dictionaries as the decoded transfer streams.
+    """
+
+    def __init__(self, columns: Optional[Dict[str, np.ndarray]] = None) -> None:
+        if columns is None:
+            columns = {name: np.empty(0, dtype=dtype) for name, dtype in TRANSFER_DTYPES.items()}
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns['block_number'])
+
+    def __getitem__(self, selection: Any) -> 'TransferTable':
+        return TransferTable({name: column[selection] for name, column in self.columns.items()})
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        columns = self.columns
+        # Byte columns are read from their raw buffers, NumPy strips trailing zero bytes from items
+        tx_hashes = _chunks(columns['tx_hash'].tobytes(), 32)
+        tokens = _chunks(columns['token'].tobytes(), 20)
+        senders = _chunks(columns['sender'].tobytes(), 20)
+        recipients = _chunks(columns['recipient'].tobytes(), 20)
+        amounts = self.amounts()
+        for i in range(len(self)):
+            yield {
+                'token': Web3.toChecksumAddress(tokens[i]),
+                'from': Web3.toChecksumAddress(senders[i]),
+                'to': Web3.toChecksumAddress(recipients[i]),
+                'value': amounts[i],
+                'block_number': int(columns['block_number'][i]),
+                'log_index': int(columns['log_index'][i]),
+                'transaction_index': int(columns['transaction_index'][i]),
+                'tx_hash': '0x' + tx_hashes[i].hex(),
+                'timestamp': int(columns['timestamp'][i]),
+            }
+
+    @classmethod
+    def from_transfers(cls, transfers: Iterable[Dict[str, Any]], chunk_size: int = 65536) -> 'TransferTable':
+        """
+        Build a table from decoded transfers, converting them in chunks
+
+        :param transfers: decoded transfers, e.g. from iter_decoded_transfers or ChainStore.iter_transfers
+        :param chunk_size: number of transfers converted at a time
+        :return: table of the transfers
+        :raises ValueError: if a transfer has no block timestamp
+        """
+        chunks = []
+        rows: List[Dict[str, Any]] = []
+        for transfer in transfers:
+            rows.append(transfer)
+            if len(rows) >= chunk_size:
+                chunks.append(cls._from_rows(rows))
+                rows = []
+        if rows or not chunks:
+            chunks.append(cls._from_rows(rows))
+        return concat(chunks)
+
+    @classmethod
+    def _from_rows(cls, rows: List[Dict[str, Any]]) -> 'TransferTable':
+        check_timestamps(rows)
+
+        def column(name, values):
+            return np.fromiter(values, dtype=TRANSFER_DTYPES[name], count=len(rows))
+        return cls({
+            'block_number': column('block_number', (row['block_number'] for row in rows)),
+            'log_index': column('log_index', (row['log_index'] for row in rows)),
+            'transaction_index': column('transaction_index', (row['transaction_index'] for row in rows)),
+            'timestamp': column('timestamp', (row['timestamp'] for row in rows)),
+            'tx_hash': np.array([_hex_bytes(row['tx_hash']) for row in rows], dtype='S32'),
+            'token': np.array([_hex_bytes(row['token']) for row in rows], dtype='S20'),
+            'sender': np.array([_hex_bytes(row['from']) for row in rows], dtype='S20'),
+            'recipient': np.array([_hex_bytes(row['to']) for row in rows], dtype='S20'),
+            'amount': np.array([row['value'].to_bytes(32, 'big') for row in rows], dtype='S32'),
+        })
+
+    def amounts(self) -> List[int]:
+        """
+        Get the exact amounts as Python integers
+
+        :return: list of raw integer amounts
+        """
+        return [int.from_bytes(amount, 'big') for amount in _chunks(self.columns['amount'].tobytes(), 32)]
+
+    def amounts_float(self, decimals: int = 18) -> np.ndarray:
+        """
+        Get the amounts scaled by the token decimals as float64, vectorized
+
+        :param decimals: number of token decimals
+        :return: array of amounts in whole tokens
+        """
+        limbs = np.frombuffer(self.columns['amount'].tobytes(), dtype='>u8').reshape(-1, 4)
+        weights = np.array([2.0 ** 192, 2.0 ** 128, 2.0 ** 64, 1.0]) / 10.0 ** decimals
+        return limbs.astype(np.float64) @ weights
+
+    def total(self) -> int:
+        """
+        Get the exact sum of the amounts
+
+        :return: raw integer sum
+        """
+        return sum(self.amounts())
+
+    def direction(self, wallet_address: str) -> np.ndarray:
+        """
+        Get the direction of each transfer relative to a wallet
+
+        :param wallet_address: wallet address
+        :return: int8 array, 1 for incoming, -1 for outgoing, 0 otherwise or for self-transfers
+        """
+        key = _key(wallet_address)
+        return ((self.columns['recipient'] == key).astype(np.int8)
+                - (self.columns['sender'] == key).astype(np.int8))
+
+    def for_wallet(self, wallet_address: str, direction: str = 'both') -> 'TransferTable':
+        """
+        Select the transfers of a wallet
+
+        :param wallet_address: wallet address
+        :param direction: 'incoming', 'outgoing' or 'both'
+        :return: table of the selected transfers
+        """
+        key = _key(wallet_address)
+        if direction == 'incoming':
+            mask = self.columns['recipient'] == key
+        elif direction == 'outgoing':
+            mask = self.columns['sender'] == key
+        elif direction == 'both':
+            mask = (self.columns['recipient'] == key) | (self.columns['sender'] == key)
+        else:
+            raise ValueError('Invalid direction provided')
+        return self[mask]
+
+    def for_token(self, token_address: str) -> 'TransferTable':
+        """
+        Select the transfers of a token
+
+        :param token_address: token contract address
+        :return: table of the selected transfers
+        """
+        return self[self.columns['token'] == _key(token_address)]
+
+    def between(self, start: Union[int, datetime, None] = None,
+                end: Union[int, datetime, None] = None) -> 'TransferTable':
+        """
+        Select the transfers within a time window
+
+        :param start: unix timestamp or UTC datetime the window starts at, inclusive
+        :param end: unix timestamp or UTC datetime the window ends at, inclusive
+        :return: table of the selected transfers
+        """
+        timestamps = self.columns['timestamp']
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= _timestamp(start)
+        if end is not None:
+            mask &= timestamps <= _timestamp(end)
+        return self[mask]
+
+    def nbytes(self) -> int:
+        """
+        Get the memory used by the columns
+
+        :return: size in bytes
+        """
+        return sum(column.nbytes for column in self.columns.values())
+
+
+def concat(tables: Iterable[TransferTable]) -> TransferTable:
+    """
+    Concatenate tables in order
+
+    :param tables: tables to concatenate
+    :return: table of all transfers
+    """
+    tables = list(tables)
+    if not tables:
+        return TransferTable()
+    return TransferTable({name: np.concatenate([table.columns[name] for table in tables])
+                          for name in TRANSFER_DTYPES})
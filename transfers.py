@@ -0,0 +1,252 @@
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from web3 import Web3
+
+from batch_provider import batch_results
+from log_scanner import TRANSFER_TOPIC
+from metrics import inc
+
+
+def _to_hex(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    return value if value.startswith('0x') else '0x' + value
+
+
+def decode_transfer_log(log: Dict) -> Optional[Dict[str, Any]]:
+    """
+    Decode an ERC20 Transfer log from its topics and data without any RPC
+
+    :param log: raw log entry as returned by eth_getLogs
+    :return: decoded transfer, or None if the log is not an ERC20 Transfer
+    """
+    topics = [_to_hex(topic).lower() for topic in log['topics']]
+    if len(topics) != 3 or topics[0] != TRANSFER_TOPIC:
+        return None
+    data = _to_hex(log['data'])
+    return {
+        'token': Web3.toChecksumAddress(log['address']),
+        'from': Web3.toChecksumAddress('0x' + topics[1][-40:]),
+        'to': Web3.toChecksumAddress('0x' + topics[2][-40:]),
+        'value': int(data, 16) if len(data) > 2 else 0,
+        'block_number': log['blockNumber'],
+        'log_index': log['logIndex'],
+        'transaction_index': log['transactionIndex'],
+        'tx_hash': _to_hex(log['transactionHash']),
+    }
+
+
+def check_timestamps(transfers: List[Dict[str, Any]]) -> None:
+    """
+    Check that every transfer carries the timestamp of its block
+
+    ChainStore.iter_transfers gives a None timestamp for blocks whose
+    timestamp was never stored.
+
+    :param transfers: decoded transfers
+    :raises ValueError: naming the blocks without a timestamp
+    """
+    missing = sorted({transfer['block_number'] for transfer in transfers if transfer['timestamp'] is None})
+    if missing:
+        raise ValueError(f'Transfers of blocks {missing} have no timestamp, '
+                         f'store their block timestamps before building columns')
+
+
+class BlockTimestampCache:
+    """
+    Thread-safe LRU cache of block timestamps keyed by block number
+
+    Each distinct block is fetched at most once while it stays cached, and
+    missing blocks requested together are fetched concurrently. With a
+    ``store`` (e.g. a ChainStore) timestamps are also read from and written
+    to disk, so they survive between runs.
+    """
+
+    def __init__(self, maxsize: int = 100000, max_workers: int = 8, store: Any = None) -> None:
+        self.maxsize = maxsize
+        self.max_workers = max_workers
+        self.store = store
+        self._timestamps: 'OrderedDict[int, int]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._timestamps)
+
+    def _store(self, block_number: int, timestamp: int) -> None:
+        with self._lock:
+            self._timestamps[block_number] = timestamp
+            self._timestamps.move_to_end(block_number)
+            while len(self._timestamps) > self.maxsize:
+                self._timestamps.popitem(last=False)
+
+    def get(self, w3: Web3, block_number: int) -> int:
+        """
+        Get the timestamp of a block, fetching its header if it is not cached
+
+        :param w3: Web3 instance used on a cache miss
+        :param block_number: number of the block
+        :return: block timestamp in seconds
+        """
+        return self.get_many(w3, [block_number])[block_number]
+
+    def lookup(self, block_numbers: Iterable[int]) -> Tuple[Dict[int, int], List[int]]:
+        """
+        Get the cached timestamps of several blocks without fetching any
+
+        :param block_numbers: numbers of the blocks, duplicates allowed
+        :return: dictionary of the cached timestamps and list of the missing block numbers
+        """
+        timestamps = {}
+        missing = []
+        with self._lock:
+            for block_number in set(block_numbers):
+                if block_number in self._timestamps:
+                    self._timestamps.move_to_end(block_number)
+                    timestamps[block_number] = self._timestamps[block_number]
+                else:
+                    missing.append(block_number)
+        if timestamps:
+            inc('cache_lookups_total', len(timestamps), cache='block_timestamp', result='hit')
+        if missing and self.store is not None:
+            stored = self.store.get_block_timestamps(missing)
+            for block_number, timestamp in stored.items():
+                self._store(block_number, timestamp)
+            timestamps.update(stored)
+            missing = [block_number for block_number in missing if block_number not in stored]
+            if stored:
+                inc('cache_lookups_total', len(stored), cache='block_timestamp', result='store_hit')
+        if missing:
+            inc('cache_lookups_total', len(missing), cache='block_timestamp', result='miss')
+        return timestamps, missing
+
+    def update(self, timestamps: Dict[int, int]) -> None:
+        """
+        Add fetched block timestamps to the cache and its store
+
+        :param timestamps: dictionary mapping block numbers to timestamps
+        """
+        for block_number, timestamp in timestamps.items():
+            self._store(block_number, timestamp)
+        if timestamps and self.store is not None:
+            self.store.add_block_timestamps(timestamps)
+
+    def get_many(self, w3: Web3, block_numbers: Iterable[int]) -> Dict[int, int]:
+        """
+        Get the timestamps of several blocks, fetching each missing block once
+
+        Missing blocks are requested in one JSON-RPC batch when the provider
+        supports it, and concurrently otherwise.
+
+        :param w3: Web3 instance used on cache misses
+        :param block_numbers: numbers of the blocks, duplicates allowed
+        :return: dictionary mapping block numbers to timestamps
+        :raises ValueError: if the node does not know some of the blocks
+        """
+        timestamps, missing = self.lookup(block_numbers)
+        if not missing:
+            return timestamps
+        if len(missing) > 1 and hasattr(w3.provider, 'make_batch_request'):
+            responses = w3.provider.make_batch_request(
+                [('eth_getBlockByNumber', [hex(number), False]) for number in missing])
+            blocks = dict(zip(missing, batch_results(responses)))
+            # Batches answer unknown blocks with null, where get_block raises BlockNotFound
+            unknown = [number for number, block in blocks.items() if block is None]
+            if unknown:
+                raise ValueError(f'Blocks {unknown} were not found, the node may be behind')
+            fetched = {number: int(block['timestamp'], 16) for number, block in blocks.items()}
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                headers = executor.map(w3.eth.get_block, missing)
+                fetched = {number: header['timestamp'] for number, header in zip(missing, headers)}
+        self.update(fetched)
+        timestamps.update(fetched)
+        return timestamps
+
+
+def _get_transactions(w3: Web3, tx_hashes: List[str], max_workers: int) -> Dict[str, Dict]:
+    if hasattr(w3.provider, 'make_batch_request'):
+        responses = w3.provider.make_batch_request(
+            [('eth_getTransactionByHash', [tx_hash]) for tx_hash in tx_hashes])
+        # Raw results carry lowercase addresses, web3 checksums them on the other path
+        return {
+            tx_hash: dict(tx, **{'from': Web3.toChecksumAddress(tx['from']),
+                                 'to': tx['to'] and Web3.toChecksumAddress(tx['to'])})
+            for tx_hash, tx in zip(tx_hashes, batch_results(responses))
+        }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(tx_hashes, executor.map(w3.eth.get_transaction, tx_hashes)))
+
+
+def iter_with_transactions(w3: Web3,
+                           transfers: Iterable[Dict[str, Any]],
+                           batch_size: int = 1000,
+                           max_workers: int = 8) -> Iterator[Dict[str, Any]]:
+    """
+    Add the 'tx_sender', 'tx_recipient' and 'tx_input' fields to transfers
+
+    Transactions are fetched once per distinct hash in each batch.
+
+    :param w3: Web3 instance used for transaction lookups
+    :param transfers: decoded transfers
+    :param batch_size: number of transfers handled per batch
+    :param max_workers: number of concurrent lookups without a batching provider
+    :return: generator of the transfers with transaction fields
+    """
+    transfers = iter(transfers)
+    while True:
+        batch = list(itertools.islice(transfers, batch_size))
+        if not batch:
+            return
+        tx_hashes = list({transfer['tx_hash'] for transfer in batch})
+        transactions = _get_transactions(w3, tx_hashes, max_workers)
+        for transfer in batch:
+            tx = transactions[transfer['tx_hash']]
+            transfer['tx_sender'] = tx['from']
+            transfer['tx_recipient'] = tx['to']
+            transfer['tx_input'] = tx['input']
+            yield transfer
+
+
+def _iter_timestamped(w3: Web3, logs: Iterable[Dict], block_cache: BlockTimestampCache,
+                      batch_size: int) -> Iterator[Dict[str, Any]]:
+    decoded = (decode_transfer_log(log) for log in logs)
+    transfers = (transfer for transfer in decoded if transfer is not None)
+    while True:
+        batch = list(itertools.islice(transfers, batch_size))
+        if not batch:
+            return
+        timestamps = block_cache.get_many(w3, (transfer['block_number'] for transfer in batch))
+        for transfer in batch:
+            transfer['timestamp'] = timestamps[transfer['block_number']]
+            yield transfer
+
+
+def iter_decoded_transfers(w3: Web3,
+                           logs: Iterable[Dict],
+                           block_cache: Optional[BlockTimestampCache] = None,
+                           include_tx: bool = False,
+                           batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """
+    Decode Transfer logs and attach block timestamps in batches
+
+    Timestamps are fetched once per distinct block in each batch. Full
+    transactions are only fetched when ``include_tx`` is set, which adds the
+    'tx_sender', 'tx_recipient' and 'tx_input' fields.
+
+    :param w3: Web3 instance used for block and transaction lookups
+    :param logs: raw Transfer log entries in block order
+    :param block_cache: shared block timestamp cache
+    :param include_tx: also fetch the transaction of each transfer
+    :param batch_size: number of logs decoded per batch
+    :return: generator of decoded transfers with a 'timestamp' field
+    """
+    if block_cache is None:
+        block_cache = BlockTimestampCache()
+    transfers = _iter_timestamped(w3, logs, block_cache, batch_size)
+    if include_tx:
+        transfers = iter_with_transactions(w3, transfers, batch_size, block_cache.max_workers)
+    return transfers
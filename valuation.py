@@ -0,0 +1,107 @@
+from typing import Dict, NamedTuple, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+PRICE_METHODS = ('best_bid', 'median', 'vwap')
+
+
+class PortfolioValue(NamedTuple):
+    values: pd.DataFrame
+    per_wallet: pd.Series
+    per_token: pd.Series
+    total: float
+
+
+def select_prices(prices: pd.DataFrame, method: str = 'median',
+                  volumes: Optional[pd.DataFrame] = None) -> pd.Series:
+    """
+    Function to reduce a token x exchange price matrix to one price per token
+
+    'best_bid' takes the highest quote across exchanges, the best price a
+    seller can get from the quoted prices. 'median' takes the median quote
+    and 'vwap' weights the quotes by the traded volume on each exchange.
+    Missing quotes are ignored.
+
+    :param prices: Prices indexed by token with one column per exchange, e.g. from price_matrix
+    :param method: 'best_bid', 'median' or 'vwap'
+    :param volumes: Traded volumes shaped like prices, required for 'vwap'
+    :return: Series of prices indexed by token
+    """
+    if method == 'best_bid':
+        return prices.max(axis=1, skipna=True)
+    if method == 'median':
+        return prices.median(axis=1, skipna=True)
+    if method == 'vwap':
+        if volumes is None:
+            raise ValueError('vwap price selection requires volumes')
+        volumes = volumes.reindex_like(prices).where(prices.notna(), 0.0).fillna(0.0)
+        weighted = (prices.fillna(0.0) * volumes).sum(axis=1)
+        return weighted / volumes.sum(axis=1).replace(0.0, np.nan)
+    raise ValueError('Invalid price method provided')
+
+
+class Portfolio:
+    """
+    Wallet x token balances prepared for repeated valuation
+
+    The balance matrix is scaled to whole tokens once, so revaluing the
+    whole portfolio on a new set of prices is a single broadcast multiply.
+    """
+
+    def __init__(self, balances: pd.DataFrame, decimals: Union[int, Dict[str, int]] = 18) -> None:
+        self.wallets = balances.index
+        self.tokens = balances.columns
+        if isinstance(decimals, dict):
+            scale = np.array([10.0 ** -decimals.get(token, 18) for token in self.tokens])
+        else:
+            scale = np.full(len(self.tokens), 10.0 ** -decimals)
+        # Raw balances may be exact Python integers with None for failed calls
+        raw = balances.to_numpy(dtype=np.float64, na_value=np.nan)
+        self.amounts = np.nan_to_num(raw) * scale
+
+    def value(self, prices: pd.DataFrame, method: str = 'median',
+              volumes: Optional[pd.DataFrame] = None) -> PortfolioValue:
+        """
+        Value every holding in USD
+
+        :param prices: Prices indexed by token with one column per exchange
+        :param method: Price selection across exchanges, see select_prices
+        :param volumes: Traded volumes shaped like prices, required for 'vwap'
+        :return: per-holding values, per-wallet and per-token sums, and the total
+        """
+        token_prices = select_prices(prices, method, volumes).reindex(self.tokens)
+        return self.value_at(np.nan_to_num(token_prices.to_numpy(dtype=np.float64)))
+
+    def value_at(self, token_prices: np.ndarray) -> PortfolioValue:
+        """
+        Value every holding at one USD price per token
+
+        :param token_prices: Prices in the order of the balance columns
+        :return: per-holding values, per-wallet and per-token sums, and the total
+        """
+        values = self.amounts * token_prices
+        per_wallet = values.sum(axis=1)
+        per_token = values.sum(axis=0)
+        return PortfolioValue(
+            values=pd.DataFrame(values, index=self.wallets, columns=self.tokens),
+            per_wallet=pd.Series(per_wallet, index=self.wallets, name='value'),
+            per_token=pd.Series(per_token, index=self.tokens, name='value'),
+            total=float(per_token.sum()),
+        )
+
+
+def value_portfolio(balances: pd.DataFrame, prices: pd.DataFrame, method: str = 'median',
+                    volumes: Optional[pd.DataFrame] = None,
+                    decimals: Union[int, Dict[str, int]] = 18) -> PortfolioValue:
+    """
+    Function to value a wallet x token balance matrix in USD
+
+    :param balances: Raw balances indexed by wallet with one column per token, e.g. from get_token_balances
+    :param prices: Prices indexed by token with one column per exchange, e.g. from price_matrix
+    :param method: Price selection across exchanges, see select_prices
+    :param volumes: Traded volumes shaped like prices, required for 'vwap'
+    :param decimals: Token decimals, one value for all tokens or a dictionary per token
+    :return: per-holding values, per-wallet and per-token sums, and the total
+    """
+    return Portfolio(balances, decimals).value(prices, method, volumes)
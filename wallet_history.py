@@ -0,0 +1,158 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+from web3 import Web3
+
+from chain_store import ChainStore
+from log_scanner import TRANSFER_TOPIC, address_topic, scan_logs
+
+
+def _log_key(log: Dict) -> tuple:
+    return log['blockNumber'], log['logIndex']
+
+
+def _transfer_key(transfer: Dict) -> tuple:
+    return transfer['block_number'], transfer['log_index']
+
+
+def wallet_topic_filters(wallet_addresses: List[str], max_wallets_per_query: int = 500) -> List[List[Any]]:
+    """
+    Build the Transfer topic filters matching the logs sent or received by any of many wallets
+
+    eth_getLogs ANDs topic positions together, so "from OR to a wallet"
+    takes two filters: one with the wallets in topic1 (outgoing) and one
+    with them in topic2 (incoming). Each filter covers every wallet in its
+    topic array, so the whole portfolio is two filters per
+    ``max_wallets_per_query`` wallets.
+
+    :param wallet_addresses: wallets to follow
+    :param max_wallets_per_query: maximum number of wallets per topic filter
+    :return: eth_getLogs topic filters, two per wallet chunk
+    """
+    wallet_topics = sorted({address_topic(wallet_address) for wallet_address in wallet_addresses})
+    filters = []
+    for start in range(0, len(wallet_topics), max_wallets_per_query):
+        chunk = wallet_topics[start:start + max_wallets_per_query]
+        filters.append([TRANSFER_TOPIC, chunk])
+        filters.append([TRANSFER_TOPIC, None, chunk])
+    return filters
+
+
+def merge_logs(streams: Iterable[Iterable[Dict]]) -> Iterator[Dict]:
+    """
+    Merge raw log streams that are each in block order
+
+    :param streams: log iterables, e.g. the scans of wallet_topic_filters
+    :return: generator of the logs in block order, logs matched by several filters yielded once
+    """
+    last_key = None
+    for log in heapq.merge(*streams, key=_log_key):
+        key = _log_key(log)
+        if key != last_key:
+            last_key = key
+            yield log
+
+
+def scan_wallet_transfer_logs(w3: Web3,
+                              wallet_addresses: List[str],
+                              token_addresses: List[str],
+                              from_block: int,
+                              to_block: Union[int, str] = 'latest',
+                              max_wallets_per_query: int = 500,
+                              **scan_kwargs: Any) -> Iterator[Dict]:
+    """
+    Scan Transfer logs sent or received by any of many wallets, for many tokens
+
+    Each filter of wallet_topic_filters covers every token in its address
+    array, so the whole portfolio is two range scans per
+    ``max_wallets_per_query`` wallets. The scans are merged in block order
+    and logs matched by both are yielded once. They all run on one pool of
+    ``max_workers`` threads, however many wallets are followed.
+
+    :param w3: Web3 instance to query
+    :param wallet_addresses: wallets to follow
+    :param token_addresses: token contract addresses
+    :param from_block: first block of the range
+    :param to_block: last block of the range, or 'latest'
+    :param max_wallets_per_query: maximum number of wallets per topic filter
+    :param scan_kwargs: chunking options passed to scan_logs
+    :return: generator of raw Transfer log entries in block order
+    """
+    if to_block == 'latest':
+        to_block = w3.eth.block_number
+    token_addresses = [Web3.toChecksumAddress(token_address) for token_address in token_addresses]
+    with ThreadPoolExecutor(max_workers=scan_kwargs.get('max_workers', 8)) as executor:
+        yield from merge_logs(scan_logs(w3, token_addresses, topics, from_block, to_block,
+                                        executor=executor, **scan_kwargs)
+                              for topics in wallet_topic_filters(wallet_addresses, max_wallets_per_query))
+
+
+def iter_stored_wallet_transfers(store: ChainStore,
+                                 wallet_addresses: List[str],
+                                 token_addresses: List[str],
+                                 from_block: int = 0,
+                                 to_block: Optional[int] = None,
+                                 max_wallets_per_query: int = 400) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the stored transfers sent or received by any of many wallets
+
+    Each query covers one token and up to ``max_wallets_per_query`` wallets,
+    so the number of queries grows with the wallet chunks instead of with
+    every wallet. Chunks are kept small enough for SQLite's limit on bound
+    parameters, each wallet being bound twice.
+
+    :param store: chain store synced for the tokens
+    :param wallet_addresses: wallets to follow
+    :param token_addresses: token contract addresses
+    :param from_block: first block of the range
+    :param to_block: last block of the range, defaults to the last stored block
+    :param max_wallets_per_query: maximum number of wallets per query
+    :return: generator of decoded transfers in block order, each yielded once
+    """
+    wallet_addresses = sorted({Web3.toChecksumAddress(wallet_address) for wallet_address in wallet_addresses})
+    return merge_transfers(
+        store.iter_transfers(token_address, from_block, to_block,
+                             wallet_addresses=wallet_addresses[start:start + max_wallets_per_query])
+        for token_address in token_addresses
+        for start in range(0, len(wallet_addresses), max_wallets_per_query)
+    )
+
+
+def merge_transfers(streams: Iterable[Iterable[Dict[str, Any]]]) -> Iterator[Dict[str, Any]]:
+    """
+    Merge decoded transfer streams that are each in block order
+
+    :param streams: decoded transfer iterables, e.g. per-wallet store queries
+    :return: generator of the transfers in block order, each yielded once
+    """
+    last_key = None
+    for transfer in heapq.merge(*streams, key=_transfer_key):
+        key = _transfer_key(transfer)
+        if key != last_key:
+            last_key = key
+            yield transfer
+
+
+def split_by_wallet(transfers: Iterable[Dict[str, Any]],
+                    wallet_addresses: List[str]) -> Dict[str, Dict[str, List[Dict[str, Any]]]]:
+    """
+    Sort decoded transfers into incoming and outgoing lists per wallet
+
+    A transfer between two followed wallets is outgoing for the sender and
+    incoming for the recipient.
+
+    :param transfers: decoded transfers
+    :param wallet_addresses: followed wallets
+    :return: dictionary mapping each wallet to its 'incoming' and 'outgoing' transfers
+    """
+    wallets = {wallet_address.lower(): wallet_address for wallet_address in wallet_addresses}
+    history = {wallet_address: {'incoming': [], 'outgoing': []} for wallet_address in wallet_addresses}
+    for transfer in transfers:
+        sender = wallets.get(transfer['from'].lower())
+        if sender is not None:
+            history[sender]['outgoing'].append(transfer)
+        recipient = wallets.get(transfer['to'].lower())
+        if recipient is not None:
+            history[recipient]['incoming'].append(transfer)
+    return history